@@ -0,0 +1,81 @@
+# Copyright (c) weykent <weykent@weasyl.com>
+# See COPYING for details.
+
+"""
+Time no-op converges of one service with a 20 variable envdir.
+
+    PYTHONPATH=library python benchmarks/converge.py [iterations]
+
+Each converge is bracketed by getppid() calls, so that running this under
+strace makes the syscalls of a single converge easy to pick out.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import runit_sv
+
+
+class Done(BaseException):
+    pass
+
+
+class BenchModule(object):
+    check_mode = False
+
+    def __init__(self, params):
+        self.params = params
+
+    def __call__(self, argument_spec, supports_check_mode):
+        for name, spec in argument_spec.items():
+            self.params.setdefault(name, spec.get('default'))
+        return self
+
+    def exit_json(self, **result):
+        raise Done(result)
+
+    def fail_json(self, **result):
+        raise RuntimeError(result)
+
+
+def converge(basedir):
+    module = BenchModule(dict(
+        name='bench',
+        runscript='#!/bin/sh\nexec bench\n',
+        log_runscript='#!/bin/sh\nexec svlogd -tt main\n',
+        envdir=dict(('VAR%d' % (i,), 'value %d' % (i,)) for i in range(20)),
+        sv_directory=[os.path.join(basedir, 'sv')],
+        service_directory=[os.path.join(basedir, 'service')],
+        init_d_directory=[os.path.join(basedir, 'init.d')],
+    ))
+    try:
+        runit_sv.main(module)
+    except Done as e:
+        return e.args[0]
+
+
+def main(iterations=1000):
+    basedir = tempfile.mkdtemp()
+    try:
+        for d in ['sv', 'service', 'init.d']:
+            os.mkdir(os.path.join(basedir, d))
+        converge(basedir)
+        os.getppid()
+        result = converge(basedir)
+        os.getppid()
+        assert not result['changed'], result
+        clock = getattr(time, 'process_time', None) or time.clock
+        start = clock()
+        for _ in range(iterations):
+            converge(basedir)
+        elapsed = clock() - start
+        print('%.1f us CPU per no-op converge' % (elapsed / iterations * 1e6))
+    finally:
+        shutil.rmtree(basedir)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
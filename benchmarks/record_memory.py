@@ -0,0 +1,43 @@
+# Copyright (c) weykent <weykent@weasyl.com>
+# See COPYING for details.
+
+"""
+Measure how much memory each kind of record takes, as allocated by the
+interpreter while building a large plan of them. Needs Python 3's tracemalloc.
+
+    PYTHONPATH=library python benchmarks/record_memory.py [count]
+"""
+
+import os
+import sys
+import tracemalloc
+
+import runit_sv
+
+
+def build(count, factory):
+    # Build the paths up front so that only the records themselves are
+    # measured; the planner shares path strings the same way.
+    paths = [os.path.join('/etc/sv/bench/env', 'VAR%d' % (i,))
+             for i in range(count)]
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    records = [factory(path) for path in paths]
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return (after - before) / float(count)
+
+
+def main(count=100000):
+    factories = [
+        ('FileRecord', lambda p: runit_sv.FileRecord(p, 0o644, 'value')),
+        ('LinkRecord', lambda p: runit_sv.LinkRecord(p, '/etc/sv/bench')),
+        ('RemoveThing', runit_sv.rm),
+    ]
+    for name, factory in factories:
+        print('%-12s %6.1f bytes/record' % (name, build(count, factory)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Copyright (c) weykent <weykent@weasyl.com>
+# See COPYING for details.
+
+"""
+Export the state of every runit service as a node_exporter textfile.
+
+    runit_sv_metrics.py [--service-directory DIR ...] [--output FILE]
+                        [--interval SECONDS] [--once]
+
+Every interval, each supervise/status under the service directories (and
+under each service's log/) is read in one pass, without running sv, and the
+textfile is replaced atomically. --service-directory can be given more than
+once, as for each of the service_shards services are linked into. Restarts
+are counted from the pid of a service changing between scrapes.
+"""
+
+import argparse
+import errno
+import os
+import struct
+import sys
+import tempfile
+import time
+
+# runsv's supervise/status: a tai64n timestamp of the last state change, the
+# pid (little-endian, 0 if not running), then the paused flag, what's wanted
+# ('u' or 'd'), the term flag, and the state (0 down, 1 run, 2 finish).
+SUPERVISE_STATUS = struct.Struct('<8s4sIBcBB')
+TAI64_EPOCH = (1 << 62) + 10
+STATES = {0: 'down', 1: 'run', 2: 'finish'}
+
+METRICS = [
+    ('runit_service_up', 'gauge',
+     'Whether the service is running.'),
+    ('runit_service_want_up', 'gauge',
+     'Whether the service is wanted up.'),
+    ('runit_service_paused', 'gauge',
+     'Whether the service is paused.'),
+    ('runit_service_state_change_timestamp_seconds', 'gauge',
+     'When the service last changed state.'),
+    ('runit_service_uptime_seconds', 'gauge',
+     'How long the service has been in its current state.'),
+    ('runit_service_restarts_total', 'counter',
+     'Restarts of the service seen by this collector.'),
+]
+
+
+def read_status(supervise):
+    """
+    Parse a runsv status file into a dict, or return None if there isn't a
+    complete one.
+    """
+    try:
+        fd = os.open(os.path.join(supervise, 'status'), os.O_RDONLY)
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return None
+    try:
+        data = os.read(fd, SUPERVISE_STATUS.size)
+    finally:
+        os.close(fd)
+    if len(data) != SUPERVISE_STATUS.size:
+        return None
+    # The timestamp's seconds are big-endian, unlike the pid.
+    seconds, = struct.unpack('>Q', data[:8])
+    _, _, pid, paused, want, _, state = SUPERVISE_STATUS.unpack(data)
+    return dict(
+        timestamp=seconds - TAI64_EPOCH,
+        pid=pid,
+        paused=bool(paused),
+        want_up=want == b'u',
+        state=STATES.get(state, 'unknown'),
+    )
+
+
+def scrape(service_directories):
+    """
+    Read the status of every service, and every log service, under each of
+    the service directories. Returns a dict of service name to status; log
+    services are named '<name>/log'.
+    """
+    statuses = {}
+    for service_directory in service_directories:
+        for name in sorted(os.listdir(service_directory)):
+            if name.startswith('.'):
+                continue
+            service = os.path.join(service_directory, name)
+            for label, supervise in [
+                    (name, os.path.join(service, 'supervise')),
+                    (name + '/log',
+                     os.path.join(service, 'log', 'supervise'))]:
+                status = read_status(supervise)
+                if status is not None:
+                    statuses.setdefault(label, status)
+    return statuses
+
+
+class Collector(object):
+    """
+    Tracks the pid of every service across scrapes, to count its restarts.
+    """
+
+    def __init__(self, service_directories):
+        self.service_directories = service_directories
+        self.pids = {}
+        self.restarts = {}
+
+    def __repr__(self):
+        return '<%s %#x: %r>' % (
+            type(self).__name__, id(self), self.service_directories)
+
+    def update(self, statuses):
+        for name, status in statuses.items():
+            pid = status['pid']
+            previous = self.pids.get(name)
+            self.restarts.setdefault(name, 0)
+            if pid and previous and pid != previous:
+                self.restarts[name] += 1
+            if pid:
+                self.pids[name] = pid
+
+    def render(self, statuses, now):
+        samples = dict((metric, []) for metric, _, _ in METRICS)
+        for name, status in sorted(statuses.items()):
+            labels = '{service="%s"}' % (
+                name.replace('\\', '\\\\').replace('"', '\\"'),)
+            up = status['pid'] != 0 and status['state'] == 'run'
+            for metric, value in [
+                    ('runit_service_up', int(up)),
+                    ('runit_service_want_up', int(status['want_up'])),
+                    ('runit_service_paused', int(status['paused'])),
+                    ('runit_service_state_change_timestamp_seconds',
+                     status['timestamp']),
+                    ('runit_service_uptime_seconds',
+                     max(0, now - status['timestamp'])),
+                    ('runit_service_restarts_total',
+                     self.restarts.get(name, 0))]:
+                samples[metric].append('%s%s %s\n' % (metric, labels, value))
+        lines = []
+        for metric, kind, help_text in METRICS:
+            lines.append('# HELP %s %s\n' % (metric, help_text))
+            lines.append('# TYPE %s %s\n' % (metric, kind))
+            lines.extend(samples[metric])
+        return ''.join(lines)
+
+    def collect(self, now=None):
+        statuses = scrape(self.service_directories)
+        self.update(statuses)
+        return self.render(statuses, int(time.time() if now is None else now))
+
+
+def write_textfile(path, text):
+    # node_exporter must never see a partly written file, so write it beside
+    # the real one and rename it over.
+    directory = os.path.dirname(os.path.abspath(path))
+    outfile = tempfile.NamedTemporaryFile(
+        mode='w', dir=directory, prefix='.tmp', suffix='~', delete=False)
+    try:
+        with outfile:
+            outfile.write(text)
+        os.chmod(outfile.name, 0o644)
+        os.rename(outfile.name, path)
+    except Exception:
+        os.unlink(outfile.name)
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export runit service states as a node_exporter '
+        'textfile.')
+    parser.add_argument(
+        '--service-directory', dest='service_directories', action='append',
+        help='a service directory to scrape; may be given more than once '
+        '(default: /etc/service)')
+    parser.add_argument(
+        '--output',
+        default='/var/lib/node_exporter/textfile_collector/runit.prom')
+    parser.add_argument('--interval', type=float, default=15)
+    parser.add_argument(
+        '--once', action='store_true', help='scrape once, then exit')
+    args = parser.parse_args(argv)
+
+    collector = Collector(args.service_directories or ['/etc/service'])
+    while True:
+        write_textfile(args.output, collector.collect())
+        if args.once:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,24 +2,56 @@
 # Copyright (c) weykent <weykent@weasyl.com>
 # See COPYING for details.
 
+import argparse
+import ctypes
+import ctypes.util
 import errno
+import fcntl
 import functools
 import hashlib
+import io
+import json
+import multiprocessing
+import multiprocessing.pool
 import os
+import random
+import re
+import select
 import shutil
 import stat
+import struct
+import sys
 import tempfile
+import time
 import traceback
 
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
 EXECUTABLE = 0o777
 NONEXECUTABLE = 0o666
 SETTABLE_MASK = 0o7777
+HASH_CHUNK_SIZE = 1 << 16
+
+text_type = type(u'')
+# Python 3 has faster or more correct primitives for some of what this module
+# does; use them when they exist, and fall back to the Python 2 ones.
+_file_digest = getattr(hashlib, 'file_digest', None)
+replace = getattr(os, 'replace', os.rename)
 
 
 def settable_mode(m):
     return m & SETTABLE_MASK
 
 
+def to_bytes(value):
+    if isinstance(value, text_type):
+        return value.encode('utf-8')
+    return value
+
+
 def first_directory(directories):
     for d in directories:
         try:
@@ -34,24 +66,40 @@ def first_directory(directories):
     return None
 
 
-def hash_file(path, chunksize=4096):
+def hash_file(path, chunksize=HASH_CHUNK_SIZE):
+    # Going through the bare file descriptor skips the buffering layer of
+    # open() and the extra syscalls it makes; most managed files are small
+    # enough to be read in a single read().
     try:
-        infile = open(path, 'rb')
-    except IOError as e:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
         if e.errno != errno.ENOENT:
-            raise
+            raise IOError(e.errno, e.strerror, path)
         return None, None
-    hasher = hashlib.sha256()
-    with infile:
-        while True:
-            chunk = infile.read(chunksize)
-            if not chunk:
-                break
-            hasher.update(chunk)
-        s = os.fstat(infile.fileno())
+    try:
+        s = os.fstat(fd)
+        if _file_digest is not None and s.st_size > chunksize:
+            with io.FileIO(fd, 'rb', closefd=False) as infile:
+                hasher = _file_digest(infile, 'sha256')
+        else:
+            hasher = hashlib.sha256()
+            while True:
+                chunk = os.read(fd, chunksize)
+                hasher.update(chunk)
+                if len(chunk) < chunksize:
+                    break
+    except OSError as e:
+        # Errors from reading are IOErrors too, as they were from open().
+        raise IOError(e.errno, e.strerror, path)
+    finally:
+        os.close(fd)
     return hasher.hexdigest(), s.st_mode
 
 
+def hash_content(content):
+    return hashlib.sha256(to_bytes(content)).hexdigest()
+
+
 def makedirs_exist_ok(path):
     try:
         os.makedirs(path)
@@ -60,247 +108,1636 @@ def makedirs_exist_ok(path):
             raise
 
 
+SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+def parse_size(value):
+    """
+    Parse a size in bytes, optionally suffixed with K, M, G or T (powers of
+    1024). Integers are returned unchanged.
+    """
+    if isinstance(value, int):
+        return value
+    value = str(value).strip()
+    multiplier = SIZE_SUFFIXES.get(value[-1:].lower())
+    if multiplier is None:
+        return int(value)
+    return int(value[:-1]) * multiplier
+
+
+class LockTimeoutError(Exception):
+    pass
+
+
+def flock_first_available(fds, operation, timeout, interval=0.01,
+                          max_interval=0.5):
+    start = time.time()
+    while True:
+        for fd in fds:
+            try:
+                fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            else:
+                return fd, time.time() - start
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            raise LockTimeoutError(fds, timeout)
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+
+
+def flock_with_timeout(fd, operation, timeout):
+    _, waited = flock_first_available([fd], operation, timeout)
+    return waited
+
+
+class DirectoryLocks(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.waited = 0.0
+        self.fds = []
+
+    def __repr__(self):
+        return '<%s %#x: %d held, waited %.3fs>' % (
+            type(self).__name__, id(self), len(self.fds), self.waited)
+
+    def _open(self, path, create):
+        try:
+            return os.open(path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        if not create:
+            return None
+        makedirs_exist_ok(path)
+        return os.open(path, os.O_RDONLY)
+
+    def acquire(self, path, operation, create=False):
+        # The directory can be removed and recreated by whoever held the lock
+        # before us, so make sure the locked inode is still the one at path.
+        while True:
+            fd = self._open(path, create)
+            if fd is None:
+                return False
+            try:
+                self.waited += flock_with_timeout(
+                    fd, operation, self.timeout - self.waited)
+                current = os.stat(path)
+            except LockTimeoutError:
+                os.close(fd)
+                raise LockTimeoutError(path, self.timeout)
+            except OSError as e:
+                os.close(fd)
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            except Exception:
+                os.close(fd)
+                raise
+            locked = os.fstat(fd)
+            if (current.st_dev, current.st_ino) == (
+                    locked.st_dev, locked.st_ino):
+                self.fds.append(fd)
+                return True
+            os.close(fd)
+
+    def release(self):
+        while self.fds:
+            os.close(self.fds.pop())
+
+
+def missing_directories(path):
+    missing = []
+    while path and not os.path.isdir(path):
+        missing.append(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return missing
+
+
+def unlink_exist_ok(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def write_temporary_file(directory, content, mode):
+    outfile = tempfile.NamedTemporaryFile(
+        dir=directory, prefix='.tmp', suffix='~', delete=False)
+    try:
+        with outfile:
+            outfile.write(to_bytes(content))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.chmod(outfile.name, mode)
+    except Exception:
+        unlink_exist_ok(outfile.name)
+        raise
+    return outfile.name
+
+
+def move_aside(path):
+    directory = os.path.dirname(path)
+    s = os.lstat(path)
+    if stat.S_ISDIR(s.st_mode):
+        # Renaming a directory replaces an empty one, so a fresh mkdtemp
+        # reserves the name without any race.
+        aside_path = tempfile.mkdtemp(dir=directory, prefix='.tmp', suffix='~')
+        os.rename(path, aside_path)
+        return aside_path
+    while True:
+        aside_path = tempfile.mktemp(dir=directory, prefix='.tmp', suffix='~')
+        try:
+            os.link(path, aside_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            continue
+        os.unlink(path)
+        return aside_path
+
+
+def make_temporary_symlink(directory, target):
+    # The dot prefix also keeps runsvdir from ever treating the temporary
+    # link as a service when it's made in the service directory.
+    while True:
+        path = tempfile.mktemp(dir=directory, prefix='.tmp', suffix='~')
+        try:
+            os.symlink(target, path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            continue
+        return path
+
+
+def snapshot_path(path):
+    try:
+        s = os.lstat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    if stat.S_ISLNK(s.st_mode):
+        return 'link', os.readlink(path)
+    elif stat.S_ISREG(s.st_mode):
+        with open(path, 'rb') as infile:
+            return 'file', infile.read(), settable_mode(s.st_mode)
+    else:
+        return 'other', s.st_mode
+
+
+def restore_snapshot(path, snapshot):
+    if snapshot is not None and snapshot[0] == 'other':
+        # Nothing applied by a record replaces anything that isn't a file or
+        # a symlink, so there's nothing to put back.
+        return
+    elif snapshot is None:
+        unlink_exist_ok(path)
+        return
+    elif snapshot[0] == 'link':
+        replace(make_temporary_symlink(os.path.dirname(path), snapshot[1]),
+                path)
+    else:
+        _, content, mode = snapshot
+        replace(
+            write_temporary_file(os.path.dirname(path), content, mode), path)
+
+
+class RollbackFailedError(Exception):
+    pass
+
+
+def _discard_records(records):
+    for record in reversed(records):
+        try:
+            record.discard()
+        except Exception:
+            pass
+
+
+def _roll_back_records(records):
+    failed = []
+    for record in reversed(records):
+        try:
+            record.rollback()
+        except Exception:
+            failed.append((record.path, traceback.format_exc()))
+    return failed
+
+
+def commit_records(records):
+    """
+    Make every record's path match its desired state, or none of them.
+
+    Every record that must change is first prepared, which does all of the
+    slow and failure-prone work (writing and syncing new content to temporary
+    files) without touching any managed path. Then each record is applied,
+    journaling the previous state of its path first. If anything fails, the
+    applied records are rolled back from their journals in reverse order and
+    the original exception is re-raised.
+    """
+    to_commit = [record for record in records if record.must_change]
+    prepared = []
+    applied = []
+    try:
+        for record in to_commit:
+            prepared.append(record)
+            record.prepare()
+        for record in to_commit:
+            applied.append(record)
+            record.apply()
+    except Exception:
+        failed = _roll_back_records(applied)
+        _discard_records(prepared)
+        if failed:
+            raise RollbackFailedError(failed, traceback.format_exc())
+        raise
+    for record in to_commit:
+        record.finalize()
+
+
+class Record(object):
+    # Plans can hold a record for every file of every service managed in one
+    # process, so records don't carry a per-instance __dict__.
+    __slots__ = ('path', 'action', 'must_change', 'reason', 'current',
+                 'changed', 'created_directories')
+
+    def __init__(self, path):
+        self.path = path
+        self.action = None
+        self.must_change = False
+        self.reason = None
+        self.current = None
+        self.changed = False
+        self.created_directories = ()
+
+    def check_if_must_change(self):
+        self.current = None
+        self.reason = self._change_reason()
+        self.must_change = self.reason is not None
+
+    def describe_change(self):
+        """
+        Report why the record must change, and what its path is and should
+        be, from what was found when checking it.
+        """
+        current, desired = self._describe_states()
+        return dict(reason=self.reason, current=current, desired=desired)
+
+    def _ensure_parent(self):
+        parent = os.path.dirname(self.path)
+        self.created_directories = missing_directories(parent)
+        makedirs_exist_ok(parent)
+
+    def prepare(self):
+        pass
+
+    def apply(self):
+        raise NotImplementedError()
+
+    def rollback(self):
+        raise NotImplementedError()
+
+    def discard(self):
+        for directory in self.created_directories:
+            try:
+                os.rmdir(directory)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTEMPTY):
+                    raise
+        self.created_directories = ()
+
+    def finalize(self):
+        pass
+
+    def commit(self):
+        commit_records([self])
+
+
+class Semaphore(object):
+    """
+    A counting semaphore shared by every process on the host, made of one lock
+    file per slot. Holding an exclusive flock on any slot holds the semaphore.
+    """
+
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+        self.fd = None
+
+    def __repr__(self):
+        return '<%s %#x: %r(%d) held:%s>' % (
+            type(self).__name__, id(self), self.directory, self.count,
+            self.fd is not None)
+
+    def acquire(self, timeout):
+        makedirs_exist_ok(self.directory)
+        fds = []
+        try:
+            for slot in range(self.count):
+                fds.append(os.open(
+                    os.path.join(self.directory, 'slot-%d' % (slot,)),
+                    os.O_RDWR | os.O_CREAT, 0o600))
+            try:
+                self.fd, waited = flock_first_available(
+                    fds, fcntl.LOCK_EX, timeout)
+            except LockTimeoutError:
+                raise LockTimeoutError(self.directory, timeout)
+        finally:
+            for fd in fds:
+                if fd != self.fd:
+                    os.close(fd)
+        return waited
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+MANIFEST_VERSION = 1
+
+
+def source_digest():
+    """
+    Return a digest of this module's source, or None if it can't be read.
+    """
+    path = __file__
+    if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+    try:
+        with open(path, 'rb') as infile:
+            return hashlib.sha256(infile.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+# Manifests are keyed on the parameters, but what's generated from them
+# changes with the module itself; after an upgrade, none of the manifests an
+# older version wrote are current. The source is read once, on import.
+SOURCE_DIGEST = source_digest()
+# Parameters which change how runit_sv goes about converging, but not what
+# it converges to, and so don't invalidate a manifest.
+MANIFEST_IGNORED_PARAMS = frozenset([
+    'lock_timeout', 'state_directory', 'restart_concurrency',
+    'restart_jitter', 'verify', 'extra_file_actions', 'apply_action',
+    'only_paths', 'restart_timeout'])
+
+
+def _stat_ns(s, field):
+    ns = getattr(s, 'st_%s_ns' % (field,), None)
+    if ns is None:
+        ns = int(getattr(s, 'st_' + field) * 1e9)
+    return ns
+
+
+def stat_signature(path, contents=True):
+    """
+    Return what a manifest records about a path: None if it doesn't exist,
+    only its type if it's a directory whose contents aren't managed, and
+    otherwise enough of its stat to tell whether it was touched since.
+    """
+    try:
+        s = os.lstat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    if not contents and stat.S_ISDIR(s.st_mode):
+        return [stat.S_IFMT(s.st_mode)]
+    return [s.st_dev, s.st_ino, s.st_size, s.st_mode, _stat_ns(s, 'mtime'),
+            _stat_ns(s, 'ctime')]
+
+
+def params_digest(module, names, directories):
+    params = dict(
+        (name, value) for name, value in module.params.items()
+        if name not in MANIFEST_IGNORED_PARAMS)
+    normalized = json.dumps(
+        [MANIFEST_VERSION, SOURCE_DIGEST, params, names, directories],
+        sort_keys=True, default=repr)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+    """
+    What the last successful runit_sv run left on disk for a service: a
+    digest of the parameters it was run with, and the stat signature of every
+    path it manages. If neither has changed since, neither has the service,
+    and there's no need to read any of its files to know it.
+    """
+
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+
+    def __repr__(self):
+        return '<%s %#x: %r>' % (type(self).__name__, id(self), self.path)
+
+    def load(self):
+        """
+        Return the paths the manifest records if it's current, or None.
+        """
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            written = _stat_ns(os.fstat(fd), 'mtime')
+            chunks = []
+            while True:
+                chunk = os.read(fd, HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+        try:
+            manifest = json.loads(b''.join(chunks).decode('utf-8'))
+        except ValueError:
+            return None
+        if manifest.get('digest') != self.digest:
+            return None
+        for path, signature in manifest['entries']:
+            contents = signature is None or len(signature) > 1
+            # A path changed in the same clock tick the manifest was written
+            # in can't be told apart from how it was when it was recorded.
+            if contents and signature is not None and signature[5] >= written:
+                return None
+            if stat_signature(path, contents) != signature:
+                return None
+        return manifest['paths']
+
+    def save(self, records, directories):
+        """
+        Record the current state of the paths of every record, and of the
+        directories whose contents are managed.
+        """
+        entries = [[record.path, stat_signature(record.path, contents=False)]
+                   for record in records]
+        entries.extend(
+            [directory, stat_signature(directory)]
+            for directory in directories)
+        content = json.dumps(dict(
+            digest=self.digest,
+            paths=sorted(record.path for record in records),
+            entries=entries,
+        ), sort_keys=True)
+        directory = os.path.dirname(self.path)
+        makedirs_exist_ok(directory)
+        tmp = write_temporary_file(directory, content, 0o600)
+        try:
+            replace(tmp, self.path)
+        except Exception:
+            unlink_exist_ok(tmp)
+            raise
+
+    def discard(self):
+        unlink_exist_ok(self.path)
+
+
 class FileDoesNotExistError(Exception):
     pass
 
 
-class FileRecord(object):
+class FileRecord(Record):
+    __slots__ = ('mode', 'content', 'temporary_path', 'journal')
+
     def __init__(self, path, mode, content=None):
-        self.path = path
+        super(FileRecord, self).__init__(path)
         self.mode = mode
         self.content = content
-        self.must_change = False
-        self.changed = False
+        self.temporary_path = None
+        self.journal = None
 
     def __repr__(self):
         return '<%s %#x: %r @%r(%o)>' % (
             type(self).__name__, id(self), self.content, self.path, self.mode)
 
-    def _must_change_p(self):
+    def _change_reason(self):
         current_hash, current_mode = hash_file(self.path)
         if current_hash is None:
-            return self.content is not None
-        else:
-            if self.content is None:
-                return True
-            elif self.content is True:
-                content_matches = True
-            else:
-                content_matches = (
-                    hashlib.sha256(self.content).hexdigest() == current_hash)
-            return (
-                not content_matches
-                or self.mode != settable_mode(current_mode))
+            return 'missing' if self.content is not None else None
+        self.current = current_hash, settable_mode(current_mode)
+        if self.content is None:
+            return 'extra'
+        content_matches = self.content is True or (
+            hash_content(self.content) == current_hash)
+        mode_matches = self.mode == self.current[1]
+        if content_matches and mode_matches:
+            return None
+        elif mode_matches:
+            return 'content'
+        elif content_matches:
+            return 'mode'
+        return 'content+mode'
 
-    def check_if_must_change(self):
-        self.must_change = self._must_change_p()
+    def _describe_states(self):
+        current = desired = None
+        if self.current is not None:
+            current = dict(
+                digest=self.current[0], mode='%04o' % (self.current[1],))
+        if self.content is not None:
+            desired = dict(
+                digest=None if self.content is True else hash_content(
+                    self.content),
+                mode='%04o' % (self.mode,))
+        return current, desired
 
-    def commit(self):
-        if not self.must_change:
-            return
+    def prepare(self):
         if self.content is None:
-            try:
-                os.unlink(self.path)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise
+            return
         elif self.content is True:
             try:
-                filestat = os.lstat(self.path)
+                os.lstat(self.path)
             except OSError as e:
                 if e.errno == errno.ENOENT:
                     raise FileDoesNotExistError(self.path)
                 else:
                     raise
-            if not stat.S_ISLNK(filestat.st_mode):
+            return
+        self._ensure_parent()
+        self.temporary_path = write_temporary_file(
+            os.path.dirname(self.path), self.content, self.mode)
+        written_hash, _ = hash_file(self.temporary_path)
+        if written_hash != hash_content(self.content):
+            raise IOError(
+                errno.EIO, 'content did not survive writing',
+                self.temporary_path)
+
+    def apply(self):
+        self.journal = snapshot_path(self.path)
+        if self.content is None:
+            unlink_exist_ok(self.path)
+        elif self.content is True:
+            if self.journal is None:
+                raise FileDoesNotExistError(self.path)
+            elif self.journal[0] != 'link':
                 os.chmod(self.path, self.mode)
         else:
-            outdir = os.path.dirname(self.path)
-            makedirs_exist_ok(outdir)
-            outfile = tempfile.NamedTemporaryFile(
-                dir=outdir, prefix='.tmp', suffix='~', delete=False)
-            with outfile:
-                outfile.write(self.content)
-            os.chmod(outfile.name, self.mode)
-            os.rename(outfile.name, self.path)
+            replace(self.temporary_path, self.path)
+            self.temporary_path = None
         self.changed = True
 
+    def rollback(self):
+        if self.content is True:
+            if self.journal is not None and self.journal[0] == 'file':
+                os.chmod(self.path, self.journal[2])
+        else:
+            restore_snapshot(self.path, self.journal)
+        self.changed = False
+
+    def discard(self):
+        if self.temporary_path is not None:
+            unlink_exist_ok(self.temporary_path)
+            self.temporary_path = None
+        super(FileRecord, self).discard()
+
+    def finalize(self):
+        self.journal = None
+
 
 class PathAlreadyExistsError(Exception):
     pass
 
 
-class LinkRecord(object):
+class LinkRecord(Record):
+    __slots__ = ('target', 'dir_ok', 'journal', 'temporary_path')
+
     def __init__(self, path, target=None, dir_ok=False):
-        self.path = path
+        super(LinkRecord, self).__init__(path)
         self.target = target
         self.dir_ok = dir_ok
-        self.must_change = False
-        self.changed = False
+        self.journal = None
+        self.temporary_path = None
 
     def __repr__(self):
         return '<%s %#x: %r dir_ok:%s @%r>' % (
             type(self).__name__, id(self), self.target, self.dir_ok, self.path)
 
-    def _must_change_p(self):
+    def _change_reason(self):
         try:
-            current_target = os.readlink(self.path)
+            self.current = os.readlink(self.path)
         except OSError as e:
             if e.errno == errno.ENOENT:
-                return self.target is not None
+                return 'missing' if self.target is not None else None
             elif e.errno == errno.EINVAL:
                 if self.dir_ok and os.path.isdir(self.path):
-                    return False
+                    return None
                 else:
                     raise PathAlreadyExistsError(self.path)
             raise
-        return self.target != current_target
+        if self.target is None:
+            return 'extra'
+        elif self.target != self.current:
+            return 'target'
+        return None
 
-    def check_if_must_change(self):
-        self.must_change = self._must_change_p()
+    def _describe_states(self):
+        return (
+            None if self.current is None else dict(target=self.current),
+            None if self.target is None else dict(target=self.target))
 
-    def commit(self):
-        if not self.must_change:
-            return
+    def prepare(self):
+        if self.target is not None:
+            self._ensure_parent()
+            self.temporary_path = make_temporary_symlink(
+                os.path.dirname(self.path), self.target)
+
+    def apply(self):
+        # Retargeting renames a new link over the old one, so the path never
+        # stops existing; runsvdir would stop a service whose link it found
+        # missing in a rescan.
+        self.journal = snapshot_path(self.path)
+        if self.target is None:
+            unlink_exist_ok(self.path)
+        else:
+            replace(self.temporary_path, self.path)
+            self.temporary_path = None
+        self.changed = True
+
+    def rollback(self):
+        restore_snapshot(self.path, self.journal)
+        self.changed = False
+
+    def discard(self):
+        if self.temporary_path is not None:
+            unlink_exist_ok(self.temporary_path)
+            self.temporary_path = None
+        super(LinkRecord, self).discard()
+
+    def finalize(self):
+        self.journal = None
+
+
+class DirRecord(Record):
+    """
+    Ensures a directory exists with a mode. Directories are only ever created
+    by this; anything already in one is left alone.
+    """
+
+    __slots__ = ('mode', 'created')
+
+    def __init__(self, path, mode):
+        super(DirRecord, self).__init__(path)
+        self.mode = mode
+        self.created = False
+
+    def __repr__(self):
+        return '<%s %#x: %r(%o)>' % (
+            type(self).__name__, id(self), self.path, self.mode)
+
+    def _change_reason(self):
         try:
-            os.unlink(self.path)
+            s = os.lstat(self.path)
         except OSError as e:
             if e.errno != errno.ENOENT:
                 raise
-        if self.target is not None:
-            makedirs_exist_ok(os.path.dirname(self.path))
-            os.symlink(self.target, self.path)
+            return 'missing'
+        if not stat.S_ISDIR(s.st_mode):
+            raise PathAlreadyExistsError(self.path)
+        self.current = settable_mode(s.st_mode)
+        return None if self.current == self.mode else 'mode'
+
+    def _describe_states(self):
+        current = None
+        if self.current is not None:
+            current = dict(mode='%04o' % (self.current,))
+        return current, dict(mode='%04o' % (self.mode,))
+
+    def prepare(self):
+        self._ensure_parent()
+
+    def apply(self):
+        if self.current is None:
+            os.mkdir(self.path, self.mode)
+            self.created = True
+        os.chmod(self.path, self.mode)
         self.changed = True
 
+    def rollback(self):
+        if self.created:
+            os.rmdir(self.path)
+            self.created = False
+        elif self.current is not None:
+            os.chmod(self.path, self.current)
+        self.changed = False
+
 
 class NotAThingError(Exception):
     pass
 
 
-class RemoveThing(object):
+class RemoveThing(Record):
+    __slots__ = ('stat_type', 'remover', 'aside_path')
+
     def __init__(self, path, stat_type, remover):
-        self.path = path
+        super(RemoveThing, self).__init__(path)
         self.stat_type = stat_type
         self.remover = remover
-        self.must_change = False
-        self.changed = False
+        self.aside_path = None
 
     def __repr__(self):
         return '<%s %#x: %r(%r, %r)>' % (
             type(self).__name__, id(self), self.path, self.stat_type,
             self.remover)
 
-    def _must_change_p(self):
+    def _change_reason(self):
         try:
             s = os.lstat(self.path)
         except OSError as e:
             if e.errno != errno.ENOENT:
                 raise
-            return False
+            return None
         if not getattr(stat, self.stat_type)(s.st_mode):
             raise NotAThingError(self.path, 'does not match', self.stat_type)
-        return True
+        self.current = self.stat_type
+        return 'stray'
 
-    def check_if_must_change(self):
-        self.must_change = self._must_change_p()
+    def _describe_states(self):
+        kind = 'directory' if self.stat_type == 'S_ISDIR' else 'file'
+        return dict(type=kind), None
 
-    def commit(self):
-        if not self.must_change:
-            return
-        self.remover(self.path)
+    def apply(self):
+        # Removal is deferred until every record has been applied; until then
+        # the thing is only moved aside, so that rolling back is a rename.
+        self.aside_path = move_aside(self.path)
         self.changed = True
 
+    def rollback(self):
+        if self.aside_path is not None:
+            replace(self.aside_path, self.path)
+            self.aside_path = None
+        self.changed = False
+
+    def finalize(self):
+        if self.aside_path is not None:
+            self.remover(self.aside_path)
+            self.aside_path = None
+
 
 rm = functools.partial(RemoveThing, stat_type='S_ISREG', remover=os.unlink)
 rmdir = functools.partial(
     RemoveThing, stat_type='S_ISDIR', remover=shutil.rmtree)
 
 
-def main(module_cls):
-    module = module_cls(
-        argument_spec=dict(
-            name=dict(required=True),
-            sv_directory=dict(type='list', default=['/etc/sv']),
-            service_directory=dict(type='list', default=['/service', '/etc/service']),
-            init_d_directory=dict(type='list', default=['/etc/init.d']),
-            runscript=dict(required=True),
-            log_runscript=dict(),
-            supervise_link=dict(),
-            log_supervise_link=dict(),
-            state=dict(
-                choices=['present', 'absent', 'down'], default='present'),
-            extra_files=dict(type='dict', default={}),
-            extra_scripts=dict(type='dict', default={}),
-            envdir=dict(type='dict'),
-            lsb_service=dict(choices=['present', 'absent']),
-            umask=dict(type='int', default=0o022),
-        ),
-        supports_check_mode=True,
-    )
+SVLOGD_TIMESTAMPS = {
+    'tai64n': ' -t', 'utc': ' -tt', 'iso': ' -ttt', 'none': ''}
+SVLOGD_CONFIG = [
+    ('size', 's', parse_size),
+    ('count', 'n', int),
+    ('min_count', 'N', int),
+    ('timeout', 't', int),
+]
+LOG_OPTIONS = frozenset(
+    ['directory', 'user', 'timestamp', 'compress', 'compress_nice',
+     'processor'] + [option for option, _, _ in SVLOGD_CONFIG])
 
-    try:
-        _main(module)
-    except Exception:
-        module.fail_json(
-            msg='unhandled exception', traceback=traceback.format_exc())
 
+class InvalidOptionsError(Exception):
+    pass
 
-def _main(module):
-    def first_directory_or_fail(name):
-        directories = module.params[name]
-        ret = first_directory(directories)
-        if ret is None:
-            module.fail_json(
-                msg='no extant directory found for %r out of %r' % (
-                    name, directories))
-        return ret
 
-    sv_directory = first_directory_or_fail('sv_directory')
-    service_directory = first_directory_or_fail('service_directory')
-    name = module.params['name']
-    state = module.params['state']
-    umask = module.params['umask']
-    sv = functools.partial(os.path.join, sv_directory, name)
-    exe = functools.partial(FileRecord, mode=EXECUTABLE & ~umask)
-    nexe = functools.partial(FileRecord, mode=NONEXECUTABLE & ~umask)
+def check_options(kind, options, allowed):
+    unknown = set(options) - allowed
+    if unknown:
+        raise InvalidOptionsError(
+            'unknown %s options: %s' % (kind, ', '.join(sorted(unknown))))
 
-    outfiles = []
-    outfiles.append(exe(sv('run'), content=module.params['runscript']))
-    directories_to_clear = []
-    directories_to_clear.append(sv())
-    if module.params['log_runscript'] is None:
-        if module.params['log_supervise_link'] is not None:
-            module.fail_json(
-                msg='log_supervise_link must be specified with log_runscript')
-        outfiles.append(rmdir(sv('log')))
-    else:
-        outfiles.append(
-            exe(sv('log', 'run'), content=module.params['log_runscript']))
-        directories_to_clear.append(sv('log'))
-    for filename, content in module.params['extra_files'].iteritems():
+
+def svlogd_service(options):
+    """
+    Build the run script of a log service running svlogd from a dict of log
+    options, along with the path of its log directory (relative to the log
+    service directory unless absolute) and the contents of the svlogd config
+    file to put there.
+    """
+    check_options('log', options, LOG_OPTIONS)
+    directory = options.get('directory', 'main')
+    timestamp = options.get('timestamp', 'utc')
+    if timestamp not in SVLOGD_TIMESTAMPS:
+        raise InvalidOptionsError(
+            'log timestamp must be one of %s' % (
+                ', '.join(sorted(SVLOGD_TIMESTAMPS)),))
+
+    config = []
+    for option, letter, convert in SVLOGD_CONFIG:
+        value = options.get(option)
+        if value is None:
+            continue
+        try:
+            value = convert(value)
+        except ValueError:
+            raise InvalidOptionsError(
+                'invalid log %s: %r' % (option, value))
+        config.append('%s%d\n' % (letter, value))
+    compress = options.get('compress')
+    if compress in (True, 'yes', 'true', 'True'):
+        compress = 'gzip'
+    elif compress in (False, 'no', 'false', 'False'):
+        compress = None
+    processor = options.get('processor')
+    if compress is not None:
+        if processor is not None:
+            raise InvalidOptionsError(
+                'log compress and processor are mutually exclusive')
+        processor = 'nice -n %d %s' % (
+            int(options.get('compress_nice', 19)), compress)
+    if processor is not None:
+        config.append('!%s\n' % (processor,))
+
+    runscript = ['#!/bin/sh\n']
+    chpst = ''
+    quoted_directory = shell_quote(directory)
+    user = options.get('user')
+    if user is not None:
+        user = shell_quote(str(user))
+        runscript.append('mkdir -p %s\nchown %s %s\n' % (
+            quoted_directory, user, quoted_directory))
+        chpst = 'chpst -u %s ' % (user,)
+    runscript.append('exec %ssvlogd%s %s\n' % (
+        chpst, SVLOGD_TIMESTAMPS[timestamp], quoted_directory))
+    return ''.join(runscript), directory, ''.join(config)
+
+
+WRAPPED_RUNSCRIPT = 'run.service'
+CHPST_LIMITS = [
+    ('memory', '-m', parse_size),
+    ('data', '-d', parse_size),
+    ('open_files', '-o', int),
+    ('processes', '-p', int),
+    ('file_size', '-f', parse_size),
+    ('core', '-c', parse_size),
+    ('cpu_time', '-t', int),
+]
+LIMITS_OPTIONS = frozenset(option for option, _, _ in CHPST_LIMITS)
+
+
+def chpst_limits(options):
+    """
+    Build the chpst command limiting the resources of a service from a dict
+    of limits options.
+    """
+    check_options('limits', options, LIMITS_OPTIONS)
+    command = ['chpst']
+    for option, flag, convert in CHPST_LIMITS:
+        value = options.get(option)
+        if value is None:
+            continue
+        try:
+            value = convert(value)
+        except ValueError:
+            value = -1
+        if value < 0:
+            raise InvalidOptionsError(
+                'invalid limits %s: %r' % (option, options[option]))
+        command.append('%s %d' % (flag, value))
+    return ' '.join(command)
+
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+CPU_LIST_ITEM = re.compile(r'^\d+(-\d+)?$')
+
+
+def scheduling_prefix(cpu_affinity=None, nice=None, ionice_class=None,
+                      ionice_level=None):
+    """
+    Build the taskset, nice and ionice commands applying a service's
+    scheduling policy.
+    """
+    prefix = []
+    if cpu_affinity is not None:
+        cpus = [str(cpu).strip() for cpu in cpu_affinity]
+        if not cpus or not all(CPU_LIST_ITEM.match(cpu) for cpu in cpus):
+            raise InvalidOptionsError(
+                'invalid cpu_affinity: %r' % (cpu_affinity,))
+        prefix.append('taskset -c %s' % (','.join(cpus),))
+    if nice is not None:
+        if not -20 <= nice <= 19:
+            raise InvalidOptionsError('nice must be between -20 and 19')
+        prefix.append('nice -n %d' % (nice,))
+    if ionice_level is not None:
+        if not 0 <= ionice_level <= 7:
+            raise InvalidOptionsError('ionice_level must be between 0 and 7')
+        if ionice_class is None:
+            ionice_class = 'best-effort'
+        elif ionice_class == 'idle':
+            raise InvalidOptionsError(
+                'ionice_level is meaningless with ionice_class=idle')
+    if ionice_class is not None:
+        command = 'ionice -c %d' % (IONICE_CLASSES[ionice_class],)
+        if ionice_level is not None:
+            command += ' -n %d' % (ionice_level,)
+        prefix.append(command)
+    return prefix
+
+
+def run_wrapper(setup, prefix):
+    """
+    Build a run script which runs some setup shell code and then execs the
+    service's own run script, installed next to it as WRAPPED_RUNSCRIPT,
+    through a chain of command prefixes.
+    """
+    script = ['#!/bin/sh\n']
+    script.extend(setup)
+    script.append('exec %s./%s\n' % (
+        ''.join(command + ' ' for command in prefix), WRAPPED_RUNSCRIPT))
+    return ''.join(script)
+
+
+# The wait loop only wakes to poll a dependency's status byte and run its
+# check script, backing off exponentially in tenths of a second.
+REQUIRES_WAIT = """\
+runit_sv_ready() {
+    [ "$(od -An -j19 -N1 -tu1 "$1/supervise/status" 2>/dev/null \\
+        | tr -d ' ')" = 1 ] || return 1
+    [ ! -x "$1/check" ] || (cd "$1" && exec ./check) >/dev/null 2>&1
+}
+for dependency in %(dependencies)s; do
+    delay=1
+    until runit_sv_ready "$dependency"; do
+        sleep "$((delay / 10)).$((delay %% 10))"
+        delay=$((delay * 2))
+        [ "$delay" -le %(max_delay)d ] || delay=%(max_delay)d
+    done
+done
+"""
+
+
+def requires_wait(dependencies, max_delay):
+    """
+    Build the setup shell code making a run script block until every
+    dependency (an sv directory) is up, and passes its check script if it
+    has one.
+    """
+    try:
+        max_delay = int(float(max_delay) * 10)
+    except ValueError:
+        max_delay = 0
+    if max_delay < 1:
+        raise InvalidOptionsError(
+            'requires_max_delay must be at least 0.1 seconds')
+    return [REQUIRES_WAIT % dict(
+        dependencies=' '.join(shell_quote(d) for d in dependencies),
+        max_delay=max_delay)]
+
+
+CPU_MAX_PERIOD = 100000
+
+
+def _cgroup_limit(option, value, convert, minimum):
+    if str(value).strip() == 'max':
+        return 'max'
+    try:
+        converted = convert(value)
+    except ValueError:
+        converted = None
+    if converted is None or converted < minimum:
+        raise InvalidOptionsError('invalid %s: %r' % (option, value))
+    return converted
+
+
+def cgroup_setup(name, root, cpu_max=None, memory_max=None, io_weight=None,
+                 pids_max=None):
+    """
+    Build the setup shell code making a run script move itself into a cgroup
+    v2 group of its own under root, limited by the cgroup options, before it
+    execs the service. The code is empty if no limits are set.
+    """
+    limits = []
+    if cpu_max is not None:
+        cpus = _cgroup_limit('cpu_max', cpu_max, float, 0.01)
+        if cpus != 'max':
+            cpus = '%d' % (round(cpus * CPU_MAX_PERIOD),)
+        limits.append(('cpu', 'cpu.max', '%s %d' % (cpus, CPU_MAX_PERIOD)))
+    if memory_max is not None:
+        limits.append(('memory', 'memory.max', _cgroup_limit(
+            'memory_max', memory_max, parse_size, 1)))
+    if io_weight is not None:
+        if not 1 <= io_weight <= 10000:
+            raise InvalidOptionsError('io_weight must be between 1 and 10000')
+        limits.append(('io', 'io.weight', 'default %d' % (io_weight,)))
+    if pids_max is not None:
+        limits.append(('pids', 'pids.max', _cgroup_limit(
+            'pids_max', pids_max, int, 1)))
+    if not limits:
+        return []
+
+    # A service with limits it can't apply is never run unconfined; exiting
+    # has runsv try again a second later.
+    cgroup = os.path.join(root, name)
+    script = ['mkdir -p %s &&\n' % (shell_quote(cgroup),)]
+    script.append('echo %s > %s &&\n' % (
+        shell_quote(' '.join('+' + controller for controller, _, _ in limits)),
+        shell_quote(os.path.join(root, 'cgroup.subtree_control'))))
+    for _, filename, value in limits:
+        script.append('echo %s > %s &&\n' % (
+            shell_quote(str(value)),
+            shell_quote(os.path.join(cgroup, filename))))
+    script.append('echo $$ > %s || exit 111\n' % (
+        shell_quote(os.path.join(cgroup, 'cgroup.procs')),))
+    return [''.join(script)]
+
+
+# runsv runs ./finish after every exit of ./run, and only restarts ./run once
+# it returns. The crash count and the time of the last restart are kept in
+# supervise/, so they go away along with the rest of runsv's state.
+RESTART_BACKOFF_FINISH = """\
+#!/bin/sh
+state=supervise/backoff
+count=0
+last=0
+if [ -r "$state" ]; then
+    read count last < "$state" || count=0
+fi
+now=$(date +%%s)
+crashed=true
+if [ "$1" = 0 ] || { [ "$1" = -1 ] && [ "$2" = 15 ]; }; then
+    crashed=false
+fi
+if ! $crashed || [ $((now - last)) -ge %(reset_after)d ]; then
+    count=0
+fi
+delay=0
+if $crashed; then
+    delay=%(initial)d
+    i=0
+    while [ "$i" -lt "$count" ] && [ "$delay" -lt %(max)d ]; do
+        delay=$((delay * 2))
+        i=$((i + 1))
+    done
+    [ "$delay" -le %(max)d ] || delay=%(max)d
+    count=$((count + 1))
+fi
+# Stop backing off as soon as the service is wanted down.
+while [ "$delay" -gt 0 ] && [ "$(od -An -j17 -N1 -c supervise/status \\
+        2>/dev/null | tr -d ' ')" != d ]; do
+    sleep 1
+    delay=$((delay - 1))
+done
+echo "$count $(date +%%s)" > "$state.new" && mv "$state.new" "$state"
+"""
+RESTART_BACKOFF_OPTIONS = frozenset(['initial', 'max', 'reset_after'])
+
+
+def restart_backoff_finish(options):
+    """
+    Build a finish script which delays restarting a service exponentially
+    while it keeps crashing, from a dict of restart_backoff options. Exiting
+    0 or on a TERM (as from sv restart) isn't a crash, and staying up for
+    reset_after seconds forgets the crashes before.
+    """
+    check_options('restart_backoff', options, RESTART_BACKOFF_OPTIONS)
+    values = dict(initial=1, max=60, reset_after=60)
+    for option in RESTART_BACKOFF_OPTIONS:
+        value = options.get(option)
+        if value is None:
+            continue
+        try:
+            values[option] = int(value)
+        except ValueError:
+            values[option] = -1
+        if values[option] < 1:
+            raise InvalidOptionsError(
+                'invalid restart_backoff %s: %r' % (option, value))
+    if values['max'] < values['initial']:
+        raise InvalidOptionsError(
+            'restart_backoff max must be at least initial')
+    return RESTART_BACKOFF_FINISH % values
+
+
+# runsv runs control/<letter>, if it exists, on receiving that letter on its
+# control fifo; if it exits 0, runsv doesn't act on the letter itself.
+CONTROL_LETTERS = frozenset('udopchaiq12tkx')
+CONTROL_ALIASES = {
+    'up': 'u', 'down': 'd', 'once': 'o', 'pause': 'p', 'cont': 'c',
+    'hup': 'h', 'reload': 'h', 'alarm': 'a', 'interrupt': 'i', 'quit': 'q',
+    'usr1': '1', 'usr2': '2', 'term': 't', 'kill': 'k', 'exit': 'x',
+}
+
+
+def control_letters(control):
+    """
+    Map each control letter to its script, from a dict keyed by letters or
+    by the names of sv's commands.
+    """
+    letters = {}
+    for command, script in control.items():
+        letter = CONTROL_ALIASES.get(command, command)
+        if letter not in CONTROL_LETTERS:
+            raise InvalidOptionsError(
+                'invalid control command: %r' % (command,))
+        elif letter in letters:
+            raise InvalidOptionsError(
+                'control command %r specified more than once' % (letter,))
+        letters[letter] = script
+    return letters
+
+
+INSTANCES_AUTO = re.compile(r'^auto(?::cores(?:([*/])(\d+))?)?$')
+
+
+def cpu_count():
+    sched_getaffinity = getattr(os, 'sched_getaffinity', None)
+    if sched_getaffinity is not None:
+        return len(sched_getaffinity(0))
+    return multiprocessing.cpu_count()
+
+
+def parse_instances(value, cores=None):
+    """
+    Parse a number of instances: either an integer, or 'auto' (one per core),
+    'auto:cores', 'auto:cores/N' or 'auto:cores*N'. Scaling by the core count
+    never yields fewer than one instance.
+    """
+    if value is None:
+        return None
+    if isinstance(value, int):
+        count = value
+    else:
+        match = INSTANCES_AUTO.match(str(value).strip())
+        if match is None:
+            count = int(value)
+        else:
+            if cores is None:
+                cores = cpu_count()
+            operator, operand = match.groups()
+            if operator == '/':
+                count = max(1, cores // int(operand))
+            elif operator == '*':
+                count = cores * int(operand)
+            else:
+                count = cores
+    if count < 0:
+        raise ValueError(value)
+    return count
+
+
+def instance_name(name, index):
+    return '%s-%d' % (name, index)
+
+
+class InstanceList(object):
+    """
+    The names of the instances of a service which runit_sv has created. Only
+    these are ever removed as surplus, so that another service which merely
+    happens to be named like an instance is left alone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return '<%s %#x: %r>' % (type(self).__name__, id(self), self.path)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as infile:
+                names = json.loads(infile.read().decode('utf-8'))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        except ValueError:
+            return []
+        if not isinstance(names, list):
+            return []
+        return names
+
+    def save(self, names):
+        directory = os.path.dirname(self.path)
+        makedirs_exist_ok(directory)
+        tmp = write_temporary_file(directory, json.dumps(sorted(names)), 0o600)
+        try:
+            replace(tmp, self.path)
+        except Exception:
+            unlink_exist_ok(tmp)
+            raise
+
+
+def find_surplus_instances(name, count, known, directories):
+    """
+    Return which of the known instances of a service are numbered above the
+    count and still exist in any of the directories.
+    """
+    pattern = re.compile(r'^%s-([1-9]\d*)$' % (re.escape(name),))
+    surplus = set()
+    for entry in known:
+        match = pattern.match(entry)
+        if match is None or int(match.group(1)) <= count:
+            continue
+        if any(os.path.lexists(os.path.join(directory, entry))
+               for directory in directories):
+            surplus.add(entry)
+    return sorted(surplus)
+
+
+# runsv's supervise/status: a tai64n timestamp, the pid (little-endian, 0 if
+# the service isn't running), then the paused flag, what's wanted ('u' or
+# 'd'), the term flag, and the state (0 down, 1 run, 2 finish).
+SUPERVISE_STATUS = struct.Struct('<12sIBcBB')
+
+
+def read_supervise_status(supervise):
+    """
+    Return the pid, wanted state and state from a runsv status file, or None
+    if there isn't a complete one.
+    """
+    try:
+        fd = os.open(os.path.join(supervise, 'status'), os.O_RDONLY)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    try:
+        data = os.read(fd, SUPERVISE_STATUS.size)
+    finally:
+        os.close(fd)
+    if len(data) != SUPERVISE_STATUS.size:
+        return None
+    _, pid, _, want, _, state = SUPERVISE_STATUS.unpack(data)
+    return pid, want, state
+
+
+def _open_fifo(supervise, name):
+    # A fifo with no reader can't be opened for writing without blocking, so
+    # a nonblocking open tells whether runsv is running at all.
+    try:
+        return os.open(
+            os.path.join(supervise, name), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENXIO):
+            raise
+        return None
+
+
+def supervisor_running(supervise):
+    fd = _open_fifo(supervise, 'ok')
+    if fd is None:
+        return False
+    os.close(fd)
+    return True
+
+
+def send_control(supervise, commands):
+    """
+    Write each command to runsv's control fifo. Returns False if there's no
+    runsv to receive them.
+    """
+    fd = _open_fifo(supervise, 'control')
+    if fd is None:
+        return False
+    try:
+        for command in commands:
+            os.write(fd, command)
+    finally:
+        os.close(fd)
+    return True
+
+
+def stop_services(supervise_directories, timeout, interval=0.05):
+    """
+    Tell the runsv of every service to take it down and exit, then wait for
+    all of them at once until their status shows no process or the timeout
+    passes. Returns how long each signalled service took to stop, and the
+    names of those which didn't.
+    """
+    start = time.time()
+    pending = {}
+    for name, supervise in supervise_directories.items():
+        if send_control(supervise, [b'd', b'x']):
+            pending[name] = supervise
+    durations = {}
+    while pending:
+        now = time.time()
+        for name, supervise in list(pending.items()):
+            status = read_supervise_status(supervise)
+            if status is None or status[0] == 0:
+                durations[name] = now - start
+                del pending[name]
+        if not pending or now - start >= timeout:
+            break
+        time.sleep(interval)
+    return durations, sorted(pending)
+
+
+def resume_services(supervise_directories):
+    """
+    Bring back up every service stop_services took down, for when removing
+    them failed. A runsv which already exited is respawned by runsvdir, and
+    brings its service up by itself. Returns the names of the services told
+    to come up.
+    """
+    return sorted(
+        name for name, supervise in supervise_directories.items()
+        if send_control(supervise, [b'u']))
+
+
+# What a running service needs for a change to a file to take effect, from
+# least to most disruptive, and the control commands which do each.
+ACTIONS = ['none', 'reload', 'restart']
+ACTION_COMMANDS = {'reload': [b'h'], 'restart': [b't', b'c', b'u']}
+
+
+def default_action(relative):
+    """
+    Return what a change to a path inside a service's sv directory needs, as
+    a (service or log, action) tuple, or None if it needs nothing.
+    """
+    segments = relative.split(os.sep)
+    # runsv reads down only when it starts, and runs finish and control
+    # scripts afresh every time.
+    if segments[0] in (os.pardir, 'control') or relative in (
+            'down', 'finish'):
+        return None
+    elif segments[0] == 'log' and len(segments) > 1:
+        return 'log', 'restart'
+    return 'service', 'restart'
+
+
+def required_actions(records):
+    """
+    Return the least disruptive action which makes every change to the
+    records that must change take effect, for the service and the log
+    service of each service name.
+    """
+    required = {}
+    for record in records:
+        if not record.must_change or record.action is None:
+            continue
+        name, target, action = record.action
+        actions = required.setdefault(name, dict(service='none', log='none'))
+        if ACTIONS.index(action) > ACTIONS.index(actions[target]):
+            actions[target] = action
+    return required
+
+
+def apply_actions(required, sv_directory, state):
+    """
+    Send the control commands for each required action to the runsv of every
+    running service. Returns the actions sent, and the supervise directory
+    and pid of every process being restarted, keyed by service name (or
+    '<name>/log').
+    """
+    applied = {}
+    restarting = {}
+    for name, actions in sorted(required.items()):
+        for target, action in sorted(actions.items()):
+            commands = ACTION_COMMANDS.get(action)
+            if commands is None:
+                continue
+            segments = ['supervise'] if target == 'service' else [
+                'log', 'supervise']
+            # Restarting a service meant to stay down mustn't bring it up.
+            if target == 'service' and state != 'present':
+                commands = [c for c in commands if c != b'u']
+            supervise = os.path.join(sv_directory, name, *segments)
+            status = read_supervise_status(supervise)
+            if send_control(supervise, commands):
+                applied.setdefault(name, {})[target] = action
+                if action == 'restart' and status is not None and status[0]:
+                    label = name if target == 'service' else name + '/log'
+                    restarting[label] = supervise, status[0]
+    return applied, restarting
+
+
+def wait_for_restarts(restarting, timeout, interval=0.05):
+    """
+    Wait until every process being restarted has been replaced: its status
+    shows a different pid, and either shows it running or no process at all
+    for a service meant to stay down. Returns how long each took, and the
+    names of those which didn't finish restarting within the timeout.
+    """
+    start = time.time()
+    pending = dict(restarting)
+    durations = {}
+    while pending:
+        now = time.time()
+        for name, (supervise, old_pid) in list(pending.items()):
+            status = read_supervise_status(supervise)
+            pid, _, state = status or (None, None, None)
+            if status is None or (
+                    pid != old_pid and (pid == 0 or state == 1)):
+                durations[name] = now - start
+                del pending[name]
+        if not pending or now - start >= timeout:
+            break
+        time.sleep(interval)
+    return durations, sorted(pending)
+
+
+def choose_shard(name, shards, shard=None):
+    """
+    Return the service directory out of the shards which a service is linked
+    into: the explicitly chosen one, or one picked by hashing its name, so
+    that services spread evenly and always land in the same shard.
+    """
+    if shard is None:
+        shard = int(hashlib.sha256(to_bytes(name)).hexdigest(), 16) % len(
+            shards)
+    elif not 0 <= shard < len(shards):
+        raise InvalidOptionsError(
+            'shard must be between 0 and %d' % (len(shards) - 1,))
+    return shards[shard]
+
+
+def service_link_directories(module, service_directory):
+    """
+    Return every directory a link to a service might be found in: the
+    service directory, and each shard.
+    """
+    directories = [service_directory]
+    for shard in module.params['service_shards'] or []:
+        if os.path.normpath(shard) != os.path.normpath(service_directory):
+            directories.append(shard)
+    return directories
+
+
+def plan_service(module, name, sv_directory, service_directory,
+                 init_d_directory, instance=None):
+    """
+    Build the list of records describing the desired state of one service,
+    and the list of directories whose contents it manages.
+    """
+    state = module.params['state']
+    if state == 'absent' and module.params['remove_sv_directory']:
+        if module.params['lsb_service'] == 'present':
+            module.fail_json(
+                msg="lsb_service can't be set to present if state=absent")
+        return plan_removed_service(
+            name, sv_directory,
+            service_link_directories(module, service_directory),
+            init_d_directory, module.params['supervise_tmpfs_root'],
+            module.params['tmpfiles_directory']), []
+    umask = module.params['umask']
+    sv = functools.partial(os.path.join, sv_directory, name)
+    exe = functools.partial(FileRecord, mode=EXECUTABLE & ~umask)
+    nexe = functools.partial(FileRecord, mode=NONEXECUTABLE & ~umask)
+
+    outfiles = []
+    wrapper_setup = []
+    wrapper_prefix = []
+    limits = module.params['limits']
+    requires = module.params['requires']
+    try:
+        if requires:
+            if name in requires:
+                raise InvalidOptionsError("a service can't require itself")
+            wrapper_setup.extend(requires_wait(
+                [os.path.join(sv_directory, dependency)
+                 for dependency in requires],
+                module.params['requires_max_delay']))
+        wrapper_setup.extend(cgroup_setup(
+            name, module.params['cgroup_root'], module.params['cpu_max'],
+            module.params['memory_max'], module.params['io_weight'],
+            module.params['pids_max']))
+        wrapper_prefix.extend(scheduling_prefix(
+            module.params['cpu_affinity'], module.params['nice'],
+            module.params['ionice_class'], module.params['ionice_level']))
+        if limits is not None:
+            wrapper_prefix.append(chpst_limits(limits))
+    except InvalidOptionsError as e:
+        module.fail_json(msg=str(e))
+    if wrapper_setup or wrapper_prefix:
+        outfiles.append(exe(
+            sv('run'), content=run_wrapper(wrapper_setup, wrapper_prefix)))
+        outfiles.append(
+            exe(sv(WRAPPED_RUNSCRIPT), content=module.params['runscript']))
+    else:
+        outfiles.append(exe(sv('run'), content=module.params['runscript']))
+    directories_to_clear = []
+    directories_to_clear.append(sv())
+    paths_to_keep = []
+    log_runscript = module.params['log_runscript']
+    log = module.params['log']
+    if log is not None:
+        if log_runscript is not None:
+            module.fail_json(
+                msg='log and log_runscript are mutually exclusive')
+        try:
+            log_runscript, log_directory, log_config = svlogd_service(log)
+        except InvalidOptionsError as e:
+            module.fail_json(msg=str(e))
+        log_directory = os.path.normpath(log_directory)
+        if not os.path.isabs(log_directory):
+            # svlogd's own files live next to the config, so keep the log
+            # directory from being cleared out of log/ along with strays.
+            paths_to_keep.append(sv('log', log_directory.split(os.sep)[0]))
+            log_directory = sv('log', log_directory)
+        outfiles.append(
+            nexe(os.path.join(log_directory, 'config'), content=log_config))
+    if log_runscript is None:
+        if module.params['log_supervise_link'] is not None:
+            module.fail_json(
+                msg='log_supervise_link must be specified with log_runscript '
+                'or log')
+        outfiles.append(rmdir(sv('log')))
+    else:
+        outfiles.append(exe(sv('log', 'run'), content=log_runscript))
+        directories_to_clear.append(sv('log'))
+    restart_backoff = module.params['restart_backoff']
+    if restart_backoff is not None:
+        if 'finish' in module.params['extra_scripts']:
+            module.fail_json(
+                msg="restart_backoff can't be used with a finish extra script")
+        try:
+            finish = restart_backoff_finish(restart_backoff)
+        except InvalidOptionsError as e:
+            module.fail_json(msg=str(e))
+        outfiles.append(exe(sv('finish'), content=finish))
+    for filename, content in module.params['extra_files'].items():
         outfiles.append(nexe(sv(filename), content=content))
-    for filename, content in module.params['extra_scripts'].iteritems():
+    for filename, content in module.params['extra_scripts'].items():
         outfiles.append(exe(sv(filename), content=content))
     envdir = module.params['envdir']
+    if instance is not None:
+        envdir = dict(envdir or {})
+        envdir[module.params['instance_env_var']] = str(instance)
     if envdir is None:
         outfiles.append(rmdir(sv('env')))
     else:
-        for key, value in module.params['envdir'].iteritems():
+        for key, value in envdir.items():
             outfiles.append(nexe(sv('env', key), content=value))
         directories_to_clear.append(sv('env'))
+    control = module.params['control']
+    if control is None:
+        outfiles.append(rmdir(sv('control')))
+    else:
+        try:
+            control = control_letters(control)
+        except InvalidOptionsError as e:
+            module.fail_json(msg=str(e))
+        for letter, script in control.items():
+            outfiles.append(exe(sv('control', letter), content=script))
+        directories_to_clear.append(sv('control'))
     outfiles.append(nexe(sv('down'), content='' if state == 'down' else None))
 
-    def do_supervise_link(param, *segments):
-        target = module.params[param]
+    supervise_target = module.params['supervise_link']
+    log_supervise_target = module.params['log_supervise_link']
+    tmpfs_root = module.params['supervise_tmpfs_root']
+    if tmpfs_root is not None:
+        for param in ['supervise_link', 'log_supervise_link']:
+            if module.params[param] is not None:
+                module.fail_json(
+                    msg="%s can't be used with supervise_tmpfs_root" % (
+                        param,))
+        # Whatever is on a tmpfs is gone after a reboot. The directories are
+        # records like any other, and a tmpfiles.d entry has them recreated
+        # at boot, before runsvdir finds the supervise links dangling.
+        supervise_target = os.path.join(tmpfs_root, name)
+        targets = [supervise_target]
+        if log_runscript is not None:
+            log_supervise_target = os.path.join(tmpfs_root, name + '.log')
+            targets.append(log_supervise_target)
+        # runsv creates supervise as a directory of its own when there's no
+        # link there, and holds it open for as long as it runs, so it can't
+        # be swapped for a link from under an existing service.
+        for segments in [('supervise',), ('log', 'supervise')][:len(targets)]:
+            existing = sv(*segments)
+            if os.path.isdir(existing) and not os.path.islink(existing):
+                module.fail_json(
+                    msg='%s is already a directory, which runsv may be '
+                    'using; to move it to supervise_tmpfs_root, first stop '
+                    'the service with state=absent and no '
+                    'supervise_tmpfs_root, remove the directory, then run '
+                    'again' % (existing,))
+        for target in targets:
+            outfiles.append(DirRecord(target, mode=0o700))
+        tmpfiles_directory = module.params['tmpfiles_directory']
+        if tmpfiles_directory is not None:
+            outfiles.append(nexe(
+                tmpfiles_path(tmpfiles_directory, name),
+                content=''.join(
+                    'd %s 0700 - - -\n' % (target,) for target in targets)))
+
+    def do_supervise_link(target, *segments):
         outfiles.append(LinkRecord(
             sv(*segments), target=target, dir_ok=target is None))
 
-    do_supervise_link('supervise_link', 'supervise')
-    do_supervise_link('log_supervise_link', 'log', 'supervise')
+    do_supervise_link(supervise_target, 'supervise')
+    do_supervise_link(log_supervise_target, 'log', 'supervise')
 
+    link_directory = service_directory
+    shards = module.params['service_shards']
+    if shards:
+        link_directory = choose_shard(name, shards, module.params['shard'])
     outfiles.append(LinkRecord(
-        os.path.join(service_directory, name),
+        os.path.join(link_directory, name),
         target=None if state == 'absent' else sv()))
+    # Records are applied in order, so a service moving between shards is
+    # linked into its new shard before its old links are removed.
+    for directory in service_link_directories(module, service_directory):
+        if os.path.normpath(directory) != os.path.normpath(link_directory):
+            outfiles.append(LinkRecord(os.path.join(directory, name)))
 
     lsb_service = module.params['lsb_service']
     if state == 'absent':
@@ -308,7 +1745,6 @@ def _main(module):
             module.fail_json(
                 msg="lsb_service can't be set to present if state=absent")
     else:
-        init_d_directory = first_directory(module.params['init_d_directory'])
         if init_d_directory is None:
             if lsb_service is not None:
                 module.fail_json(
@@ -324,6 +1760,7 @@ def _main(module):
         module.fail_json(msg='duplicate file paths specified')
 
     paths_set.update(directories_to_clear)
+    paths_set.update(paths_to_keep)
     for to_clear in directories_to_clear:
         try:
             directory_paths = os.listdir(to_clear)
@@ -334,22 +1771,1137 @@ def _main(module):
         directory_paths = {os.path.join(to_clear, p) for p in directory_paths}
         outfiles.extend(rm(path) for path in directory_paths - paths_set)
 
+    actions = {}
+    if log is not None:
+        # svlogd rereads its config on a HUP.
+        actions[os.path.join(log_directory, 'config')] = 'log', 'reload'
+    extra_actions = module.params['extra_file_actions'] or {}
+    for filename, action in extra_actions.items():
+        if filename not in module.params['extra_files'] and (
+                filename not in module.params['extra_scripts']):
+            module.fail_json(
+                msg='extra_file_actions given for %r, which is neither an '
+                'extra file nor an extra script' % (filename,))
+        elif action not in ACTIONS:
+            module.fail_json(msg='invalid action for %r: %r' % (
+                filename, action))
+        actions[sv(filename)] = 'service', action
+    # Records share one tuple per distinct action, rather than one each.
+    interned = {}
     for outfile in outfiles:
-        outfile.check_if_must_change()
-    paths = {outfile.path: outfile.must_change for outfile in outfiles}
-    if not any(outfile.must_change for outfile in outfiles):
-        module.exit_json(paths=paths, changed=False)
-    elif module.check_mode:
-        module.exit_json(paths=paths, changed=True)
+        action = actions.get(outfile.path)
+        if action is None:
+            action = default_action(os.path.relpath(outfile.path, sv()))
+        if action is not None:
+            outfile.action = interned.setdefault(action, (name,) + action)
+    return outfiles, directories_to_clear
+
+
+def tmpfiles_path(tmpfiles_directory, name):
+    return os.path.join(tmpfiles_directory, 'runit_sv-%s.conf' % (name,))
+
+
+def plan_removed_service(name, sv_directory, service_directories,
+                         init_d_directory, supervise_tmpfs_root=None,
+                         tmpfiles_directory=None):
+    """
+    Build the list of records removing every trace of a service.
+    """
+    outfiles = [LinkRecord(os.path.join(directory, name))
+                for directory in service_directories]
+    if init_d_directory is not None:
+        outfiles.append(LinkRecord(os.path.join(init_d_directory, name)))
+    outfiles.append(rmdir(os.path.join(sv_directory, name)))
+    if supervise_tmpfs_root is not None:
+        outfiles.append(rmdir(os.path.join(supervise_tmpfs_root, name)))
+        outfiles.append(
+            rmdir(os.path.join(supervise_tmpfs_root, name + '.log')))
+        if tmpfiles_directory is not None:
+            outfiles.append(rm(tmpfiles_path(tmpfiles_directory, name)))
+    return outfiles
+
+
+ARGUMENT_SPEC = dict(
+    name=dict(required=True),
+    sv_directory=dict(type='list', default=['/etc/sv']),
+    service_directory=dict(type='list', default=['/service', '/etc/service']),
+    service_shards=dict(type='list'),
+    shard=dict(type='int'),
+    init_d_directory=dict(type='list', default=['/etc/init.d']),
+    runscript=dict(required=True),
+    limits=dict(type='dict'),
+    cpu_affinity=dict(type='list'),
+    nice=dict(type='int'),
+    ionice_class=dict(choices=sorted(IONICE_CLASSES)),
+    ionice_level=dict(type='int'),
+    cpu_max=dict(),
+    memory_max=dict(),
+    io_weight=dict(type='int'),
+    pids_max=dict(),
+    cgroup_root=dict(default='/sys/fs/cgroup/runit'),
+    requires=dict(type='list'),
+    requires_max_delay=dict(default=5),
+    log_runscript=dict(),
+    log=dict(type='dict'),
+    supervise_link=dict(),
+    log_supervise_link=dict(),
+    supervise_tmpfs_root=dict(),
+    tmpfiles_directory=dict(default='/etc/tmpfiles.d'),
+    state=dict(choices=['present', 'absent', 'down'], default='present'),
+    extra_files=dict(type='dict', default={}),
+    extra_scripts=dict(type='dict', default={}),
+    extra_file_actions=dict(type='dict'),
+    apply_action=dict(type='bool', default=False),
+    envdir=dict(type='dict'),
+    control=dict(type='dict'),
+    restart_backoff=dict(type='dict'),
+    lsb_service=dict(choices=['present', 'absent']),
+    instances=dict(),
+    instance_env_var=dict(default='RUNIT_INSTANCE'),
+    umask=dict(type='int', default=0o022),
+    lock_timeout=dict(type='int', default=60),
+    state_directory=dict(),
+    restart_concurrency=dict(type='int'),
+    restart_jitter=dict(default=0),
+    stop_timeout=dict(type='int', default=7),
+    restart_timeout=dict(type='int', default=7),
+    remove_sv_directory=dict(type='bool', default=False),
+    verify=dict(choices=['manifest', 'full'], default='manifest'),
+    only_paths=dict(type='list'),
+)
+
+
+class SpecError(Exception):
+    pass
+
+
+BOOLEANS_TRUE = ['yes', 'on', '1', 'true', 1]
+BOOLEANS_FALSE = ['no', 'off', '0', 'false', 0]
+
+
+def convert_spec_value(name, option, value):
+    """
+    Check and convert one spec value the way AnsibleModule would for the
+    option's type and choices, raising SpecError if it can't be.
+    """
+    if value is None:
+        return None
+    wanted = option.get('type')
+    is_string = isinstance(value, (text_type, bytes))
+    if wanted == 'list':
+        if is_string:
+            value = value.split(',')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = [str(value)]
+        elif not isinstance(value, list):
+            raise SpecError('%s must be a list' % (name,))
+    elif wanted == 'dict':
+        if not isinstance(value, dict):
+            raise SpecError('%s must be a dict' % (name,))
+    elif wanted == 'bool':
+        if not isinstance(value, bool):
+            if is_string:
+                value = value.lower()
+            if value in BOOLEANS_TRUE:
+                value = True
+            elif value in BOOLEANS_FALSE:
+                value = False
+            else:
+                raise SpecError('%s must be a boolean' % (name,))
+    elif wanted == 'int':
+        if isinstance(value, bool) or not isinstance(
+                value, (int, text_type, bytes)):
+            raise SpecError('%s must be an integer' % (name,))
+        try:
+            value = int(value)
+        except ValueError:
+            raise SpecError('%s must be an integer' % (name,))
+    choices = option.get('choices')
+    if choices is not None and value not in choices:
+        raise SpecError('value of %s must be one of: %s, got: %s' % (
+            name, ', '.join(choices), value))
+    return value
+
+
+class SpecModule(object):
+    """
+    Stands in for an AnsibleModule when planning a service from a spec given
+    outside of a runit_sv task: a dict of the same parameters runit_sv takes.
+    """
+
+    def __init__(self, spec, check_mode=True):
+        missing = [name for name, option in ARGUMENT_SPEC.items()
+                   if option.get('required') and name not in spec]
+        if missing:
+            raise SpecError('missing required arguments: %s' % (
+                ', '.join(sorted(missing)),))
+        unknown = set(spec) - set(ARGUMENT_SPEC)
+        if unknown:
+            raise SpecError('unsupported parameters: %s' % (
+                ', '.join(sorted(unknown)),))
+        self.params = dict(
+            (name, convert_spec_value(name, option, spec[name])
+             if name in spec else option.get('default'))
+            for name, option in ARGUMENT_SPEC.items())
+        self.check_mode = check_mode
+
+    def __repr__(self):
+        return '<%s %#x: %r>' % (
+            type(self).__name__, id(self), self.params['name'])
+
+    def fail_json(self, msg, **result):
+        raise SpecError(msg)
+
+
+def main(module_cls):
+    module = module_cls(argument_spec=ARGUMENT_SPEC, supports_check_mode=True)
+
+    try:
+        _main(module)
+    except Exception:
+        module.fail_json(
+            msg='unhandled exception', traceback=traceback.format_exc())
+
+
+def service_names(module, sv_directory, service_directory):
+    """
+    Return the names of the services a runit_sv invocation manages, and of
+    the surplus instances it removes.
+    """
+    name = module.params['name']
+    try:
+        instances = parse_instances(module.params['instances'])
+    except ValueError:
+        module.fail_json(
+            msg='invalid instances: %r' % (module.params['instances'],))
+    if instances is None:
+        return [name], []
+    for param in ['supervise_link', 'log_supervise_link']:
+        if module.params[param] is not None:
+            module.fail_json(msg="%s can't be used with instances" % (param,))
+    names = [instance_name(name, index) for index in range(1, instances + 1)]
+    surplus_names = find_surplus_instances(
+        name, instances, instance_list(module, sv_directory).load(),
+        [sv_directory] + service_link_directories(module, service_directory))
+    return names, surplus_names
+
+
+def state_directory_for(module, sv_directory):
+    state_directory = module.params['state_directory']
+    if state_directory is None:
+        state_directory = os.path.join(sv_directory, '.runit_sv')
+    return state_directory
+
+
+def instance_list(module, sv_directory):
+    return InstanceList(os.path.join(
+        state_directory_for(module, sv_directory), 'instances',
+        module.params['name'] + '.json'))
+
+
+def path_within(path, directories):
+    """
+    Return whether a path is one of the directories, or anywhere under one.
+    """
+    for directory in directories:
+        directory = directory.rstrip(os.sep) or os.sep
+        if path == directory or path.startswith(directory + os.sep) or (
+                directory == os.sep):
+            return True
+    return False
+
+
+def plan_services(module, names, surplus_names, sv_directory,
+                  service_directory, init_d_directory):
+    instanced = module.params['instances'] is not None
+    outfiles = []
+    directories = []
+    for index, name in enumerate(names, start=1):
+        service_outfiles, service_directories = plan_service(
+            module, name, sv_directory, service_directory, init_d_directory,
+            instance=index if instanced else None)
+        outfiles.extend(service_outfiles)
+        directories.extend(service_directories)
+    for name in surplus_names:
+        outfiles.extend(plan_removed_service(
+            name, sv_directory,
+            service_link_directories(module, service_directory),
+            init_d_directory, module.params['supervise_tmpfs_root'],
+            module.params['tmpfiles_directory']))
+    return outfiles, directories
+
+
+def _main(module):
+    def first_directory_or_fail(name):
+        directories = module.params[name]
+        ret = first_directory(directories)
+        if ret is None:
+            module.fail_json(
+                msg='no extant directory found for %r out of %r' % (
+                    name, directories))
+        return ret
+
+    sv_directory = first_directory_or_fail('sv_directory')
+    service_directory = first_directory_or_fail('service_directory')
+    shards = module.params['service_shards']
+    if module.params['shard'] is not None:
+        if not shards:
+            module.fail_json(msg='shard requires service_shards')
+        try:
+            choose_shard(module.params['name'], shards, module.params['shard'])
+        except InvalidOptionsError as e:
+            module.fail_json(msg=str(e))
+    for shard in shards or []:
+        if not os.path.isdir(shard):
+            module.fail_json(msg='service shard %r does not exist' % (shard,))
+    names, surplus_names = service_names(
+        module, sv_directory, service_directory)
+
+    # Planning and committing must not interleave with another runit_sv
+    # touching the same service. The service directory is only locked shared,
+    # so that work spanning every service can exclude all of us at once.
+    locks = DirectoryLocks(module.params['lock_timeout'])
+    removing = (module.params['state'] == 'absent'
+                and module.params['remove_sv_directory'])
+    try:
+        for to_lock in sorted(
+                service_link_directories(module, service_directory)):
+            locks.acquire(to_lock, fcntl.LOCK_SH)
+        for to_lock in sorted(names + surplus_names):
+            locks.acquire(
+                os.path.join(sv_directory, to_lock), fcntl.LOCK_EX,
+                create=(not module.check_mode and not removing
+                        and to_lock in names))
+    except LockTimeoutError as e:
+        locks.release()
+        module.fail_json(
+            msg='timed out waiting for lock on %r' % (e.args[0],),
+            lock_wait=locks.waited)
+    try:
+        _main_locked(
+            module, locks, sv_directory, service_directory, names,
+            surplus_names)
+    finally:
+        locks.release()
+
+
+def _main_locked(module, locks, sv_directory, service_directory, names,
+                 surplus_names):
+    init_d_directory = first_directory(module.params['init_d_directory'])
+    state_directory = state_directory_for(module, sv_directory)
+    result = dict(lock_wait=locks.waited, queue_wait=0.0)
+    if module.params['instances'] is not None:
+        result['instances'] = names
+    if module.params['service_shards'] and module.params['state'] != 'absent':
+        result['shards'] = dict(
+            (name, choose_shard(
+                name, module.params['service_shards'], module.params['shard']))
+            for name in names)
+    instances = None
+    if module.params['instances'] is not None:
+        instances = instance_list(module, sv_directory)
+    removing = (module.params['state'] == 'absent'
+                and module.params['remove_sv_directory'])
+    to_stop = list(surplus_names)
+    if module.params['state'] == 'absent':
+        to_stop[:0] = names
+    running = {}
+    for name in to_stop:
+        supervise = os.path.join(sv_directory, name, 'supervise')
+        if supervisor_running(supervise):
+            running[name] = supervise
+
+    # Nearly every run finds nothing to do. If the last successful run left a
+    # manifest which still matches, that's known from a stat of each managed
+    # path, without reading any of them.
+    manifest = Manifest(
+        os.path.join(
+            state_directory, 'manifests', module.params['name'] + '.json'),
+        params_digest(
+            module, names,
+            [sv_directory, init_d_directory]
+            + service_link_directories(module, service_directory)))
+    # Checking only some paths can neither trust nor write a manifest
+    # covering all of them.
+    only_paths = module.params['only_paths']
+    if module.params['verify'] == 'full' or only_paths is not None:
+        result['manifest'] = 'skipped'
+    else:
+        paths = None if surplus_names or running else manifest.load()
+        if paths is not None:
+            module.exit_json(
+                changed=False, paths=dict.fromkeys(paths, False),
+                changes={}, required_action=dict(service='none', log='none'),
+                manifest='hit', **result)
+        result['manifest'] = 'miss'
+
+    outfiles, directories = plan_services(
+        module, names, surplus_names, sv_directory, service_directory,
+        init_d_directory)
+    if only_paths is not None:
+        outfiles = [outfile for outfile in outfiles
+                    if path_within(outfile.path, only_paths)]
 
     for outfile in outfiles:
-        outfile.commit()
+        outfile.check_if_must_change()
+    result['paths'] = {
+        outfile.path: outfile.must_change for outfile in outfiles}
+    result['changes'] = {
+        outfile.path: outfile.describe_change()
+        for outfile in outfiles if outfile.must_change}
+    required = required_actions(outfiles)
+    result['required_action'] = dict(service='none', log='none')
+    for actions in required.values():
+        for target, action in actions.items():
+            if ACTIONS.index(action) > ACTIONS.index(
+                    result['required_action'][target]):
+                result['required_action'][target] = action
+    if module.check_mode:
+        module.exit_json(changed=bool(running) or any(
+            outfile.must_change for outfile in outfiles), **result)
+
+    must_change = any(outfile.must_change for outfile in outfiles)
+    if not running and not must_change:
+        if instances is not None:
+            record_instances(
+                module, instances, [] if removing else names, result)
+        if only_paths is None:
+            save_manifest(manifest, outfiles, directories)
+        module.exit_json(changed=False, **result)
+
+    # Instances are recorded before they're created, so that a run which
+    # fails partway through still leaves them to be removed once surplus.
+    if instances is not None:
+        record_instances(module, instances, names + surplus_names, result)
+
+    # Restarting a service to pick up the changes is when it's unavailable,
+    # so bound how many services on this host can be in that window at once,
+    # across every concurrent invocation sharing the same state directory.
+    # The slot is held until the restarts are seen to finish.
+    semaphore = None
+    restart_concurrency = module.params['restart_concurrency']
+    if restart_concurrency is not None:
+        if restart_concurrency < 1:
+            module.fail_json(msg='restart_concurrency must be at least 1')
+        if not module.params['apply_action']:
+            module.fail_json(
+                msg='restart_concurrency requires apply_action, as nothing '
+                'is restarted without it')
+        semaphore = Semaphore(
+            os.path.join(state_directory, 'restart-slots'),
+            restart_concurrency)
+        queue_start = time.time()
+        jitter = float(module.params['restart_jitter'])
+        if jitter > 0:
+            time.sleep(random.uniform(0, jitter))
+        try:
+            semaphore.acquire(module.params['lock_timeout'])
+        except LockTimeoutError:
+            result['queue_wait'] = time.time() - queue_start
+            module.fail_json(
+                msg='timed out waiting for one of %d restart slots' % (
+                    semaphore.count,), **result)
+        result['queue_wait'] = time.time() - queue_start
+
+    try:
+        # Removing a service's link leaves runsvdir to tear it down whenever
+        # it next rescans; stop it first, so that it's gone by the time this
+        # returns. runsvdir respawns an exited runsv whose link is still
+        # there, so the link has to go right after.
+        if running:
+            result['shutdown'], timed_out = stop_services(
+                running, module.params['stop_timeout'])
+            if timed_out:
+                module.fail_json(
+                    msg='timed out waiting for %s to stop' % (
+                        ', '.join(timed_out),), **result)
+        if must_change:
+            try:
+                manifest.discard()
+                commit_records(outfiles)
+            except RollbackFailedError as e:
+                result['resumed'] = resume_services(running)
+                module.fail_json(
+                    msg='failed to commit changes, and failed to roll back '
+                    '%r' % ([path for path, _ in e.args[0]],),
+                    traceback=e.args[1], **result)
+            except Exception:
+                result['resumed'] = resume_services(running)
+                module.fail_json(
+                    msg='failed to commit changes; all changes were rolled '
+                    'back', traceback=traceback.format_exc(), **result)
+        if module.params['apply_action']:
+            result['applied_action'], restarting = apply_actions(
+                required, sv_directory, module.params['state'])
+            result['restart_wait'], timed_out = wait_for_restarts(
+                restarting, module.params['restart_timeout'])
+            if timed_out:
+                module.fail_json(
+                    msg='timed out waiting for %s to restart' % (
+                        ', '.join(timed_out),), changed=True, **result)
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+    if instances is not None:
+        record_instances(
+            module, instances, [] if removing else names,
+            dict(result, changed=True))
+    if only_paths is None:
+        save_manifest(manifest, outfiles, directories)
+    module.exit_json(changed=True, **result)
+
+
+def record_instances(module, instances, names, result):
+    try:
+        if sorted(instances.load()) != sorted(names):
+            instances.save(names)
+    except (IOError, OSError):
+        module.fail_json(
+            msg='failed to record the instances of %r' % (
+                module.params['name'],),
+            traceback=traceback.format_exc(), **result)
+
+
+def save_manifest(manifest, records, directories):
+    # The manifest only ever saves work; failing to write one is no reason to
+    # fail a run, but a stale one mustn't be left behind.
+    try:
+        manifest.save(records, directories)
+    except (IOError, OSError):
+        try:
+            manifest.discard()
+        except OSError:
+            pass
+
+
+AUDIT_ARGUMENT_SPEC = dict(
+    services=dict(type='list', required=True),
+    sv_directory=ARGUMENT_SPEC['sv_directory'],
+    service_directory=ARGUMENT_SPEC['service_directory'],
+    service_shards=ARGUMENT_SPEC['service_shards'],
+    init_d_directory=ARGUMENT_SPEC['init_d_directory'],
+    workers=dict(type='int', default=8),
+)
+
+
+def classify_drift(record):
+    """
+    Sort a record which must change into the kind of drift it represents.
+    """
+    if record.reason in ('extra', 'stray'):
+        return 'extra'
+    elif record.reason == 'missing':
+        return 'missing'
+    return 'changed'
+
+
+def plan_spec(spec):
+    """
+    Plan one service spec without checking or changing anything. Returns the
+    names of the services planned, their records, and the directories whose
+    contents they manage.
+    """
+    module = SpecModule(spec)
+    sv_directory = first_directory(module.params['sv_directory'])
+    service_directory = first_directory(module.params['service_directory'])
+    if sv_directory is None or service_directory is None:
+        raise SpecError('no extant sv_directory or service_directory')
+    names, surplus_names = service_names(
+        module, sv_directory, service_directory)
+    records, directories = plan_services(
+        module, names, surplus_names, sv_directory, service_directory,
+        first_directory(module.params['init_d_directory']))
+    return names + surplus_names, records, directories
 
-    module.exit_json(paths=paths, changed=True)
+
+def audit_service(spec, directories):
+    """
+    Plan one declared service spec in check mode, and report how the host
+    has drifted from it, along with the names of the services planned.
+    """
+    spec = dict(spec)
+    for name, candidates in directories.items():
+        spec.setdefault(name, candidates)
+    names, records, _ = plan_spec(spec)
+    drift = {}
+    for record in records:
+        record.check_if_must_change()
+        if record.must_change:
+            drift.setdefault(classify_drift(record), []).append(record.path)
+    for paths in drift.values():
+        paths.sort()
+    return drift, names
+
+
+def audit(specs, sv_directory, service_directory, init_d_directory,
+          workers=8, service_shards=None):
+    """
+    Check every declared service spec against the host across a pool of
+    worker threads, without changing anything. The directories are lists of
+    candidates, like runit_sv's, and are the defaults for every spec, as are
+    the service shards. Returns the drift of each service which has any, the
+    errors planning any spec, and the services in the sv and service
+    directories, and in each shard, which no spec declares.
+    """
+    directories = dict(
+        sv_directory=sv_directory, service_directory=service_directory,
+        init_d_directory=init_d_directory)
+    if service_shards:
+        directories['service_shards'] = service_shards
+
+    def audit_one(spec):
+        try:
+            return audit_service(spec, directories) + (None,)
+        except SpecError as e:
+            return None, (), str(e)
+        except Exception:
+            return None, (), traceback.format_exc()
+
+    pool = multiprocessing.pool.ThreadPool(max(1, workers))
+    try:
+        results = pool.map(audit_one, specs)
+    finally:
+        pool.close()
+        pool.join()
+
+    drift = {}
+    errors = {}
+    declared = set()
+    for spec, (service_drift, names, error) in zip(specs, results):
+        name = spec.get('name')
+        declared.update(names)
+        if error is not None:
+            errors[name] = error
+        elif service_drift:
+            drift[name] = service_drift
+
+    extra = {}
+    for key in ['service_directory', 'sv_directory']:
+        undeclared = undeclared_services(
+            first_directory(directories[key]), declared)
+        if undeclared:
+            extra[key] = undeclared
+    for shard in service_shards or []:
+        undeclared = undeclared_services(shard, declared)
+        if undeclared:
+            extra.setdefault('service_shards', {})[shard] = undeclared
+    return drift, errors, extra
+
+
+def undeclared_services(directory, declared):
+    if directory is None:
+        return []
+    try:
+        entries = os.listdir(directory)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    return sorted(
+        entry for entry in entries
+        if not entry.startswith('.') and entry not in declared)
+
+
+# runit_sv and runit_sv_audit are this same file, and ansible may feed it to
+# python on stdin, so which module is running can only be told from the
+# arguments: only runit_sv_audit takes services. Until that's known, every
+# option of either is accepted, and none is required.
+DISPATCH_ARGUMENT_SPEC = dict(
+    (name, dict(
+        (key, value) for key, value in option.items() if key != 'required'))
+    for argument_spec in [ARGUMENT_SPEC, AUDIT_ARGUMENT_SPEC]
+    for name, option in argument_spec.items())
+
+
+def main_dispatch(module_cls):
+    module = module_cls(
+        argument_spec=DISPATCH_ARGUMENT_SPEC, supports_check_mode=True)
+    if module.params.get('services') is None:
+        argument_spec, entry = ARGUMENT_SPEC, _main
+    else:
+        argument_spec, entry = AUDIT_ARGUMENT_SPEC, _main_audit
+    missing = sorted(
+        name for name, option in argument_spec.items()
+        if option.get('required') and module.params.get(name) is None)
+    if missing:
+        module.fail_json(
+            msg='missing required arguments: %s' % (', '.join(missing),))
+    unsupported = sorted(
+        name for name, option in DISPATCH_ARGUMENT_SPEC.items()
+        if name not in argument_spec
+        and module.params.get(name) != option.get('default'))
+    if unsupported:
+        module.fail_json(
+            msg='unsupported parameters: %s' % (', '.join(unsupported),))
+    module.params = dict(
+        (name, module.params.get(name)) for name in argument_spec)
+
+    try:
+        entry(module)
+    except Exception:
+        module.fail_json(
+            msg='unhandled exception', traceback=traceback.format_exc())
+
+
+def _main_audit(module):
+    for name in ['sv_directory', 'service_directory']:
+        if first_directory(module.params[name]) is None:
+            module.fail_json(
+                msg='no extant directory found for %r out of %r' % (
+                    name, module.params[name]))
+    drift, errors, extra = audit(
+        module.params['services'], module.params['sv_directory'],
+        module.params['service_directory'],
+        module.params['init_d_directory'], workers=module.params['workers'],
+        service_shards=module.params['service_shards'])
+    result = dict(
+        changed=False, drift=drift, errors=errors, extra_services=extra,
+        drifted=bool(drift or extra))
+    if errors:
+        module.fail_json(
+            msg='failed to audit %s' % (', '.join(sorted(errors)),),
+            **result)
+    module.exit_json(**result)
+
+
+class SpecExit(BaseException):
+    """
+    Ends planning or applying a spec the way exit_json or fail_json would.
+    It isn't an Exception, so the module's own error handling can't catch it.
+    """
+
+    def __init__(self, failed, result):
+        super(SpecExit, self).__init__(failed, result)
+        self.failed = failed
+        self.result = result
+
+
+class CliModule(SpecModule):
+    """
+    A SpecModule which runit_sv itself can run, for the runit-sv command.
+    """
+
+    def exit_json(self, **result):
+        raise SpecExit(False, result)
+
+    def fail_json(self, msg, **result):
+        result['msg'] = msg
+        raise SpecExit(True, result)
+
+
+def run_spec(spec, check_mode):
+    """
+    Plan, and unless in check mode apply, one service spec. Returns whether
+    it failed, and the result runit_sv would have returned.
+    """
+    try:
+        module = CliModule(spec, check_mode=check_mode)
+        _main(module)
+    except SpecError as e:
+        return True, dict(msg=str(e))
+    except SpecExit as e:
+        return e.failed, e.result
+    except Exception:
+        return True, dict(
+            msg='unhandled exception', traceback=traceback.format_exc())
+    return True, dict(msg='runit_sv exited without a result')
+
+
+def load_specs(path):
+    """
+    Load the service specs from a JSON file, or standard input if the path is
+    '-'. The file holds either a list of specs, or an object whose services
+    key is the list of specs and whose other keys are defaults for every
+    spec.
+    """
+    if path == '-':
+        document = json.load(sys.stdin)
+    else:
+        with open(path) as infile:
+            document = json.load(infile)
+    if isinstance(document, list):
+        defaults, specs = {}, document
+    elif isinstance(document, dict) and isinstance(
+            document.get('services'), list):
+        defaults = dict(document)
+        specs = defaults.pop('services')
+    else:
+        raise SpecError(
+            'a spec file must hold a list of specs, or an object with a '
+            'list of specs as its services')
+    ret = []
+    seen = set()
+    for spec in specs:
+        if not isinstance(spec, dict):
+            raise SpecError('invalid spec: %r' % (spec,))
+        spec = dict(defaults, **spec)
+        name = spec.get('name')
+        if name in seen:
+            raise SpecError('service %r is declared twice' % (name,))
+        seen.add(name)
+        ret.append(spec)
+    return ret
+
+
+# The inotify(7) events which can mean a managed path has drifted. Writes are
+# only seen once the file is closed, so a file being written is checked once.
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+INOTIFY_EVENT = struct.Struct('iIII')
+POLL_INTERVAL = 5
+
+
+def _fs_path(name):
+    if isinstance(name, str):
+        return name
+    return name.decode(sys.getfilesystemencoding(), 'surrogateescape')
+
+
+class InotifyWatcher(object):
+    """
+    Reports the paths which changed in a set of watched directories, using
+    inotify through libc.
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(
+            os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0o2000000))
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.directories = {}
+
+    def __repr__(self):
+        return '<%s %#x: %d directories>' % (
+            type(self).__name__, id(self), len(self.directories))
+
+    def watch(self, directory):
+        wd = self._libc.inotify_add_watch(
+            self.fd, to_bytes(directory), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(e, os.strerror(e), directory)
+        self.directories[wd] = directory
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds for changes, and return the set of paths
+        changed.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        touched = set()
+        while readable:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped; anything could have changed.
+                    touched.update(self.directories.values())
+                    continue
+                directory = self.directories.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.directories[wd]
+                elif name:
+                    touched.add(os.path.join(directory, _fs_path(name)))
+                else:
+                    touched.add(directory)
+        return touched
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollWatcher(object):
+    """
+    Reports the paths which changed in a set of watched directories by
+    comparing the stats of their entries every interval, for where inotify
+    isn't available.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.snapshots = {}
+
+    def __repr__(self):
+        return '<%s %#x: %d directories>' % (
+            type(self).__name__, id(self), len(self.snapshots))
+
+    def _snapshot(self, directory):
+        try:
+            names = os.listdir(directory)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return None
+        return dict(
+            (name, stat_signature(
+                os.path.join(directory, name), contents=False))
+            for name in names)
+
+    def watch(self, directory):
+        if directory not in self.snapshots:
+            self.snapshots[directory] = self._snapshot(directory)
+
+    def wait(self, timeout=None):
+        time.sleep(self.interval if timeout is None else min(
+            timeout, self.interval))
+        touched = set()
+        for directory, before in list(self.snapshots.items()):
+            after = self.snapshots[directory] = self._snapshot(directory)
+            if before is None or after is None:
+                if before != after:
+                    touched.add(directory)
+                continue
+            for name in set(before) | set(after):
+                if before.get(name) != after.get(name):
+                    touched.add(os.path.join(directory, name))
+        return touched
+
+    def close(self):
+        pass
+
+
+def make_watcher(poll_interval=None):
+    """
+    Return an InotifyWatcher, or a PollWatcher if a poll interval is given or
+    inotify isn't available.
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher()
+        except (AttributeError, OSError):
+            poll_interval = POLL_INTERVAL
+    return PollWatcher(poll_interval)
+
+
+class Reconciler(object):
+    """
+    Keeps services converged to their specs between runs of runit_sv. Only
+    the records under paths a watcher saw change are checked, and drifted
+    ones are repaired by the same code runit_sv itself uses. A metrics line
+    is written for every repair.
+    """
+
+    def __init__(self, specs, watcher, debounce=0.5, output=None):
+        self.specs = specs
+        self.watcher = watcher
+        self.debounce = debounce
+        self.output = sys.stdout if output is None else output
+        self.plans = {}
+        for spec in specs:
+            self.index(spec)
+
+    def __repr__(self):
+        return '<%s %#x: %d specs>' % (
+            type(self).__name__, id(self), len(self.specs))
+
+    def index(self, spec):
+        """
+        Plan a spec to learn which paths it manages, and watch every
+        directory they're in.
+        """
+        _, records, directories = plan_spec(spec)
+        paths = frozenset(record.path for record in records)
+        directories = frozenset(directories)
+        self.plans[spec['name']] = paths, directories
+        for directory in directories.union(
+                os.path.dirname(path) for path in paths):
+            self.watcher.watch(directory)
+
+    def relevant_paths(self, spec, touched):
+        paths, directories = self.plans[spec['name']]
+        return sorted(
+            path for path in touched
+            if path in paths or os.path.dirname(path) in directories
+            or any(path_within(managed, [path]) for managed in paths))
+
+    def wait(self, timeout=None):
+        """
+        Wait for a change, then until changes have settled for the debounce
+        interval, and return every path changed.
+        """
+        touched = self.watcher.wait(timeout)
+        if touched:
+            # Don't wait forever on a directory which never stops changing.
+            deadline = time.time() + max(1, self.debounce * 10)
+            while time.time() < deadline:
+                changed = self.watcher.wait(self.debounce)
+                if not changed:
+                    break
+                touched.update(changed)
+        return touched
+
+    def repair(self, touched):
+        """
+        Check and repair the records of every spec under the touched paths.
+        Returns the names of the specs repaired, or which failed to be.
+        """
+        repaired = []
+        for spec in self.specs:
+            relevant = self.relevant_paths(spec, touched)
+            if not relevant:
+                continue
+            start = time.time()
+            failed, result = run_spec(
+                dict(spec, only_paths=relevant), check_mode=False)
+            duration = time.time() - start
+            try:
+                self.index(spec)
+            except SpecError:
+                pass
+            if failed or result.get('changed'):
+                self.report(spec['name'], failed, result, duration)
+                repaired.append(spec['name'])
+        return repaired
+
+    def report(self, name, failed, result, duration):
+        changes = result.get('changes', {})
+        required = result.get('required_action', {})
+        fields = [
+            ('service', name),
+            ('failed', int(failed)),
+            ('paths', len(changes)),
+            ('reasons', ','.join(sorted(set(
+                change['reason'] for change in changes.values()))) or '-'),
+            ('service_action', required.get('service', 'none')),
+            ('log_action', required.get('log', 'none')),
+            ('duration_seconds', '%.6f' % (duration,)),
+        ]
+        if failed:
+            fields.append(('msg', json.dumps(result.get('msg', ''))))
+        self.output.write('runit_sv_repair %s\n' % (
+            ' '.join('%s=%s' % field for field in fields),))
+        self.output.flush()
+
+    def run(self, stop=None):
+        """
+        Repair drift until stop, if given, returns true.
+        """
+        while stop is None or not stop():
+            touched = self.wait(None if stop is None else self.debounce)
+            if touched:
+                self.repair(touched)
+
+
+CLI_COMMANDS = {
+    'apply': 'converge every service to its spec',
+    'plan': 'show what apply would change, without changing anything',
+    'check': 'exit with status 1 if apply would change anything',
+    'watch': 'repair drift as soon as it happens, until interrupted',
+}
+
+
+def main_cli(argv=None):
+    """
+    The runit-sv command: runs runit_sv over every spec in a file without
+    ansible, and prints the results as JSON. Exits with status 2 if any spec
+    failed.
+    """
+    parser = argparse.ArgumentParser(
+        prog='runit-sv',
+        description='Apply runit_sv service specs without ansible.')
+    subparsers = parser.add_subparsers(dest='command')
+    for command, help_text in sorted(CLI_COMMANDS.items()):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument(
+            'spec', help="a JSON file of service specs, or '-' for stdin")
+        if command == 'watch':
+            subparser.add_argument(
+                '--debounce', type=float, default=0.5,
+                help='seconds for changes to settle before repairing them')
+            subparser.add_argument(
+                '--poll-interval', type=float,
+                help='poll for changes this often instead of using inotify')
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error('a command is required')
+
+    try:
+        specs = load_specs(args.spec)
+    except (IOError, OSError, ValueError, SpecError) as e:
+        parser.exit(2, 'runit-sv: %s\n' % (e,))
+    if args.command == 'watch':
+        return watch(parser, specs, args.debounce, args.poll_interval)
+    check_mode = args.command != 'apply'
+    services = {}
+    failed = []
+    for spec in specs:
+        service_failed, result = run_spec(spec, check_mode)
+        name = spec.get('name')
+        services[name] = result
+        if service_failed:
+            failed.append(name)
+    changed = sorted(
+        name for name, result in services.items() if result.get('changed'))
+    if args.command == 'check':
+        output = dict(changed=changed, failed=dict(
+            (name, services[name]['msg']) for name in failed))
+    else:
+        output = dict(
+            changed=bool(changed), failed=sorted(failed), services=services)
+    json.dump(output, sys.stdout, sort_keys=True, indent=2)
+    sys.stdout.write('\n')
+    if failed:
+        return 2
+    elif args.command == 'check' and changed:
+        return 1
+    return 0
+
+
+def watch(parser, specs, debounce, poll_interval):
+    # Drift from before the watch began is left for the next apply; starting
+    # to watch shouldn't restart anything.
+    watcher = make_watcher(poll_interval)
+    try:
+        reconciler = Reconciler(specs, watcher, debounce=debounce)
+    except SpecError as e:
+        watcher.close()
+        parser.exit(2, 'runit-sv: %s\n' % (e,))
+    try:
+        reconciler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
 
 
 # This is some gross-ass ansible magic. Unfortunately noqa can't be applied for
 # E265, so it had to be disabled in setup.cfg.
 #<<INCLUDE_ANSIBLE_MODULE_COMMON>>
 if __name__ == '__main__':  # pragma: nocover
-    main(AnsibleModule)  # noqa
+    # bin/runit-sv is a symlink to this file, run directly; ansible runs it
+    # as either module, possibly from stdin.
+    if os.path.basename(sys.argv[0]) == 'runit-sv':
+        sys.exit(main_cli())
+    else:
+        main_dispatch(AnsibleModule)  # noqa
@@ -0,0 +1,12 @@
+# Copyright (c) weykent <weykent@weasyl.com>
+# See COPYING for details.
+
+import pytest
+
+
+@pytest.fixture
+def basedir(tmpdir):
+    tmpdir.join('sv').mkdir()
+    tmpdir.join('service').mkdir()
+    tmpdir.join('init.d').mkdir()
+    return tmpdir
@@ -1,6 +1,13 @@
 # Copyright (c) weykent <weykent@weasyl.com>
 # See COPYING for details.
 
+import errno
+import fcntl
+import os
+import subprocess
+import threading
+import time
+
 import pytest
 
 import runit_sv as _runit_sv_module
@@ -14,7 +21,12 @@ def pytest_generate_tests(metafunc):
     if 'idempotency_state' not in metafunc.fixturenames:
         return
     states = ['regular']
-    if getattr(metafunc.function, 'idempotent', False):
+    definition = getattr(metafunc, 'definition', None)
+    if definition is not None:
+        idempotent = definition.get_closest_marker('idempotent')
+    else:
+        idempotent = getattr(metafunc.function, 'idempotent', False)
+    if idempotent:
         states.append('checked')
     metafunc.parametrize(('idempotency_state'), states)
 
@@ -41,7 +53,7 @@ class FakeAnsibleModule(object):
 
     def __call__(self, argument_spec, supports_check_mode):
         self.argument_spec = argument_spec
-        for name, spec in self.argument_spec.iteritems():
+        for name, spec in self.argument_spec.items():
             if name not in self.params:
                 self.params[name] = spec.get('default')
         return self
@@ -74,7 +86,9 @@ def setup_change_checker(params):
 @pytest.fixture(params=['real', 'fake'])
 def runit_sv(request, idempotency_state):
     if request.param == 'real':
-        ansible_module = request.getfuncargvalue('ansible_module')
+        getfixturevalue = getattr(
+            request, 'getfixturevalue', None) or request.getfuncargvalue
+        ansible_module = getfixturevalue('ansible_module')
 
         def do(**params):
             should_fail = params.pop('_should_fail', False)
@@ -89,6 +103,7 @@ def runit_sv(request, idempotency_state):
                 assert_no_local_failure(contacted)
             if check_change is not None:
                 check_change(contacted['local']['changed'])
+            return contacted['local']
 
     elif request.param == 'fake':
         def do(**params):
@@ -101,6 +116,7 @@ def runit_sv(request, idempotency_state):
             assert excinfo.value.success != should_fail
             if check_change is not None:
                 check_change(excinfo.value.params['changed'])
+            return excinfo.value.params
 
     else:
         raise ValueError('unknown param', request.param)
@@ -110,19 +126,11 @@ def runit_sv(request, idempotency_state):
 
         def do(**params):
             _do(_must_change=True, **params)
-            _do(_must_not_change=True, **params)
+            return _do(_must_not_change=True, **params)
 
     return do
 
 
-@pytest.fixture
-def basedir(tmpdir):
-    tmpdir.join('sv').mkdir()
-    tmpdir.join('service').mkdir()
-    tmpdir.join('init.d').mkdir()
-    return tmpdir
-
-
 def base_directories(basedir, **overrides):
     ret = {'sv_directory': [basedir.join('sv').strpath],
            'service_directory': [basedir.join('service').strpath],
@@ -172,6 +180,474 @@ def test_log_runscript(runit_sv, basedir):
     assert_file(sv_log.join('run'), contents='eggs spam', mode=0o755)
 
 
+@idempotent
+def test_limits(runit_sv, basedir):
+    """
+    The limits option makes run a wrapper which execs the runscript, moved to
+    run.service, through chpst with the requested resource limits.
+    """
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        limits=dict(memory='512M', open_files=1024, processes='64', core=0),
+        **base_directories(basedir))
+    sv = basedir.join('sv', 'testsv')
+    assert sorted(p.basename for p in sv.listdir()) == ['run', 'run.service']
+    assert_file(
+        sv.join('run'),
+        contents=('#!/bin/sh\nexec chpst -m 536870912 -o 1024 -p 64 -c 0 '
+                  './run.service\n'),
+        mode=0o755)
+    assert_file(sv.join('run.service'), contents='spam eggs', mode=0o755)
+
+
+def test_limits_removed(runit_sv, basedir):
+    """
+    Dropping the limits option puts the runscript back in run and removes the
+    wrapped copy.
+    """
+    kwargs = base_directories(basedir)
+    runit_sv(
+        name='testsv', runscript='spam eggs', limits=dict(open_files=8),
+        **kwargs)
+    runit_sv(_must_change=True, name='testsv', runscript='spam eggs', **kwargs)
+    sv = basedir.join('sv', 'testsv')
+    assert [p.basename for p in sv.listdir()] == ['run']
+    assert_file(sv.join('run'), contents='spam eggs', mode=0o755)
+
+
+@pytest.mark.parametrize('limits', [
+    {'spam': 1},
+    {'memory': 'eggs'},
+    {'open_files': -1},
+])
+def test_invalid_limits(runit_sv, basedir, limits):
+    """
+    Unknown or invalid limits make the module fail.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        limits=limits,
+        **base_directories(basedir))
+
+
+@idempotent
+def test_scheduling(runit_sv, basedir):
+    """
+    The cpu_affinity, nice and ionice options are applied by the run wrapper
+    with taskset, nice and ionice, ahead of any chpst limits.
+    """
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        cpu_affinity=['0-3', 8],
+        nice=5,
+        ionice_class='best-effort',
+        ionice_level=6,
+        limits=dict(open_files=64),
+        **base_directories(basedir))
+    sv = basedir.join('sv', 'testsv')
+    assert_file(
+        sv.join('run'),
+        contents=('#!/bin/sh\nexec taskset -c 0-3,8 nice -n 5 '
+                  'ionice -c 2 -n 6 chpst -o 64 ./run.service\n'),
+        mode=0o755)
+    assert_file(sv.join('run.service'), contents='spam eggs', mode=0o755)
+
+
+@pytest.mark.parametrize(('params', 'expected'), [
+    (dict(ionice_class='idle'), 'ionice -c 3'),
+    (dict(ionice_level=0), 'ionice -c 2 -n 0'),
+    (dict(nice=-20), 'nice -n -20'),
+])
+def test_scheduling_single_option(runit_sv, basedir, params, expected):
+    """
+    Each scheduling option can be used on its own.
+    """
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        **dict(base_directories(basedir), **params))
+    assert basedir.join('sv', 'testsv', 'run').read() == (
+        '#!/bin/sh\nexec %s ./run.service\n' % (expected,))
+
+
+@pytest.mark.parametrize('params', [
+    dict(cpu_affinity=['spam']),
+    dict(cpu_affinity=[]),
+    dict(nice=20),
+    dict(ionice_level=8),
+    dict(ionice_class='idle', ionice_level=4),
+])
+def test_invalid_scheduling(runit_sv, basedir, params):
+    """
+    Invalid scheduling options make the module fail.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        **dict(base_directories(basedir), **params))
+
+
+def make_dependency(basedir, name, up, check=None):
+    dependency = basedir.join('sv', name)
+    set_dependency_up(dependency, up)
+    if check is not None:
+        dependency.join('check').write('#!/bin/sh\n' + check)
+        dependency.join('check').chmod(0o755)
+    return dependency
+
+
+def set_dependency_up(dependency, up):
+    dependency.ensure('supervise', dir=True).join('status').write_binary(
+        _runit_sv_module.SUPERVISE_STATUS.pack(
+            b'\0' * 12, 1234 if up else 0, 0, b'u', 0, 1 if up else 0))
+
+
+def run_wrapped(sv, timeout=10):
+    process = subprocess.Popen(
+        ['sh', 'run'], cwd=sv.strpath, stdout=subprocess.PIPE)
+    deadline = time.time() + timeout
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.01)
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+        return None
+    return process.stdout.read().decode()
+
+
+@idempotent
+def test_requires(runit_sv, basedir):
+    """
+    With requires, the run wrapper waits for every dependency to be up and
+    pass its check script before running the service.
+    """
+    make_dependency(basedir, 'db', up=True, check='exit 0')
+    make_dependency(basedir, 'proxy', up=True)
+    runit_sv(
+        name='testsv',
+        runscript='#!/bin/sh\necho started\n',
+        requires=['db', 'proxy'],
+        **base_directories(basedir))
+    sv = basedir.join('sv', 'testsv')
+    run = sv.join('run').read()
+    assert run.startswith('#!/bin/sh\n')
+    assert 'for dependency in %s %s; do' % (
+        basedir.join('sv', 'db').strpath,
+        basedir.join('sv', 'proxy').strpath) in run
+    assert run.endswith('exec ./run.service\n')
+    assert_file(
+        sv.join('run.service'), contents='#!/bin/sh\necho started\n',
+        mode=0o755)
+    assert run_wrapped(sv) == 'started\n'
+
+
+@pytest.mark.parametrize(('up', 'check'), [
+    (False, None),
+    (True, 'exit 1'),
+])
+def test_requires_blocks_until_ready(basedir, up, check):
+    """
+    The run wrapper doesn't start the service while a dependency is down or
+    failing its check, and starts it once the dependency is ready.
+    """
+    dependency = make_dependency(basedir, 'db', up=up, check=check)
+    module = FakeAnsibleModule(dict(
+        name='testsv', runscript='#!/bin/sh\necho started\n',
+        requires=['db'], requires_max_delay=0.2,
+        **base_directories(basedir)), False)
+    with pytest.raises(FakeAnsibleModuleBailout):
+        _runit_sv_module.main(module)
+    sv = basedir.join('sv', 'testsv')
+    assert run_wrapped(sv, timeout=0.5) is None
+    process = subprocess.Popen(
+        ['sh', 'run'], cwd=sv.strpath, stdout=subprocess.PIPE)
+    time.sleep(0.3)
+    assert process.poll() is None
+    set_dependency_up(dependency, True)
+    dependency.join('check').write('#!/bin/sh\nexit 0')
+    dependency.join('check').chmod(0o755)
+    assert process.stdout.read().decode() == 'started\n'
+    assert process.wait() == 0
+
+
+@idempotent
+def test_cgroup_limits(runit_sv, basedir):
+    """
+    The cgroup options make the run wrapper create a cgroup for the service
+    under cgroup_root, write its limits, and move itself into it before
+    running the service.
+    """
+    cgroup_root = basedir.join('cgroup')
+    runit_sv(
+        name='testsv',
+        runscript='#!/bin/sh\necho "$$"\n',
+        cpu_max=1.5,
+        memory_max='512M',
+        io_weight=200,
+        pids_max=64,
+        cgroup_root=cgroup_root.strpath,
+        **base_directories(basedir))
+    output = run_wrapped(basedir.join('sv', 'testsv'))
+    cgroup = cgroup_root.join('testsv')
+    assert cgroup_root.join('cgroup.subtree_control').read() == (
+        '+cpu +memory +io +pids\n')
+    assert cgroup.join('cpu.max').read() == '150000 100000\n'
+    assert cgroup.join('memory.max').read() == '536870912\n'
+    assert cgroup.join('io.weight').read() == 'default 200\n'
+    assert cgroup.join('pids.max').read() == '64\n'
+    assert cgroup.join('cgroup.procs').read() == output
+
+
+def test_cgroup_limits_unapplied(runit_sv, basedir):
+    """
+    If the cgroup can't be set up, the service isn't run at all.
+    """
+    cgroup_root = basedir.join('cgroup')
+    cgroup_root.write('')
+    runit_sv(
+        name='testsv',
+        runscript='#!/bin/sh\necho ran\n',
+        memory_max='max',
+        cgroup_root=cgroup_root.strpath,
+        **base_directories(basedir))
+    process = subprocess.Popen(
+        ['sh', 'run'], cwd=basedir.join('sv', 'testsv').strpath,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    assert process.returncode == 111 and not stdout
+
+
+@pytest.mark.parametrize('params', [
+    dict(cpu_max=0),
+    dict(cpu_max='spam'),
+    dict(memory_max='-1'),
+    dict(io_weight=0),
+    dict(io_weight=10001),
+    dict(pids_max=0),
+])
+def test_invalid_cgroup_limits(runit_sv, basedir, params):
+    """
+    Invalid cgroup limits make the module fail.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        cgroup_root=basedir.join('cgroup').strpath,
+        **dict(base_directories(basedir), **params))
+
+
+def run_finish(sv, want, *args):
+    sv.ensure('supervise', dir=True).join('status').write_binary(
+        _runit_sv_module.SUPERVISE_STATUS.pack(
+            b'\0' * 12, 0, 0, want, 0, 2))
+    start = time.time()
+    subprocess.check_call(['sh', 'finish'] + list(args), cwd=sv.strpath)
+    count, last = sv.join('supervise', 'backoff').read().split()
+    return int(count), time.time() - start
+
+
+@idempotent
+def test_restart_backoff(runit_sv, basedir):
+    """
+    restart_backoff generates a finish script applying the backoff.
+    """
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        restart_backoff=dict(initial=2, max=30, reset_after=120),
+        **base_directories(basedir))
+    finish = basedir.join('sv', 'testsv', 'finish')
+    assert_file(
+        finish,
+        contents=_runit_sv_module.restart_backoff_finish(
+            dict(initial=2, max=30, reset_after=120)),
+        mode=0o755)
+    assert '-ge 120 ]' in finish.read()
+
+
+def test_restart_backoff_counts_crashes(basedir):
+    """
+    The finish script counts consecutive crashes, doesn't count clean exits
+    or a TERM, and doesn't delay while the service is wanted down.
+    """
+    module = FakeAnsibleModule(dict(
+        name='testsv', runscript='spam eggs',
+        restart_backoff=dict(initial=1, max=1), **base_directories(basedir)),
+        False)
+    with pytest.raises(FakeAnsibleModuleBailout):
+        _runit_sv_module.main(module)
+    sv = basedir.join('sv', 'testsv')
+    assert run_finish(sv, b'd', '1', '0')[0] == 1
+    assert run_finish(sv, b'd', '-1', '11')[0] == 2
+    count, elapsed = run_finish(sv, b'd', '2', '0')
+    assert count == 3 and elapsed < 0.9
+    assert run_finish(sv, b'd', '-1', '15')[0] == 0
+    assert run_finish(sv, b'd', '1', '0')[0] == 1
+    assert run_finish(sv, b'd', '0', '0')[0] == 0
+
+
+def test_restart_backoff_delays_crashes(basedir):
+    """
+    While the service is wanted up, a crash delays the restart.
+    """
+    module = FakeAnsibleModule(dict(
+        name='testsv', runscript='spam eggs',
+        restart_backoff=dict(initial=1, max=1), **base_directories(basedir)),
+        False)
+    with pytest.raises(FakeAnsibleModuleBailout):
+        _runit_sv_module.main(module)
+    sv = basedir.join('sv', 'testsv')
+    count, elapsed = run_finish(sv, b'u', '1', '0')
+    assert count == 1 and elapsed >= 0.9
+    count, elapsed = run_finish(sv, b'u', '0', '0')
+    assert count == 0 and elapsed < 0.9
+
+
+@pytest.mark.parametrize('params', [
+    dict(restart_backoff=dict(spam=1)),
+    dict(restart_backoff=dict(initial=0)),
+    dict(restart_backoff=dict(max='spam')),
+    dict(restart_backoff=dict(initial=10, max=5)),
+    dict(restart_backoff=dict(), extra_scripts={'finish': 'spam'}),
+])
+def test_invalid_restart_backoff(runit_sv, basedir, params):
+    """
+    Invalid restart_backoff options, or a finish script of its own, make the
+    module fail.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        **dict(base_directories(basedir), **params))
+
+
+@pytest.mark.parametrize('params', [
+    dict(requires=['testsv']),
+    dict(requires=['db'], requires_max_delay=0),
+    dict(requires=['db'], requires_max_delay='spam'),
+])
+def test_invalid_requires(runit_sv, basedir, params):
+    """
+    A service can't require itself, and the backoff needs a positive maximum.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        **dict(base_directories(basedir), **params))
+
+
+@idempotent
+def test_log(runit_sv, basedir):
+    """
+    The log option generates an svlogd log/run script and its config file.
+    """
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        log=dict(size='1M', count=10, timeout=86400, compress=True),
+        **base_directories(basedir))
+    sv_log = basedir.join('sv', 'testsv', 'log')
+    assert sorted(p.basename for p in sv_log.listdir()) == ['main', 'run']
+    assert_file(
+        sv_log.join('run'), contents='#!/bin/sh\nexec svlogd -tt main\n',
+        mode=0o755)
+    assert_file(
+        sv_log.join('main', 'config'),
+        contents='s1048576\nn10\nt86400\n!nice -n 19 gzip\n', mode=0o644)
+
+
+def test_log_keeps_log_files(runit_sv, basedir):
+    """
+    Files svlogd writes into the log directory aren't cleared as strays.
+    """
+    current = basedir.join('sv', 'testsv', 'log', 'main', 'current')
+    current.ensure()
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        log=dict(user='nobody', timestamp='iso', processor='cat'),
+        **base_directories(basedir))
+    assert current.check(file=True)
+    sv_log = basedir.join('sv', 'testsv', 'log')
+    assert_file(
+        sv_log.join('run'),
+        contents=('#!/bin/sh\nmkdir -p main\nchown nobody main\n'
+                  'exec chpst -u nobody svlogd -ttt main\n'),
+        mode=0o755)
+    assert_file(sv_log.join('main', 'config'), contents='!cat\n', mode=0o644)
+
+
+def test_log_quoted_directory(runit_sv, basedir):
+    """
+    The log directory and user are quoted in the log run script, so that
+    spaces and shell metacharacters in them are taken literally.
+    """
+    directory = basedir.join("log dir; touch pwned 'x'")
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        log=dict(directory=directory.strpath, user='no body'),
+        **base_directories(basedir))
+    sv_log = basedir.join('sv', 'testsv', 'log')
+    fake_bin = basedir.join('bin').ensure(dir=True)
+    for command in ['chown', 'chpst', 'svlogd']:
+        fake_bin.join(command).write(
+            '#!/bin/sh\nprintf "%%s\\n" %s "$@" >> %s\n' % (
+                command, basedir.join('calls')))
+        fake_bin.join(command).chmod(0o755)
+    env = dict(os.environ, PATH=fake_bin.strpath + os.pathsep
+               + os.environ.get('PATH', ''))
+    subprocess.check_call(['sh', 'run'], cwd=sv_log.strpath, env=env)
+    assert directory.check(dir=1)
+    assert not sv_log.join('pwned').exists()
+    assert basedir.join('calls').read().splitlines() == [
+        'chown', 'no body', directory.strpath,
+        'chpst', '-u', 'no body', 'svlogd', '-tt', directory.strpath,
+    ]
+
+
+@idempotent
+def test_log_absolute_directory(runit_sv, basedir):
+    """
+    The log directory can be outside of the sv directory entirely.
+    """
+    logdir = basedir.join('var-log')
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        log=dict(directory=logdir.strpath, size=4096),
+        **base_directories(basedir))
+    assert_file(logdir.join('config'), contents='s4096\n', mode=0o644)
+    sv_log = basedir.join('sv', 'testsv', 'log')
+    assert [p.basename for p in sv_log.listdir()] == ['run']
+
+
+@pytest.mark.parametrize('log_params', [
+    dict(log={'spam': 'eggs'}),
+    dict(log={'size': 'eggs'}),
+    dict(log={'timestamp': 'eggs'}),
+    dict(log={'compress': True, 'processor': 'cat'}),
+    dict(log={}, log_runscript='eggs spam'),
+])
+def test_invalid_log(runit_sv, basedir, log_params):
+    """
+    Invalid or conflicting log options make the module fail.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        **dict(base_directories(basedir), **log_params))
+
+
 @idempotent
 def test_supervise_link(runit_sv, basedir):
     """
@@ -343,6 +819,216 @@ def test_envdir(runit_sv, basedir):
     assert_file(envdir.join('eggs'), contents='spam', mode=0o644)
 
 
+@idempotent
+def test_control(runit_sv, basedir):
+    """
+    The control option creates executable control scripts, named by control
+    letter or by sv command.
+    """
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        control={'reload': 'kill -USR1 $(cat pid)', 't': 'exit 1'},
+        **base_directories(basedir))
+    control = basedir.join('sv', 'testsv', 'control')
+    assert sorted(p.basename for p in control.listdir()) == ['h', 't']
+    assert_file(control.join('h'), contents='kill -USR1 $(cat pid)',
+                mode=0o755)
+    assert_file(control.join('t'), contents='exit 1', mode=0o755)
+
+
+def test_control_clears_stale_scripts(runit_sv, basedir):
+    """
+    Control scripts no longer specified are removed, and without the control
+    option, so is the control directory.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    runit_sv(control={'h': 'spam', 't': 'eggs'}, **kwargs)
+    control = basedir.join('sv', 'testsv', 'control')
+    runit_sv(_must_change=True, control={'hup': 'spam'}, **kwargs)
+    assert [p.basename for p in control.listdir()] == ['h']
+    runit_sv(_must_change=True, **kwargs)
+    assert not control.exists()
+
+
+@pytest.mark.parametrize('control', [
+    {'z': 'spam'},
+    {'restart': 'spam'},
+    {'h': 'spam', 'hup': 'eggs'},
+])
+def test_invalid_control(runit_sv, basedir, control):
+    """
+    Unknown control commands, or the same one twice, make the module fail.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        control=control,
+        **base_directories(basedir))
+
+
+@idempotent
+def test_instances(runit_sv, basedir):
+    """
+    The instances option creates that many numbered services, each with its
+    instance number in its envdir.
+    """
+    result = runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        envdir={'spam': 'eggs'},
+        instances=3,
+        **base_directories(basedir))
+    assert result['instances'] == ['testsv-1', 'testsv-2', 'testsv-3']
+    assert sorted(p.basename for p in basedir.join('sv').listdir()
+                  if p.basename != '.runit_sv') == [
+        'testsv-1', 'testsv-2', 'testsv-3']
+    for index in range(1, 4):
+        name = 'testsv-%d' % (index,)
+        sv = basedir.join('sv', name)
+        assert_file(sv.join('run'), contents='spam eggs', mode=0o755)
+        assert_file(sv.join('env', 'spam'), contents='eggs', mode=0o644)
+        assert_file(
+            sv.join('env', 'RUNIT_INSTANCE'), contents=str(index), mode=0o644)
+        assert basedir.join('service', name).readlink() == sv.strpath
+        assert basedir.join('init.d', name).readlink() == '/usr/bin/sv'
+
+
+def test_instances_shrink(runit_sv, basedir):
+    """
+    Lowering instances removes the surplus services entirely.
+    """
+    kwargs = base_directories(basedir)
+    runit_sv(name='testsv', runscript='spam eggs', instances=3, **kwargs)
+    runit_sv(
+        _must_change=True, name='testsv', runscript='spam eggs',
+        instances='1', instance_env_var='INDEX', **kwargs)
+    for d in ['sv', 'service', 'init.d']:
+        assert [p.basename for p in basedir.join(d).listdir()
+                if p.basename != '.runit_sv'] == ['testsv-1']
+    assert_file(
+        basedir.join('sv', 'testsv-1', 'env', 'INDEX'), contents='1',
+        mode=0o644)
+
+
+def test_instances_shrink_spares_other_services(runit_sv, basedir):
+    """
+    Only instances runit_sv created are removed as surplus, and not another
+    service which happens to be named like one.
+    """
+    kwargs = base_directories(basedir)
+    runit_sv(name='testsv-6379', runscript='spam eggs', **kwargs)
+    runit_sv(name='testsv', runscript='spam eggs', instances=3, **kwargs)
+    runit_sv(
+        _must_change=True, name='testsv', runscript='spam eggs', instances=1,
+        **kwargs)
+    for d in ['sv', 'service', 'init.d']:
+        assert sorted(p.basename for p in basedir.join(d).listdir()
+                      if p.basename != '.runit_sv') == [
+            'testsv-1', 'testsv-6379']
+    assert_file(
+        basedir.join('sv', 'testsv-6379', 'run'), contents='spam eggs',
+        mode=0o755)
+
+
+@pytest.mark.parametrize('params', [
+    dict(instances='spam'),
+    dict(instances=-1),
+    dict(instances=2, supervise_link='/spam/eggs'),
+])
+def test_invalid_instances(runit_sv, basedir, params):
+    """
+    Invalid instances, or per-service links with instances, make the module
+    fail.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        **dict(base_directories(basedir), **params))
+
+
+def make_shards(basedir, count=3):
+    shards = []
+    for index in range(count):
+        shard = basedir.join('shard-%d' % (index,))
+        shard.mkdir()
+        shards.append(shard.strpath)
+    return shards
+
+
+@idempotent
+def test_service_shards(runit_sv, basedir):
+    """
+    With service_shards, each instance is linked into exactly one shard,
+    picked by hashing its name, and never into the service directory.
+    """
+    shards = make_shards(basedir)
+    result = runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        instances=6,
+        service_shards=shards,
+        **base_directories(basedir))
+    assert sorted(result['shards']) == result['instances']
+    for name in result['instances']:
+        expected = _runit_sv_module.choose_shard(name, shards)
+        assert result['shards'][name] == expected
+        for shard in shards:
+            link = os.path.join(shard, name)
+            assert os.path.islink(link) == (shard == expected)
+        assert os.readlink(os.path.join(expected, name)) == (
+            basedir.join('sv', name).strpath)
+    assert not basedir.join('service').listdir()
+
+
+def test_service_shard_move(runit_sv, basedir):
+    """
+    Choosing a different shard moves the link, removing it from the old
+    shard and from the unsharded service directory.
+    """
+    shards = make_shards(basedir)
+    kwargs = base_directories(basedir)
+    runit_sv(name='testsv', runscript='spam eggs', **kwargs)
+    assert basedir.join('service', 'testsv').check(link=1)
+    for index in [0, 2]:
+        result = runit_sv(
+            _must_change=True, name='testsv', runscript='spam eggs',
+            service_shards=shards, shard=index, **kwargs)
+        assert result['shards'] == {'testsv': shards[index]}
+        assert [os.path.islink(os.path.join(shard, 'testsv'))
+                for shard in shards] == [i == index for i in range(3)]
+        assert not basedir.join('service', 'testsv').check(link=1)
+    runit_sv(_must_change=True, name='testsv', state='absent',
+             service_shards=shards, **kwargs)
+    for shard in shards:
+        assert not os.listdir(shard)
+
+
+@pytest.mark.parametrize('params', [
+    dict(shard=0),
+    dict(service_shards=['shard-0'], shard=1),
+    dict(service_shards=['shard-0'], shard=-1),
+    dict(service_shards=['spam']),
+])
+def test_invalid_service_shards(runit_sv, basedir, params):
+    """
+    A shard out of range, a shard without service_shards, or a shard which
+    doesn't exist makes the module fail.
+    """
+    make_shards(basedir, count=1)
+    if 'service_shards' in params:
+        params['service_shards'] = [
+            basedir.join(shard).strpath for shard in params['service_shards']]
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        **dict(base_directories(basedir), **params))
+
+
 @idempotent
 def test_no_lsb_service(runit_sv, basedir):
     """
@@ -372,6 +1058,336 @@ def test_no_lsb_service_or_service_directory(runit_sv, basedir):
     assert not basedir.join('init.d', 'testsv').exists()
 
 
+class FakeRunsv(object):
+    """
+    Stands in for a runsv supervising a service: it reads commands from the
+    control fifo, and after a 'd' (and the given delay), writes a status
+    showing the service down. After a 't' (and the restart delay), it writes
+    a status showing a new pid, recording when the restart began and ended.
+    After an 'x', it exits, unless told not to.
+    """
+
+    def __init__(self, supervise, stops=True, delay=0, restart_delay=0,
+                 exits=True):
+        supervise.ensure(dir=True)
+        self.supervise = supervise
+        self.stops = stops
+        self.exits = exits
+        self.delay = delay
+        self.restart_delay = restart_delay
+        self.received = b''
+        self.restarts = []
+        self.pid = 1234
+        self.write_status(self.pid)
+        self.fds = []
+        for fifo in ['control', 'ok']:
+            os.mkfifo(supervise.join(fifo).strpath)
+            self.fds.append(os.open(
+                supervise.join(fifo).strpath, os.O_RDONLY | os.O_NONBLOCK))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def write_status(self, pid):
+        self.supervise.join('status').write_binary(
+            _runit_sv_module.SUPERVISE_STATUS.pack(
+                b'\0' * 12, pid, 0, b'u' if pid else b'd', 0, 1 if pid else 0))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                command = os.read(self.fds[0], 1)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                command = b''
+            if not command:
+                time.sleep(0.01)
+                continue
+            self.received += command
+            if command == b'd' and self.stops:
+                time.sleep(self.delay)
+                self.write_status(0)
+            elif command == b't':
+                start = time.time()
+                time.sleep(self.restart_delay)
+                self.pid += 1
+                self.write_status(self.pid)
+                self.restarts.append((start, time.time()))
+            elif command == b'x' and self.exits:
+                break
+        self.close_fifos()
+
+    def close_fifos(self):
+        while self.fds:
+            os.close(self.fds.pop())
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+@pytest.fixture
+def fake_runsvs():
+    runsvs = []
+
+    def make(supervise, **kwargs):
+        runsv = FakeRunsv(supervise, **kwargs)
+        runsvs.append(runsv)
+        return runsv
+
+    yield make
+    for runsv in runsvs:
+        runsv.close()
+
+
+def test_absent_stops_service(runit_sv, basedir, fake_runsvs):
+    """
+    With state=absent, a running service is taken down and its runsv told to
+    exit before its link is removed, and how long that took is reported.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    runit_sv(**kwargs)
+    sv = basedir.join('sv', 'testsv')
+    runsv = fake_runsvs(sv.join('supervise'))
+    result = runit_sv(_must_change=True, state='absent', **kwargs)
+    assert runsv.received == b'dx'
+    assert list(result['shutdown']) == ['testsv']
+    assert result['shutdown']['testsv'] >= 0
+    assert not basedir.join('service', 'testsv').exists()
+    assert_file(sv.join('run'), contents='spam eggs', mode=0o755)
+
+
+def test_absent_stops_instances_in_parallel(runit_sv, basedir, fake_runsvs):
+    """
+    Every instance being removed is stopped at once, rather than one after
+    another.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs', instances=3,
+                  **base_directories(basedir))
+    runit_sv(**kwargs)
+    runsvs = [
+        fake_runsvs(basedir.join('sv', 'testsv-%d' % (index,), 'supervise'),
+                    delay=0.2)
+        for index in range(1, 4)]
+    result = runit_sv(_must_change=True, state='absent', **kwargs)
+    assert [runsv.received for runsv in runsvs] == [b'dx'] * 3
+    assert sorted(result['shutdown']) == ['testsv-1', 'testsv-2', 'testsv-3']
+    assert max(result['shutdown'].values()) < 0.5
+
+
+def test_absent_stop_times_out(runit_sv, basedir, fake_runsvs):
+    """
+    If a service doesn't stop within stop_timeout, the module fails without
+    removing anything.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    runit_sv(**kwargs)
+    fake_runsvs(basedir.join('sv', 'testsv', 'supervise'), stops=False)
+    result = runit_sv(
+        _should_fail=True, state='absent', stop_timeout=0, **kwargs)
+    assert result['shutdown'] == {}
+    assert basedir.join('service', 'testsv').check(link=1)
+
+
+def test_absent_stops_inside_restart_slot(basedir, fake_runsvs):
+    """
+    A service being removed isn't stopped until a restart slot is free, so
+    that runsvdir can't respawn it while waiting; the link is removed right
+    after.
+    """
+    params = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    with pytest.raises(FakeAnsibleModuleBailout):
+        _runit_sv_module.main(FakeAnsibleModule(dict(params), False))
+    runsv = fake_runsvs(basedir.join('sv', 'testsv', 'supervise'))
+    held = _runit_sv_module.Semaphore(
+        basedir.join('sv', '.runit_sv', 'restart-slots').strpath, 1)
+    held.acquire(0)
+    results = []
+
+    def remove():
+        module = FakeAnsibleModule(dict(
+            params, state='absent', apply_action=True,
+            restart_concurrency=1), False)
+        try:
+            _runit_sv_module.main(module)
+        except FakeAnsibleModuleBailout as e:
+            results.append(e)
+
+    thread = threading.Thread(target=remove)
+    thread.start()
+    try:
+        time.sleep(0.2)
+        assert runsv.received == b''
+    finally:
+        held.release()
+        thread.join()
+    assert results[0].success
+    assert runsv.received == b'dx'
+    assert not basedir.join('service', 'testsv').exists()
+
+
+def test_absent_failed_commit_resumes_service(basedir, fake_runsvs,
+                                              monkeypatch):
+    """
+    If removing a stopped service fails and is rolled back, the service is
+    told to come back up.
+    """
+    params = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    with pytest.raises(FakeAnsibleModuleBailout):
+        _runit_sv_module.main(FakeAnsibleModule(dict(params), False))
+    runsv = fake_runsvs(
+        basedir.join('sv', 'testsv', 'supervise'), exits=False)
+
+    def failing_commit(records):
+        raise OSError(errno.EPERM, 'operation not permitted')
+
+    monkeypatch.setattr(_runit_sv_module, 'commit_records', failing_commit)
+    with pytest.raises(FakeAnsibleModuleBailout) as excinfo:
+        _runit_sv_module.main(
+            FakeAnsibleModule(dict(params, state='absent'), False))
+    assert not excinfo.value.success
+    assert excinfo.value.params['resumed'] == ['testsv']
+    deadline = time.time() + 5
+    while time.time() < deadline and runsv.received != b'dxu':
+        time.sleep(0.01)
+    assert runsv.received == b'dxu'
+    assert basedir.join('service', 'testsv').check(link=1)
+
+
+def test_absent_check_mode_stops_nothing(runit_sv, basedir, fake_runsvs):
+    """
+    In check mode, a running service which would be stopped is reported as a
+    change, but nothing is sent to it.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    runit_sv(**kwargs)
+    runit_sv(state='absent', **kwargs)
+    runsv = fake_runsvs(basedir.join('sv', 'testsv', 'supervise'))
+    runit_sv(_check=True, _must_change=True, state='absent', **kwargs)
+    time.sleep(0.05)
+    assert runsv.received == b''
+
+
+ACTION_BASE = dict(
+    name='testsv',
+    runscript='spam eggs',
+    log=dict(size='1M'),
+    envdir={'spam': 'eggs'},
+    extra_files={'app.conf': 'spam', 'other.conf': 'eggs'},
+    extra_file_actions={'app.conf': 'reload', 'other.conf': 'none'},
+)
+
+
+@pytest.mark.parametrize(('params', 'expected'), [
+    (dict(runscript='eggs spam'), ('restart', 'none')),
+    (dict(envdir={'spam': 'spam'}), ('restart', 'none')),
+    (dict(extra_files={'app.conf': 'eggs', 'other.conf': 'eggs'}),
+     ('reload', 'none')),
+    (dict(extra_files={'app.conf': 'spam', 'other.conf': 'spam'}),
+     ('none', 'none')),
+    (dict(extra_files={'app.conf': 'spam'},
+          extra_file_actions={'app.conf': 'reload'}), ('restart', 'none')),
+    (dict(log=dict(size='2M')), ('none', 'reload')),
+    (dict(log=dict(size='1M', timestamp='iso')), ('none', 'restart')),
+    (dict(state='down'), ('none', 'none')),
+    (dict(control={'h': 'spam'}), ('none', 'none')),
+])
+def test_required_action(runit_sv, basedir, params, expected):
+    """
+    The module reports the least disruptive action which makes the changes
+    it made take effect, for the service and its log service.
+    """
+    kwargs = dict(ACTION_BASE, **base_directories(basedir))
+    runit_sv(**kwargs)
+    kwargs.update(params)
+    result = runit_sv(_must_change=True, **kwargs)
+    assert result['required_action'] == dict(
+        service=expected[0], log=expected[1])
+    assert 'applied_action' not in result
+
+
+def test_required_action_no_change(runit_sv, basedir):
+    """
+    If nothing changes, no action is required.
+    """
+    kwargs = dict(ACTION_BASE, **base_directories(basedir))
+    runit_sv(**kwargs)
+    result = runit_sv(_must_not_change=True, **kwargs)
+    assert result['required_action'] == dict(service='none', log='none')
+
+
+@pytest.mark.parametrize(('params', 'service', 'log'), [
+    (dict(runscript='eggs spam'), b'tcu', b''),
+    (dict(runscript='eggs spam', state='down'), b'tc', b''),
+    (dict(extra_files={'app.conf': 'eggs', 'other.conf': 'eggs'}), b'h', b''),
+    (dict(log=dict(size='2M')), b'', b'h'),
+])
+def test_apply_action(runit_sv, basedir, fake_runsvs, params, service, log):
+    """
+    With apply_action, the required action is sent to the running service and
+    log service.
+    """
+    kwargs = dict(ACTION_BASE, **base_directories(basedir))
+    runit_sv(**kwargs)
+    sv = basedir.join('sv', 'testsv')
+    runsvs = [fake_runsvs(sv.join('supervise'), stops=False),
+              fake_runsvs(sv.join('log', 'supervise'), stops=False)]
+    kwargs.update(params)
+    result = runit_sv(_must_change=True, apply_action=True, **kwargs)
+    expected = {}
+    if service:
+        expected['service'] = 'restart' if b't' in service else 'reload'
+    if log:
+        expected['log'] = 'reload'
+    assert result['applied_action'] == ({'testsv': expected} if expected
+                                        else {})
+    assert list(result['restart_wait']) == (
+        ['testsv'] if b't' in service else [])
+    deadline = time.time() + 5
+    while time.time() < deadline and [r.received for r in runsvs] != [
+            service, log]:
+        time.sleep(0.01)
+    assert [r.received for r in runsvs] == [service, log]
+
+
+@pytest.mark.parametrize('extra_file_actions', [
+    {'missing.conf': 'reload'},
+    {'app.conf': 'spam'},
+])
+def test_invalid_extra_file_actions(runit_sv, basedir, extra_file_actions):
+    """
+    extra_file_actions must name extra files or scripts, and valid actions.
+    """
+    runit_sv(
+        _should_fail=True,
+        **dict(ACTION_BASE, extra_file_actions=extra_file_actions,
+               **base_directories(basedir)))
+
+
+@idempotent
+def test_absent_removes_sv_directory(runit_sv, basedir):
+    """
+    With remove_sv_directory, state=absent removes the sv directory and the
+    LSB service along with the service link.
+    """
+    kwargs = base_directories(basedir)
+    runit_sv(name='testsv', runscript='spam eggs', **kwargs)
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        state='absent',
+        remove_sv_directory=True,
+        **kwargs)
+    for d in ['sv', 'service', 'init.d']:
+        assert not basedir.join(d, 'testsv').exists()
+
+
 @idempotent
 def test_down_state(runit_sv, basedir):
     """
@@ -445,6 +1461,145 @@ def test_lsb_service_present_with_no_init_d(runit_sv, basedir):
         **base_directories(basedir, init_d_directory=[]))
 
 
+@idempotent
+def test_supervise_tmpfs_root(runit_sv, basedir):
+    """
+    supervise_tmpfs_root links supervise and log/supervise to directories
+    named after the service under it, which are created.
+    """
+    root = basedir.join('run', 'supervise')
+    runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        log_runscript='eggs spam',
+        supervise_tmpfs_root=root.strpath,
+        tmpfiles_directory=basedir.join('tmpfiles.d').strpath,
+        **base_directories(basedir))
+    sv = basedir.join('sv', 'testsv')
+    assert sv.join('supervise').readlink() == root.join('testsv').strpath
+    assert sv.join('log', 'supervise').readlink() == (
+        root.join('testsv.log').strpath)
+    for target in ['testsv', 'testsv.log']:
+        assert root.join(target).check(dir=1)
+        assert settable_mode(root.join(target)) == 0o700
+
+
+@pytest.mark.parametrize('segments', [('supervise',), ('log', 'supervise')])
+def test_supervise_tmpfs_root_existing_supervise(runit_sv, basedir, segments):
+    """
+    A service whose supervise directory runsv already created isn't switched
+    to supervise_tmpfs_root; the module fails saying what to do instead, and
+    changes nothing. Doing what it says switches it.
+    """
+    root = basedir.join('run', 'supervise')
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  log_runscript='eggs spam', **base_directories(basedir))
+    runit_sv(**kwargs)
+    supervise = basedir.join('sv', 'testsv', *segments)
+    supervise.mkdir()
+    result = runit_sv(
+        _should_fail=True,
+        supervise_tmpfs_root=root.strpath,
+        tmpfiles_directory=basedir.join('tmpfiles.d').strpath,
+        **kwargs)
+    assert result['msg'].startswith(supervise.strpath + ' is already a dir')
+    assert 'state=absent' in result['msg']
+    assert supervise.check(dir=1, link=0)
+    assert not root.exists()
+
+    runit_sv(state='absent', **kwargs)
+    supervise.remove()
+    runit_sv(
+        supervise_tmpfs_root=root.strpath,
+        tmpfiles_directory=basedir.join('tmpfiles.d').strpath,
+        **kwargs)
+    assert supervise.readlink().startswith(root.strpath)
+
+
+def test_supervise_tmpfs_root_recreated(runit_sv, basedir):
+    """
+    If the supervise directories are gone, as after a reboot, the next run
+    recreates them.
+    """
+    root = basedir.join('run', 'supervise')
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  supervise_tmpfs_root=root.strpath,
+                  tmpfiles_directory=basedir.join('tmpfiles.d').strpath,
+                  **base_directories(basedir))
+    runit_sv(**kwargs)
+    settle()
+    runit_sv(_must_not_change=True, **kwargs)
+    basedir.join('run').remove()
+    result = runit_sv(_must_change=True, **kwargs)
+    assert result['changes'][root.join('testsv').strpath]['reason'] == (
+        'missing')
+    assert root.join('testsv').check(dir=1)
+    assert not root.join('testsv.log').exists()
+
+
+def test_supervise_tmpfs_root_tmpfiles(runit_sv, basedir):
+    """
+    supervise_tmpfs_root also writes a tmpfiles.d entry recreating the
+    supervise directories at boot, which is removed along with the service.
+    """
+    root = basedir.join('run', 'supervise')
+    tmpfiles = basedir.join('tmpfiles.d')
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  log_runscript='eggs spam',
+                  supervise_tmpfs_root=root.strpath,
+                  tmpfiles_directory=tmpfiles.strpath,
+                  **base_directories(basedir))
+    runit_sv(**kwargs)
+    assert_file(
+        tmpfiles.join('runit_sv-testsv.conf'),
+        contents='d %s 0700 - - -\nd %s 0700 - - -\n' % (
+            root.join('testsv'), root.join('testsv.log')),
+        mode=0o644)
+    runit_sv(_must_change=True, state='absent', remove_sv_directory=True,
+             **kwargs)
+    assert not tmpfiles.listdir()
+
+
+@pytest.mark.skipif(
+    os.getuid() != 0 or not any(
+        os.access(os.path.join(d, 'systemd-tmpfiles'), os.X_OK)
+        for d in os.environ.get('PATH', '').split(os.pathsep)),
+    reason='needs root and systemd-tmpfiles')
+def test_supervise_tmpfs_root_boot(runit_sv, basedir):
+    """
+    After a reboot empties the tmpfs, systemd-tmpfiles --create recreates
+    the supervise directories from the entry, without runit_sv running.
+    """
+    root = basedir.join('run', 'supervise')
+    tmpfiles = basedir.join('tmpfiles.d')
+    runit_sv(name='testsv', runscript='spam eggs',
+             supervise_tmpfs_root=root.strpath,
+             tmpfiles_directory=tmpfiles.strpath,
+             **base_directories(basedir))
+    basedir.join('run').remove()
+    subprocess.check_call([
+        'systemd-tmpfiles', '--create',
+        tmpfiles.join('runit_sv-testsv.conf').strpath])
+    assert root.join('testsv').check(dir=1)
+    assert settable_mode(root.join('testsv')) == 0o700
+    assert basedir.join('sv', 'testsv', 'supervise').check(dir=1)
+
+
+@pytest.mark.parametrize('param', ['supervise_link', 'log_supervise_link'])
+def test_supervise_tmpfs_root_with_link(runit_sv, basedir, param):
+    """
+    supervise_tmpfs_root can't be combined with an explicit supervise link.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        log_runscript='eggs spam',
+        supervise_tmpfs_root=basedir.join('run').strpath,
+        tmpfiles_directory=basedir.join('tmpfiles.d').strpath,
+        **dict(base_directories(basedir), **{param: '/spam/eggs'}))
+
+
 def test_supervise_already_exists(runit_sv, basedir):
     """
     If a supervise directory is in the service directory, it will continue to
@@ -493,3 +1648,377 @@ def test_extra_stuff_does_not_clobber_service_names(
     sv = basedir.join('sv', 'testsv')
     assert basedir.join('service', 'testsv').readlink() == sv.strpath
     assert basedir.join('init.d', 'testsv').readlink() == '/usr/bin/sv'
+
+
+def test_lock_wait_is_reported(runit_sv, basedir):
+    """
+    The time spent waiting for the service's locks is reported as lock_wait.
+    """
+    result = runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        **base_directories(basedir))
+    assert result['lock_wait'] >= 0
+
+
+def test_locked_service_times_out(runit_sv, basedir):
+    """
+    If another invocation holds the lock on the service's sv directory for
+    longer than lock_timeout, the module will fail without changing anything.
+    """
+    sv = basedir.join('sv', 'testsv')
+    sv.ensure(dir=True)
+    fd = os.open(sv.strpath, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        runit_sv(
+            _should_fail=True,
+            name='testsv',
+            runscript='spam eggs',
+            lock_timeout=0,
+            **base_directories(basedir))
+    finally:
+        os.close(fd)
+    assert not sv.listdir()
+
+
+def test_shared_service_directory_lock(runit_sv, basedir):
+    """
+    The service directory is only locked shared, so holding a shared lock on
+    it doesn't block the module.
+    """
+    fd = os.open(basedir.join('service').strpath, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        runit_sv(
+            name='testsv',
+            runscript='spam eggs',
+            lock_timeout=0,
+            **base_directories(basedir))
+    finally:
+        os.close(fd)
+
+
+def test_failed_commit_rolls_back(basedir, monkeypatch):
+    """
+    If committing fails partway through, the module fails and the service is
+    left as it was before the module ran.
+    """
+    kwargs = base_directories(basedir)
+    sv = basedir.join('sv', 'testsv')
+    module = FakeAnsibleModule(
+        dict(name='testsv', runscript='spam eggs', **kwargs), False)
+    with pytest.raises(FakeAnsibleModuleBailout):
+        _runit_sv_module.main(module)
+
+    def failing_symlink(target, path):
+        raise OSError(errno.EPERM, 'operation not permitted')
+
+    monkeypatch.setattr(_runit_sv_module.os, 'symlink', failing_symlink)
+    module = FakeAnsibleModule(
+        dict(name='testsv', runscript='eggs spam', envdir={'spam': 'eggs'},
+             supervise_link='/spam/eggs', **kwargs), False)
+    with pytest.raises(FakeAnsibleModuleBailout) as excinfo:
+        _runit_sv_module.main(module)
+    assert not excinfo.value.success
+    assert sorted(p.basename for p in sv.listdir()) == ['run']
+    assert_file(sv.join('run'), contents='spam eggs', mode=0o755)
+    assert basedir.join('init.d', 'testsv').readlink() == '/usr/bin/sv'
+
+
+def test_restart_concurrency(runit_sv, basedir):
+    """
+    With restart_concurrency, the module queues for a restart slot under the
+    state directory before committing and reports the time spent queued.
+    """
+    result = runit_sv(
+        name='testsv',
+        runscript='spam eggs',
+        apply_action=True,
+        restart_concurrency=2,
+        restart_jitter=0.01,
+        **base_directories(basedir))
+    assert result['queue_wait'] >= 0
+    slots = basedir.join('sv', '.runit_sv', 'restart-slots')
+    assert sorted(p.basename for p in slots.listdir()) == ['slot-0', 'slot-1']
+
+
+def test_restart_concurrency_times_out(runit_sv, basedir):
+    """
+    If every restart slot stays taken for longer than lock_timeout, the module
+    fails without changing anything.
+    """
+    state = basedir.join('state')
+    held = _runit_sv_module.Semaphore(state.join('restart-slots').strpath, 1)
+    held.acquire(0)
+    try:
+        runit_sv(
+            _should_fail=True,
+            name='testsv',
+            runscript='spam eggs',
+            apply_action=True,
+            restart_concurrency=1,
+            state_directory=state.strpath,
+            lock_timeout=0,
+            **base_directories(basedir))
+    finally:
+        held.release()
+    assert not basedir.join('sv', 'testsv').listdir()
+
+
+def test_restart_concurrency_requires_apply_action(runit_sv, basedir):
+    """
+    restart_concurrency without apply_action makes the module fail, since
+    there would be no restart to bound.
+    """
+    runit_sv(
+        _should_fail=True,
+        name='testsv',
+        runscript='spam eggs',
+        restart_concurrency=1,
+        **base_directories(basedir))
+    assert not basedir.join('sv', 'testsv').listdir()
+
+
+def test_restart_concurrency_serializes_restarts(basedir, fake_runsvs):
+    """
+    With one restart slot, two concurrent invocations don't overlap their
+    restarts: the slot is held until the restarted service is seen running
+    under a new pid.
+    """
+    names = ['spam', 'eggs']
+    runsvs = []
+    for name in names:
+        params = dict(name=name, runscript='spam eggs',
+                      **base_directories(basedir))
+        with pytest.raises(FakeAnsibleModuleBailout):
+            _runit_sv_module.main(FakeAnsibleModule(params, False))
+        runsvs.append(fake_runsvs(
+            basedir.join('sv', name, 'supervise'), restart_delay=0.2))
+
+    results = {}
+
+    def converge(name):
+        module = FakeAnsibleModule(dict(
+            name=name, runscript='eggs spam', apply_action=True,
+            restart_concurrency=1, **base_directories(basedir)), False)
+        try:
+            _runit_sv_module.main(module)
+        except FakeAnsibleModuleBailout as e:
+            results[name] = e
+
+    threads = [threading.Thread(target=converge, args=(name,))
+               for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for name in names:
+        assert results[name].success
+        assert list(results[name].params['restart_wait']) == [name]
+    (first,), (second,) = sorted(runsv.restarts for runsv in runsvs)
+    assert first[1] <= second[0]
+
+
+def test_apply_action_restart_times_out(runit_sv, basedir, fake_runsvs):
+    """
+    If a restarted service doesn't come back up within restart_timeout, the
+    module fails, reporting the change it made.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    runit_sv(**kwargs)
+    fake_runsvs(basedir.join('sv', 'testsv', 'supervise'), restart_delay=0.5)
+    kwargs['runscript'] = 'eggs spam'
+    result = runit_sv(
+        _should_fail=True, apply_action=True, restart_timeout=0, **kwargs)
+    assert result['changed']
+    assert result['applied_action'] == {'testsv': {'service': 'restart'}}
+
+
+def test_change_reasons(runit_sv, basedir):
+    """
+    The module reports why each path must change, with its current and
+    desired state.
+    """
+    kwargs = dict(name='testsv', envdir={'spam': 'eggs', 'eggs': 'spam'},
+                  **base_directories(basedir))
+    runit_sv(runscript='spam eggs', **kwargs)
+    sv = basedir.join('sv', 'testsv')
+    sv.join('env', 'spam').chmod(0o600)
+    sv.join('env', 'eggs').remove()
+    sv.join('stray').write('')
+    result = runit_sv(
+        _must_change=True, runscript='eggs spam', lsb_service='absent',
+        **kwargs)
+    changes = result['changes']
+    assert sorted(changes) == sorted(
+        path for path, changed in result['paths'].items() if changed)
+    assert {path: change['reason'] for path, change in changes.items()} == {
+        sv.join('run').strpath: 'content',
+        sv.join('env', 'spam').strpath: 'mode',
+        sv.join('env', 'eggs').strpath: 'missing',
+        sv.join('stray').strpath: 'stray',
+        basedir.join('init.d', 'testsv').strpath: 'extra',
+    }
+    run = changes[sv.join('run').strpath]
+    assert run['current']['mode'] == run['desired']['mode'] == '0755'
+    assert run['current']['digest'] != run['desired']['digest']
+    assert changes[basedir.join('init.d', 'testsv').strpath] == {
+        'reason': 'extra', 'current': {'target': '/usr/bin/sv'},
+        'desired': None}
+
+
+def settle():
+    """
+    Wait out the filesystem's timestamp granularity, so that a manifest
+    written after this isn't in the same clock tick as what it records.
+    """
+    time.sleep(0.05)
+
+
+def test_manifest_hit(runit_sv, basedir):
+    """
+    Once a manifest matches, a run reports no change from it alone, without
+    reading the managed files.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  envdir={'spam': 'eggs'}, **base_directories(basedir))
+    runit_sv(**kwargs)
+    settle()
+    runit_sv(_must_not_change=True, **kwargs)
+    result = runit_sv(_must_not_change=True, **kwargs)
+    assert result['manifest'] == 'hit'
+    sv = basedir.join('sv', 'testsv')
+    assert result['paths'][sv.join('run').strpath] is False
+    assert not any(result['paths'].values())
+    assert basedir.join(
+        'sv', '.runit_sv', 'manifests', 'testsv.json').check(file=1)
+
+
+def test_manifest_hit_skips_reading(basedir, monkeypatch):
+    """
+    A manifest hit doesn't hash any managed file.
+    """
+    params = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    for _ in range(2):
+        module = FakeAnsibleModule(dict(params), False)
+        with pytest.raises(FakeAnsibleModuleBailout):
+            _runit_sv_module.main(module)
+        settle()
+
+    def hash_file(path):
+        raise AssertionError('read %r' % (path,))
+
+    monkeypatch.setattr(_runit_sv_module, 'hash_file', hash_file)
+    module = FakeAnsibleModule(dict(params), False)
+    with pytest.raises(FakeAnsibleModuleBailout) as excinfo:
+        _runit_sv_module.main(module)
+    assert excinfo.value.success
+    assert excinfo.value.params['manifest'] == 'hit'
+
+
+@pytest.mark.parametrize('tamper', [
+    lambda sv: sv.join('run').write('eggs spam'),
+    lambda sv: sv.join('run').chmod(0o700),
+    lambda sv: sv.join('stray').write('spam'),
+    lambda sv: sv.join('env', 'spam').remove(),
+])
+def test_manifest_miss_after_tampering(runit_sv, basedir, tamper):
+    """
+    Changing, adding or removing anything the manifest covers makes the next
+    run check and fix everything, however soon it happens.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  envdir={'spam': 'eggs'}, **base_directories(basedir))
+    runit_sv(**kwargs)
+    sv = basedir.join('sv', 'testsv')
+    tamper(sv)
+    result = runit_sv(_must_change=True, **kwargs)
+    assert result['manifest'] == 'miss'
+    assert sorted(p.basename for p in sv.listdir()) == ['env', 'run']
+    assert_file(sv.join('run'), contents='spam eggs', mode=0o755)
+    assert_file(sv.join('env', 'spam'), contents='eggs', mode=0o644)
+
+
+def test_manifest_miss_after_params_change(runit_sv, basedir):
+    """
+    Any change to the parameters which affect the service invalidates the
+    manifest.
+    """
+    kwargs = base_directories(basedir)
+    runit_sv(name='testsv', runscript='spam eggs', **kwargs)
+    settle()
+    runit_sv(name='testsv', runscript='spam eggs', **kwargs)
+    result = runit_sv(
+        _must_change=True, name='testsv', runscript='spam eggs', umask=0o077,
+        **kwargs)
+    assert result['manifest'] == 'miss'
+    assert_file(
+        basedir.join('sv', 'testsv', 'run'), contents='spam eggs', mode=0o700)
+
+
+def test_manifest_miss_after_upgrade(basedir, monkeypatch):
+    """
+    A manifest written by a different version of the module isn't current,
+    so that what the new version generates from the same parameters still
+    gets written.
+    """
+    params = dict(name='testsv', runscript='spam eggs',
+                  restart_backoff=dict(initial=1, max=1),
+                  **base_directories(basedir))
+
+    def run():
+        module = FakeAnsibleModule(dict(params), False)
+        with pytest.raises(FakeAnsibleModuleBailout) as excinfo:
+            _runit_sv_module.main(module)
+        assert excinfo.value.success
+        return excinfo.value.params
+
+    run()
+    settle()
+    run()
+    assert run()['manifest'] == 'hit'
+    monkeypatch.setattr(
+        _runit_sv_module, 'RESTART_BACKOFF_FINISH', '#!/bin/sh\n# %(max)s\n')
+    monkeypatch.setattr(_runit_sv_module, 'SOURCE_DIGEST', 'upgraded')
+    result = run()
+    assert result['changed'] and result['manifest'] == 'miss'
+    assert basedir.join('sv', 'testsv', 'finish').read() == '#!/bin/sh\n# 1\n'
+
+
+def test_verify_full(runit_sv, basedir):
+    """
+    verify=full ignores any manifest, and checks every managed file.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  **base_directories(basedir))
+    runit_sv(**kwargs)
+    settle()
+    runit_sv(**kwargs)
+    result = runit_sv(_must_not_change=True, verify='full', **kwargs)
+    assert result['manifest'] == 'skipped'
+    assert result['paths'] == dict.fromkeys(result['paths'], False)
+
+
+def test_only_paths(runit_sv, basedir):
+    """
+    only_paths checks and repairs only the managed paths under them, and
+    leaves the manifest to the next full run.
+    """
+    kwargs = dict(name='testsv', runscript='spam eggs',
+                  envdir={'spam': 'eggs'}, **base_directories(basedir))
+    runit_sv(**kwargs)
+    sv = basedir.join('sv', 'testsv')
+    sv.join('run').write('eggs spam')
+    sv.join('env', 'spam').remove()
+    result = runit_sv(
+        _must_change=True, only_paths=[sv.join('env').strpath], **kwargs)
+    assert result['manifest'] == 'skipped'
+    assert list(result['changes']) == [sv.join('env', 'spam').strpath]
+    assert sv.join('env', 'spam').read() == 'eggs'
+    assert sv.join('run').read() == 'eggs spam'
+    result = runit_sv(_must_change=True, **kwargs)
+    assert result['manifest'] == 'miss'
+    assert list(result['changes']) == [sv.join('run').strpath]
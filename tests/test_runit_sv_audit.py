@@ -0,0 +1,156 @@
+# Copyright (c) weykent <weykent@weasyl.com>
+# See COPYING for details.
+
+import pytest
+
+import runit_sv as _runit_sv_module
+from test_runit_sv import (
+    FakeAnsibleModule, FakeAnsibleModuleBailout, base_directories)
+
+
+def run(main, params, check_mode=False):
+    module = FakeAnsibleModule(params, check_mode)
+    with pytest.raises(FakeAnsibleModuleBailout) as excinfo:
+        main(module)
+    return excinfo.value
+
+
+SPECS = [
+    dict(name='spam', runscript='spam run', envdir={'SPAM': 'eggs'}),
+    dict(name='eggs', runscript='eggs run', log_runscript='eggs log'),
+]
+
+
+@pytest.fixture
+def converged(basedir):
+    for spec in SPECS:
+        bailout = run(
+            _runit_sv_module.main,
+            dict(spec, **base_directories(basedir)))
+        assert bailout.success
+    return basedir
+
+
+def audit(basedir, specs=SPECS, **params):
+    params.update(base_directories(basedir))
+    return run(
+        _runit_sv_module.main_dispatch, dict(params, services=specs),
+        check_mode=True)
+
+
+def test_audit_no_drift(converged):
+    """
+    Auditing the specs a host was converged with reports no drift.
+    """
+    bailout = audit(converged)
+    assert bailout.success
+    assert bailout.params == dict(
+        changed=False, drifted=False, drift={}, errors={}, extra_services={})
+
+
+def test_audit_reports_drift(converged):
+    """
+    Changed, missing and extra files and links are reported per service, and
+    services no spec declares are reported separately, without anything
+    being changed.
+    """
+    sv = converged.join('sv')
+    sv.join('spam', 'run').write('hand edited')
+    sv.join('spam', 'env', 'SPAM').remove()
+    sv.join('spam', 'stray').write('')
+    converged.join('service', 'eggs').remove()
+    sv.join('ham').ensure('run')
+    converged.join('service', 'ham').mksymlinkto(sv.join('ham'))
+    bailout = audit(converged, workers=1)
+    assert bailout.success
+    assert bailout.params['drifted']
+    assert bailout.params['drift'] == {
+        'spam': {
+            'changed': [sv.join('spam', 'run').strpath],
+            'missing': [sv.join('spam', 'env', 'SPAM').strpath],
+            'extra': [sv.join('spam', 'stray').strpath],
+        },
+        'eggs': {
+            'missing': [converged.join('service', 'eggs').strpath],
+        },
+    }
+    assert bailout.params['extra_services'] == {
+        'service_directory': ['ham'],
+        'sv_directory': ['ham'],
+    }
+    assert sv.join('spam', 'run').read() == 'hand edited'
+    assert sv.join('spam', 'stray').check(file=True)
+
+
+def test_audit_service_shards(basedir):
+    """
+    Services linked into shards aren't drift, and undeclared services in
+    every shard are reported along with the shard.
+    """
+    shards = [basedir.join('shard-%d' % (index,)) for index in range(2)]
+    for shard in shards:
+        shard.mkdir()
+    specs = [dict(SPECS[0], instances=4)]
+    bailout = run(
+        _runit_sv_module.main,
+        dict(specs[0], service_shards=[shard.strpath for shard in shards],
+             **base_directories(basedir)))
+    assert bailout.success
+    basedir.join('sv', 'ham').ensure('run')
+    shards[1].join('ham').mksymlinkto(basedir.join('sv', 'ham'))
+    bailout = audit(
+        basedir, specs=specs,
+        service_shards=[shard.strpath for shard in shards])
+    assert bailout.success
+    assert bailout.params['drift'] == {}
+    assert bailout.params['extra_services'] == {
+        'sv_directory': ['ham'],
+        'service_shards': {shards[1].strpath: ['ham']},
+    }
+
+
+def test_audit_reports_spec_errors(converged):
+    """
+    Specs which can't be planned make the audit fail, naming them.
+    """
+    bailout = audit(converged, specs=SPECS + [
+        dict(name='ham'),
+        dict(name='eggs2', runscript='', spam='eggs'),
+    ])
+    assert not bailout.success
+    assert sorted(bailout.params['errors']) == ['eggs2', 'ham']
+    assert bailout.params['drift'] == {}
+
+
+def test_dispatch_by_arguments(converged):
+    """
+    As one file serves both modules, whichever one runs is chosen by its
+    arguments: services selects runit_sv_audit, and anything else runit_sv.
+    """
+    bailout = run(
+        _runit_sv_module.main_dispatch,
+        dict(base_directories(converged), services=SPECS), check_mode=True)
+    assert bailout.success
+    assert bailout.params['drift'] == {}
+    bailout = run(
+        _runit_sv_module.main_dispatch,
+        dict(SPECS[0], **base_directories(converged)))
+    assert bailout.success
+    assert not bailout.params['changed']
+
+
+@pytest.mark.parametrize(('params', 'message'), [
+    (dict(name='spam'), 'missing required arguments: runscript'),
+    (dict(services=SPECS, runscript='spam run'),
+     'unsupported parameters: runscript'),
+])
+def test_dispatch_invalid_arguments(basedir, params, message):
+    """
+    Required and unsupported arguments are checked against the module the
+    arguments select.
+    """
+    bailout = run(
+        _runit_sv_module.main_dispatch,
+        dict(params, **base_directories(basedir)))
+    assert not bailout.success
+    assert bailout.params['msg'] == message
@@ -0,0 +1,260 @@
+# Copyright (c) weykent <weykent@weasyl.com>
+# See COPYING for details.
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import runit_sv as _runit_sv_module
+from test_runit_sv import base_directories
+
+
+RUNIT_SV = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'bin', 'runit-sv')
+
+
+def write_specs(basedir, specs):
+    path = basedir.join('spec.json')
+    path.write(json.dumps(dict(
+        base_directories(basedir),
+        services=specs)))
+    return path.strpath
+
+
+def run_cli(capsys, *argv):
+    status = _runit_sv_module.main_cli(list(argv))
+    out, _ = capsys.readouterr()
+    return status, json.loads(out)
+
+
+SPECS = [
+    dict(name='spam', runscript='spam run', envdir={'SPAM': 'eggs'}),
+    dict(name='eggs', runscript='eggs run', instances=2),
+]
+
+
+def test_cli_apply(basedir, capsys):
+    """
+    apply converges every spec in the file, with the file's directories as
+    defaults, and applying again changes nothing.
+    """
+    path = write_specs(basedir, SPECS)
+    status, output = run_cli(capsys, 'apply', path)
+    assert status == 0
+    assert output['changed'] and output['failed'] == []
+    assert sorted(output['services']) == ['eggs', 'spam']
+    assert output['services']['eggs']['instances'] == ['eggs-1', 'eggs-2']
+    assert basedir.join('sv', 'spam', 'env', 'SPAM').read() == 'eggs'
+    assert basedir.join('service', 'eggs-2').readlink() == (
+        basedir.join('sv', 'eggs-2').strpath)
+
+    status, output = run_cli(capsys, 'apply', path)
+    assert status == 0 and not output['changed']
+
+
+def test_cli_plan_and_check(basedir, capsys):
+    """
+    plan and check change nothing; plan reports what apply would change, and
+    check exits with status 1 while anything would.
+    """
+    path = write_specs(basedir, SPECS)
+    status, output = run_cli(capsys, 'plan', path)
+    assert status == 0 and output['changed']
+    run_file = basedir.join('sv', 'spam', 'run').strpath
+    assert output['services']['spam']['changes'][run_file]['reason'] == (
+        'missing')
+    assert not basedir.join('sv').listdir()
+
+    assert run_cli(capsys, 'check', path) == (
+        1, dict(changed=['eggs', 'spam'], failed={}))
+    run_cli(capsys, 'apply', path)
+    assert run_cli(capsys, 'check', path) == (0, dict(changed=[], failed={}))
+
+
+def test_cli_failed_spec(basedir, capsys):
+    """
+    A spec which fails doesn't stop the others from being applied, but makes
+    the command exit with status 2.
+    """
+    path = write_specs(basedir, [dict(name='ham')] + SPECS)
+    status, output = run_cli(capsys, 'apply', path)
+    assert status == 2
+    assert output['failed'] == ['ham']
+    assert 'runscript' in output['services']['ham']['msg']
+    assert basedir.join('sv', 'eggs-1', 'run').read() == 'eggs run'
+
+
+def test_cli_list_from_string(basedir, capsys):
+    """
+    A list option given as a string is split on commas, the way Ansible
+    would, rather than taken apart a character at a time.
+    """
+    path = basedir.join('spec.json')
+    path.write(json.dumps([dict(
+        name='spam', runscript='spam run',
+        sv_directory=basedir.join('sv').strpath,
+        service_directory=basedir.join('service').strpath,
+        init_d_directory=basedir.join('init.d').strpath)]))
+    status, output = run_cli(capsys, 'plan', path.strpath)
+    assert status == 0
+    paths = output['services']['spam']['paths']
+    assert basedir.join('sv', 'spam', 'run').strpath in paths
+    assert basedir.join('service', 'spam').strpath in paths
+    assert all(path.startswith(basedir.strpath) for path in paths)
+
+
+@pytest.mark.parametrize(('spec', 'message'), [
+    (dict(state='absnet'), 'value of state must be one of'),
+    (dict(apply_action='maybe'), 'apply_action must be a boolean'),
+    (dict(umask='spam'), 'umask must be an integer'),
+    (dict(envdir=['SPAM']), 'envdir must be a dict'),
+])
+def test_cli_invalid_option(basedir, capsys, spec, message):
+    """
+    A spec with an option of the wrong type, or not one of its choices,
+    fails without anything being applied.
+    """
+    path = write_specs(basedir, [dict(spec, name='spam', runscript='a')])
+    status, output = run_cli(capsys, 'apply', path)
+    assert status == 2
+    assert output['failed'] == ['spam']
+    assert message in output['services']['spam']['msg']
+    assert not basedir.join('sv').listdir()
+
+
+@pytest.mark.parametrize('document', [
+    {},
+    [1],
+    [dict(name='spam', runscript='a'), dict(name='spam', runscript='b')],
+])
+def test_cli_invalid_spec_file(basedir, capsys, document):
+    """
+    A spec file which isn't a list of specs, or declares a service twice,
+    makes the command exit with status 2 without applying anything.
+    """
+    path = basedir.join('spec.json')
+    path.write(json.dumps(document))
+    with pytest.raises(SystemExit) as excinfo:
+        _runit_sv_module.main_cli(['apply', path.strpath])
+    assert excinfo.value.code == 2
+    assert not basedir.join('sv').listdir()
+
+
+def test_cli_command(basedir):
+    """
+    bin/runit-sv runs the command, reading the specs from stdin given '-'.
+    """
+    process = subprocess.Popen(
+        [sys.executable, RUNIT_SV, 'apply', '-'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stdout, _ = process.communicate(json.dumps(
+        dict(base_directories(basedir), services=SPECS)).encode())
+    assert process.returncode == 0
+    assert json.loads(stdout.decode())['changed']
+    assert basedir.join('sv', 'spam', 'run').read() == 'spam run'
+
+
+class Lines(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, text):
+        self.lines.extend(text.splitlines())
+
+    def flush(self):
+        pass
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+@pytest.fixture(params=['inotify', 'poll'])
+def watcher(request):
+    if request.param == 'inotify':
+        watcher = _runit_sv_module.make_watcher()
+        if not isinstance(watcher, _runit_sv_module.InotifyWatcher):
+            pytest.skip('inotify is unavailable')
+    else:
+        watcher = _runit_sv_module.make_watcher(poll_interval=0.02)
+    yield watcher
+    watcher.close()
+
+
+@pytest.fixture
+def reconciler(basedir, capsys, watcher):
+    specs = [dict(spec, **base_directories(basedir)) for spec in SPECS]
+    run_cli(capsys, 'apply', write_specs(basedir, SPECS))
+    output = Lines()
+    reconciler = _runit_sv_module.Reconciler(
+        specs, watcher, debounce=0.05, output=output)
+    stopped = threading.Event()
+    thread = threading.Thread(target=reconciler.run, args=(stopped.is_set,))
+    thread.start()
+    yield reconciler
+    stopped.set()
+    thread.join()
+
+
+def test_watch_repairs_drift(basedir, reconciler):
+    """
+    The reconciler repairs edited, removed and stray managed paths soon after
+    they change, writing a metrics line for each service it repaired.
+    """
+    sv = basedir.join('sv')
+    sv.join('spam', 'run').write('spam spam')
+    sv.join('spam', 'env', 'SPAM').remove()
+    sv.join('spam', 'env', 'HAM').write('ham')
+    basedir.join('service', 'eggs-2').remove()
+    wait_for(lambda: len(reconciler.output.lines) == 2)
+    assert sv.join('spam', 'run').read() == 'spam run'
+    assert sv.join('spam', 'env', 'SPAM').read() == 'eggs'
+    assert not sv.join('spam', 'env', 'HAM').check()
+    assert basedir.join('service', 'eggs-2').readlink() == (
+        sv.join('eggs-2').strpath)
+    lines = sorted(reconciler.output.lines)
+    assert lines[0].startswith(
+        'runit_sv_repair service=eggs failed=0 paths=1 reasons=missing '
+        'service_action=none log_action=none duration_seconds=')
+    assert lines[1].startswith(
+        'runit_sv_repair service=spam failed=0 paths=3 '
+        'reasons=content,missing,stray service_action=restart '
+        'log_action=none duration_seconds=')
+
+
+def test_watch_recreates_directories(basedir, reconciler):
+    """
+    A removed service directory is recreated, and watched again.
+    """
+    sv = basedir.join('sv')
+    sv.join('spam').remove()
+    wait_for(lambda: sv.join('spam', 'env', 'SPAM').check())
+    sv.join('spam', 'env', 'SPAM').write('ham')
+    wait_for(lambda: sv.join('spam', 'env', 'SPAM').read() == 'eggs')
+
+
+def test_watch_ignores_unmanaged_paths(basedir, watcher):
+    """
+    Changes to paths no spec manages aren't checked at all.
+    """
+    specs = [dict(spec, **base_directories(basedir)) for spec in SPECS]
+    reconciler = _runit_sv_module.Reconciler(specs, watcher, output=Lines())
+    touched = [basedir.join('sv', 'ham').strpath,
+               basedir.join('service', 'ham').strpath,
+               basedir.join('sv', 'spam', 'log', 'main', 'current').strpath]
+    assert all(reconciler.relevant_paths(spec, touched) == []
+               for spec in specs)
+    assert reconciler.repair(set(touched)) == []
+    assert reconciler.relevant_paths(
+        specs[0], [basedir.join('sv', 'spam').strpath]) == [
+            basedir.join('sv', 'spam').strpath]
@@ -0,0 +1,134 @@
+# Copyright (c) weykent <weykent@weasyl.com>
+# See COPYING for details.
+
+import os
+import struct
+
+import pytest
+
+
+# The collector is a standalone script installed by the role, not a module on
+# the path. runpy would do, except that on Python 2 it clears the globals of
+# what it ran once it returns.
+COLLECTOR = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'files', 'runit_sv_metrics.py')
+metrics = {'__name__': 'runit_sv_metrics', '__file__': COLLECTOR}
+with open(COLLECTOR) as infile:
+    exec(compile(infile.read(), COLLECTOR, 'exec'), metrics)
+
+
+def write_status(supervise, pid, want=b'u', state=1, paused=0,
+                 timestamp=1000):
+    supervise.ensure(dir=True).join('status').write_binary(
+        struct.pack('>Q', timestamp + metrics['TAI64_EPOCH'])
+        + struct.pack('<4sIBcBB', b'\0' * 4, pid, paused, want, 0, state))
+
+
+@pytest.fixture
+def service_directory(tmpdir):
+    service = tmpdir.join('service')
+    service.ensure(dir=True)
+    return service
+
+
+def test_read_status(service_directory):
+    """
+    read_status parses every field of a runsv status file.
+    """
+    supervise = service_directory.join('spam', 'supervise')
+    write_status(supervise, 1234, want=b'd', state=2, paused=1)
+    assert metrics['read_status'](supervise.strpath) == dict(
+        timestamp=1000, pid=1234, paused=True, want_up=False,
+        state='finish')
+
+
+@pytest.mark.parametrize('content', [None, b'', b'\0' * 19])
+def test_read_status_incomplete(tmpdir, content):
+    """
+    Without a complete status file, there's no status.
+    """
+    if content is not None:
+        tmpdir.join('status').write_binary(content)
+    assert metrics['read_status'](tmpdir.strpath) is None
+
+
+def test_scrape(service_directory):
+    """
+    Every service and log service with a status is scraped; anything else is
+    skipped.
+    """
+    write_status(service_directory.join('spam', 'supervise'), 1)
+    write_status(service_directory.join('spam', 'log', 'supervise'), 2)
+    write_status(service_directory.join('eggs', 'supervise'), 3)
+    service_directory.join('ham').ensure(dir=True)
+    service_directory.join('.hidden', 'supervise').ensure(dir=True)
+    statuses = metrics['scrape']([service_directory.strpath])
+    assert sorted(statuses) == ['eggs', 'spam', 'spam/log']
+    assert statuses['spam/log']['pid'] == 2
+
+
+def test_scrape_several_directories(tmpdir, service_directory):
+    """
+    Services are scraped from every service directory given, as from each
+    of the shards services are linked into.
+    """
+    shard = tmpdir.join('shard-0')
+    write_status(service_directory.join('spam', 'supervise'), 1)
+    write_status(shard.join('eggs', 'supervise'), 2)
+    statuses = metrics['scrape']([service_directory.strpath, shard.strpath])
+    assert sorted(statuses) == ['eggs', 'spam']
+    assert statuses['eggs']['pid'] == 2
+
+
+def test_collector_counts_restarts(service_directory):
+    """
+    A service's restarts are counted from its pid changing between scrapes,
+    including across scrapes where it was down.
+    """
+    supervise = service_directory.join('spam', 'supervise')
+    collector = metrics['Collector']([service_directory.strpath])
+    for pid in [10, 10, 11, 0, 12, 12]:
+        write_status(supervise, pid, state=1 if pid else 0)
+        collector.collect(now=1010)
+    assert collector.restarts == {'spam': 2}
+
+
+def test_collector_renders_textfile(service_directory):
+    """
+    The textfile has every metric for every service, in the node_exporter
+    text format.
+    """
+    write_status(service_directory.join('spam', 'supervise'), 10)
+    write_status(
+        service_directory.join('eggs', 'supervise'), 0, want=b'd', state=0)
+    text = metrics['Collector']([service_directory.strpath]).collect(now=1010)
+    assert '# TYPE runit_service_restarts_total counter\n' in text
+    for line in [
+            'runit_service_up{service="spam"} 1',
+            'runit_service_up{service="eggs"} 0',
+            'runit_service_want_up{service="eggs"} 0',
+            'runit_service_uptime_seconds{service="spam"} 10',
+            'runit_service_state_change_timestamp_seconds{service="spam"} '
+            '1000',
+            'runit_service_restarts_total{service="spam"} 0']:
+        assert line + '\n' in text
+
+
+def test_main_once(tmpdir, service_directory):
+    """
+    With --once, main scrapes every service directory given once, and
+    atomically writes the textfile.
+    """
+    write_status(service_directory.join('spam', 'supervise'), 10)
+    output = tmpdir.join('runit.prom')
+    write_status(tmpdir.join('shard-0', 'eggs', 'supervise'), 11)
+    assert metrics['main']([
+        '--service-directory', service_directory.strpath,
+        '--service-directory', tmpdir.join('shard-0').strpath,
+        '--output', output.strpath, '--once']) == 0
+    text = output.read()
+    assert 'runit_service_up{service="spam"} 1\n' in text
+    assert 'runit_service_up{service="eggs"} 1\n' in text
+    assert oct(output.stat().mode & 0o777) == oct(0o644)
+    assert sorted(p.basename for p in tmpdir.listdir()) == [
+        'runit.prom', 'service', 'shard-0']
@@ -0,0 +1,163 @@
+# Copyright (c) weykent <weykent@weasyl.com>
+# See COPYING for details.
+
+"""
+Budgets for the system calls runit_sv makes, so that regressions in how much
+work a run does per managed file fail the suite.
+
+Calls are counted by wrapping the os and fcntl functions runit_sv uses, and
+open, for the duration of a run through the fake module harness. A call to
+open is counted once, however many reads and writes the file object makes.
+"""
+
+import collections
+import fcntl
+import os
+
+import pytest
+
+import runit_sv as _runit_sv_module
+from test_runit_sv import (
+    FakeAnsibleModule, FakeAnsibleModuleBailout, base_directories, settle)
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+
+OS_CALLS = [
+    'chmod', 'close', 'fchmod', 'fstat', 'fsync', 'link', 'listdir', 'lstat',
+    'mkdir', 'open', 'read', 'readlink', 'rename', 'replace', 'rmdir',
+    'scandir', 'stat', 'symlink', 'unlink', 'write',
+]
+
+
+@pytest.fixture
+def count_calls(monkeypatch):
+    """
+    Return a function running runit_sv's main with some params, and returning
+    its result and a Counter of the calls it made.
+    """
+    counts = collections.Counter()
+
+    def counting(name, function):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return function(*args, **kwargs)
+        return wrapper
+
+    def run(params, check_mode=False):
+        counts.clear()
+        module = FakeAnsibleModule(dict(params), check_mode)
+        with monkeypatch.context() as patch:
+            for name in OS_CALLS:
+                function = getattr(os, name, None)
+                if function is not None:
+                    patch.setattr(os, name, counting(name, function))
+            patch.setattr(_runit_sv_module, 'replace', counting(
+                'replace', _runit_sv_module.replace))
+            patch.setattr(fcntl, 'flock', counting('flock', fcntl.flock))
+            patch.setattr(builtins, 'open', counting('open', builtins.open))
+            with pytest.raises(FakeAnsibleModuleBailout) as excinfo:
+                _runit_sv_module.main(module)
+        assert excinfo.value.success, excinfo.value.params
+        return excinfo.value.params, collections.Counter(counts)
+
+    return run
+
+
+def service_params(basedir, envdir_size=20, **params):
+    params.update(base_directories(basedir))
+    params.setdefault('name', 'testsv')
+    params.setdefault('runscript', '#!/bin/sh\nexec testsv\n')
+    params.setdefault('log_runscript', '#!/bin/sh\nexec svlogd -tt main\n')
+    params.setdefault('envdir', dict(
+        ('VAR%d' % (i,), 'value %d' % (i,)) for i in range(envdir_size)))
+    return params
+
+
+def converged(count_calls, params):
+    count_calls(params)
+    settle()
+    return count_calls(params)
+
+
+def scenario_converge(count_calls, params):
+    return count_calls(params)
+
+
+def scenario_manifest_hit(count_calls, params):
+    converged(count_calls, params)
+    return count_calls(params)
+
+
+def scenario_verify_full(count_calls, params):
+    converged(count_calls, params)
+    return count_calls(dict(params, verify='full'))
+
+
+def scenario_check_mode(count_calls, params):
+    converged(count_calls, params)
+    return count_calls(dict(params, verify='full'), check_mode=True)
+
+
+def scenario_one_change(count_calls, params):
+    converged(count_calls, params)
+    with open(os.path.join(
+            params['sv_directory'][0], params['name'], 'run'), 'w') as f:
+        f.write('#!/bin/sh\nexec eggs\n')
+    return count_calls(params)
+
+
+def scenario_absent(count_calls, params):
+    converged(count_calls, params)
+    return count_calls(dict(params, state='absent', remove_sv_directory=True))
+
+
+# Each scenario's budget is a fixed cost for a service with a log service and
+# an envdir of ten variables, and a cost for every further variable.
+BUDGETS = [
+    (scenario_converge, 228, 14),
+    (scenario_manifest_hit, 39, 1),
+    (scenario_verify_full, 97, 5),
+    (scenario_check_mode, 70, 4),
+    (scenario_one_change, 117, 5),
+    (scenario_absent, 69, 1),
+]
+
+
+def measure(basedir, count_calls, scenario, envdir_size):
+    directory = basedir.join('envdir-%d' % (envdir_size,))
+    params = service_params(directory, envdir_size)
+    for d in ['sv', 'service', 'init.d']:
+        directory.join(d).ensure(dir=True)
+    return scenario(count_calls, params)
+
+
+@pytest.mark.parametrize(('scenario', 'base', 'per_file'), BUDGETS)
+def test_syscall_budget(basedir, count_calls, scenario, base, per_file):
+    """
+    Each scenario stays within its budget of calls, both in total and for
+    every managed file added.
+    """
+    _, small = measure(basedir, count_calls, scenario, 10)
+    _, large = measure(basedir, count_calls, scenario, 30)
+    small_total = sum(small.values())
+    large_total = sum(large.values())
+    assert small_total <= base, small
+    assert large_total - small_total <= per_file * 20, large - small
+
+
+def test_noop_converge_budget(basedir, count_calls):
+    """
+    A no-op converge of a service with 20 env vars, answered from its
+    manifest, makes at most 49 calls and opens no managed file.
+    """
+    params = service_params(basedir, 20)
+    result, counts = scenario_manifest_hit(count_calls, params)
+    assert result['manifest'] == 'hit' and not result['changed']
+    assert sum(counts.values()) <= 49, counts
+    _, few_counts = scenario_manifest_hit(count_calls, dict(
+        params, name='fewsv', envdir={'VAR': 'value'}))
+    assert counts['open'] == few_counts['open']
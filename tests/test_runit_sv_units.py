@@ -1,6 +1,12 @@
 # Copyright (c) weykent <weykent@weasyl.com>
 # See COPYING for details.
 
+import errno
+import fcntl
+import multiprocessing
+import os
+import time
+
 import decorator
 import py.path
 import pytest
@@ -139,6 +145,17 @@ def test_hash_file_propagates_open_exceptions(tmpdir):
         runit_sv.hash_file(f.strpath)
 
 
+def test_hash_file_propagates_read_exceptions(tmpdir):
+    """
+    Errors raised by reading the path passed to hash_file, such as it being a
+    directory, are propagated upward as IOErrors.
+    """
+    with pytest.raises(IOError) as excinfo:
+        runit_sv.hash_file(tmpdir.strpath)
+    assert excinfo.value.errno == errno.EISDIR
+    assert excinfo.value.filename == tmpdir.strpath
+
+
 def test_makedirs_exist_ok_ignores_extant_directories(tmpdir):
     """
     If makedirs_exist_ok is passed the path to an extant directory, the
@@ -182,6 +199,143 @@ def test_makedirs_exist_ok_propagates_makedirs_exceptions(tmpdir):
         runit_sv.makedirs_exist_ok(d.strpath)
 
 
+@pytest.mark.parametrize(('value', 'expected'), [
+    (0, 0),
+    (4096, 4096),
+    ('4096', 4096),
+    ('4k', 4096),
+    ('2M', 2 << 20),
+    ('1g', 1 << 30),
+    ('1T', 1 << 40),
+])
+def test_parse_size(value, expected):
+    """
+    parse_size accepts plain byte counts and binary K/M/G/T suffixes.
+    """
+    assert runit_sv.parse_size(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', 'M', 'spam', '1.5M'])
+def test_parse_size_invalid(value):
+    """
+    parse_size raises ValueError for anything else.
+    """
+    with pytest.raises(ValueError):
+        runit_sv.parse_size(value)
+
+
+@pytest.mark.parametrize(('value', 'expected'), [
+    (None, None),
+    (0, 0),
+    (3, 3),
+    ('3', 3),
+    ('auto', 8),
+    ('auto:cores', 8),
+    ('auto:cores/2', 4),
+    ('auto:cores/3', 2),
+    ('auto:cores/16', 1),
+    ('auto:cores*2', 16),
+])
+def test_parse_instances(value, expected):
+    """
+    parse_instances accepts a count or a multiple or fraction of the number
+    of cores, which never rounds down to no instances at all.
+    """
+    assert runit_sv.parse_instances(value, cores=8) == expected
+
+
+@pytest.mark.parametrize('value', [-1, '-1', 'spam', 'auto:cores+1', 'auto:'])
+def test_parse_instances_invalid(value):
+    """
+    parse_instances raises ValueError for anything else.
+    """
+    with pytest.raises(ValueError):
+        runit_sv.parse_instances(value, cores=8)
+
+
+def test_flock_with_timeout_acquires_free_lock(tmpdir):
+    """
+    flock_with_timeout returns how long it waited if the lock is free.
+    """
+    fd = os.open(tmpdir.strpath, os.O_RDONLY)
+    try:
+        waited = runit_sv.flock_with_timeout(fd, fcntl.LOCK_EX, 0)
+    finally:
+        os.close(fd)
+    assert waited >= 0
+
+
+def test_flock_with_timeout_times_out(tmpdir):
+    """
+    If the lock is held elsewhere for longer than the timeout,
+    flock_with_timeout raises LockTimeoutError.
+    """
+    holder = os.open(tmpdir.strpath, os.O_RDONLY)
+    fd = os.open(tmpdir.strpath, os.O_RDONLY)
+    try:
+        fcntl.flock(holder, fcntl.LOCK_EX)
+        with pytest.raises(runit_sv.LockTimeoutError):
+            runit_sv.flock_with_timeout(fd, fcntl.LOCK_SH, 0.05)
+    finally:
+        os.close(fd)
+        os.close(holder)
+
+
+def test_directorylocks_create(tmpdir):
+    """
+    DirectoryLocks will create the directory to lock if asked to, and keeps a
+    descriptor open until released.
+    """
+    d = tmpdir.join('d')
+    locks = runit_sv.DirectoryLocks(0)
+    assert locks.acquire(d.strpath, fcntl.LOCK_EX, create=True)
+    assert d.check(dir=True) and len(locks.fds) == 1
+    locks.release()
+    assert not locks.fds
+
+
+def test_directorylocks_missing_directory(tmpdir):
+    """
+    Without create, DirectoryLocks skips locking a nonextant directory.
+    """
+    locks = runit_sv.DirectoryLocks(0)
+    assert not locks.acquire(tmpdir.join('d').strpath, fcntl.LOCK_EX)
+    assert not locks.fds
+
+
+def test_semaphore_uses_free_slot(tmpdir):
+    """
+    A Semaphore can be acquired as long as any one of its slots is free.
+    """
+    held = runit_sv.Semaphore(tmpdir.strpath, 2)
+    held.acquire(0)
+    sem = runit_sv.Semaphore(tmpdir.strpath, 2)
+    try:
+        assert sem.acquire(0) >= 0
+        assert sem.fd is not None
+    finally:
+        sem.release()
+        held.release()
+    assert sorted(p.basename for p in tmpdir.listdir()) == [
+        'slot-0', 'slot-1']
+
+
+def test_semaphore_times_out(tmpdir):
+    """
+    If every slot of a Semaphore is held elsewhere for longer than the
+    timeout, acquiring it raises LockTimeoutError.
+    """
+    held = runit_sv.Semaphore(tmpdir.strpath, 1)
+    held.acquire(0)
+    sem = runit_sv.Semaphore(tmpdir.strpath, 1)
+    try:
+        with pytest.raises(runit_sv.LockTimeoutError):
+            sem.acquire(0.05)
+        assert sem.fd is None
+    finally:
+        held.release()
+
+
 @pytest.mark.parametrize(('ops', 'content', 'content_expected'), [
     ('f', '', True),
     (empty_file('f'), None, True),
@@ -225,6 +379,79 @@ def test_filerecord_check_if_must_change_no_file_or_content(tmpdir):
     assert not fr.must_change
 
 
+@pytest.mark.parametrize(('ops', 'mode', 'content', 'reason'), [
+    ('f', 0o644, 'spam', 'missing'),
+    ('f', 0o644, None, None),
+    (simple_file('f', 'spam'), 0o644, None, 'extra'),
+    (simple_file('f', 'spam'), 0o644, 'spam', None),
+    (simple_file('f', 'spam'), 0o644, 'eggs', 'content'),
+    (simple_file('f', 'spam'), 0o755, 'spam', 'mode'),
+    (simple_file('f', 'spam'), 0o755, True, 'mode'),
+    (simple_file('f', 'spam'), 0o755, 'eggs', 'content+mode'),
+])
+def test_filerecord_change_reason(tmpdir, ops, mode, content, reason):
+    """
+    Checking a FileRecord records why it must change, and describes the
+    current and desired digest and mode of its path.
+    """
+    p = make_path(tmpdir, ops, mode=0o644)
+    fr = runit_sv.FileRecord(p, mode, content)
+    fr.check_if_must_change()
+    assert fr.reason == reason
+    assert fr.must_change == (reason is not None)
+    description = fr.describe_change()
+    assert description['reason'] == reason
+    if os.path.exists(p):
+        assert description['current'] == {
+            'digest': runit_sv.hash_content('spam'), 'mode': '0644'}
+    else:
+        assert description['current'] is None
+    if content is None:
+        assert description['desired'] is None
+    else:
+        assert description['desired'] == {
+            'digest': (None if content is True
+                       else runit_sv.hash_content(content)),
+            'mode': '%04o' % (mode,)}
+
+
+@pytest.mark.parametrize(('ops', 'target', 'reason'), [
+    ('l', 'target', 'missing'),
+    (symlink('l', 'target'), 'spam', 'target'),
+    (symlink('l', 'target'), None, 'extra'),
+    (symlink('l', 'target'), 'target', None),
+])
+def test_linkrecord_change_reason(tmpdir, ops, target, reason):
+    """
+    Checking a LinkRecord records why it must change, and describes the
+    current and desired target of its path.
+    """
+    p = make_path(tmpdir, ops)
+    lr = runit_sv.LinkRecord(p, target)
+    lr.check_if_must_change()
+    assert lr.reason == reason
+    current = None
+    if os.path.lexists(p):
+        current = {'target': os.readlink(p)}
+    assert lr.describe_change() == {
+        'reason': reason, 'current': current,
+        'desired': None if target is None else {'target': target}}
+
+
+@pytest.mark.parametrize(('ops', 'which', 'kind'), [
+    (empty_file('f'), 'rm', 'file'),
+    (mkdir('d'), 'rmdir', 'directory'),
+])
+def test_removething_change_reason(tmpdir, ops, which, kind):
+    """
+    Anything a RemoveThing finds to remove is a stray.
+    """
+    rt = getattr(runit_sv, which)(make_path(tmpdir, ops))
+    rt.check_if_must_change()
+    assert rt.describe_change() == {
+        'reason': 'stray', 'current': {'type': kind}, 'desired': None}
+
+
 @pytest.mark.parametrize('initial_state', [
     'f',
     'd/f',
@@ -347,6 +574,21 @@ def test_filerecord_propagates_lstat_exceptions(tmpdir):
         fr.commit()
 
 
+@pytest.mark.parametrize('record', [
+    runit_sv.FileRecord('x', 0o644, 'spam'),
+    runit_sv.LinkRecord('x', 'spam'),
+    runit_sv.rm('x'),
+    runit_sv.rmdir('x'),
+], ids=lambda r: type(r).__name__)
+def test_records_have_no_instance_dict(record):
+    """
+    Records only have slots, so that large plans stay compact.
+    """
+    assert not hasattr(record, '__dict__')
+    with pytest.raises(AttributeError):
+        record.spam = 'eggs'
+
+
 @pytest.mark.parametrize(('path', 'mode', 'content', 'expected'), [
     ('x', 0o644, None, '''<FileRecord {}: None @'x'(644)>'''),
     ("y'", 0o755, 'spam', '''<FileRecord {}: 'spam' @"y'"(755)>'''),
@@ -542,3 +784,251 @@ def test_removething_repr(path, stat_type, remover, expected):
     """
     rt = runit_sv.RemoveThing(path, stat_type, remover)
     assert repr(rt) == expected.format(hex(id(rt)))
+
+
+class ExplodingRecord(runit_sv.Record):
+    def __init__(self, path='exploding'):
+        super(ExplodingRecord, self).__init__(path)
+        self.must_change = True
+
+    def apply(self):
+        raise OSError(errno.ENOSPC, 'no space left on device')
+
+    def rollback(self):
+        pass
+
+
+@pytest.mark.parametrize(('ops', 'reason'), [
+    ('d', 'missing'),
+    ('e/d', 'missing'),
+    (mkdir('d'), 'mode'),
+])
+def test_dirrecord_commit(tmpdir, ops, reason):
+    """
+    DirRecord objects create their directory, along with any missing parents,
+    or fix its mode.
+    """
+    p = make_path(tmpdir, ops, mode=0o755)
+    dr = runit_sv.DirRecord(p, 0o700)
+    dr.check_if_must_change()
+    assert dr.reason == reason
+    dr.commit()
+    assert dr.changed
+    assert py.path.local(p).stat().mode & runit_sv.SETTABLE_MASK == 0o700
+    dr.check_if_must_change()
+    assert not dr.must_change
+
+
+def test_dirrecord_rollback(tmpdir):
+    """
+    Rolling back a DirRecord removes the directory it created, and the
+    parents created for it.
+    """
+    dr = runit_sv.DirRecord(tmpdir.join('e', 'd').strpath, 0o700)
+    dr.check_if_must_change()
+    with pytest.raises(OSError):
+        runit_sv.commit_records([dr, ExplodingRecord()])
+    assert not tmpdir.listdir()
+
+
+def test_dirrecord_not_a_directory(tmpdir):
+    """
+    A DirRecord won't replace something which isn't a directory.
+    """
+    tmpdir.join('d').write('')
+    dr = runit_sv.DirRecord(tmpdir.join('d').strpath, 0o700)
+    with pytest.raises(runit_sv.PathAlreadyExistsError):
+        dr.check_if_must_change()
+
+
+def test_commit_records_rolls_back_applied_records(tmpdir):
+    """
+    If applying any record fails, every record applied before it is rolled
+    back to its journaled state and the original exception propagates.
+    """
+    f = tmpdir.join('f')
+    f.write('old')
+    f.chmod(0o600)
+    link = tmpdir.join('l')
+    link.mksymlinkto('old-target')
+    r = tmpdir.join('r')
+    r.write('removed')
+    d = tmpdir.join('d')
+    d.ensure('inner', 'file')
+    records = [
+        runit_sv.FileRecord(f.strpath, 0o755, 'new'),
+        runit_sv.FileRecord(tmpdir.join('n').strpath, 0o644, 'new'),
+        runit_sv.LinkRecord(link.strpath, 'new-target'),
+        runit_sv.rm(r.strpath),
+        runit_sv.rmdir(d.strpath),
+        ExplodingRecord(),
+    ]
+    for record in records[:-1]:
+        record.check_if_must_change()
+        assert record.must_change
+    with pytest.raises(OSError) as excinfo:
+        runit_sv.commit_records(records)
+    assert excinfo.value.errno == errno.ENOSPC
+    assert f.read() == 'old'
+    assert f.stat().mode & runit_sv.SETTABLE_MASK == 0o600
+    assert link.readlink() == 'old-target'
+    assert r.read() == 'removed'
+    assert d.join('inner', 'file').check(file=True)
+    assert sorted(p.basename for p in tmpdir.listdir()) == [
+        'd', 'f', 'l', 'r']
+    assert not any(record.changed for record in records)
+
+
+def test_commit_records_prepare_failure_touches_nothing(tmpdir):
+    """
+    If preparing any record fails, no managed path is touched, and neither
+    temporary files nor the directories created for them are left behind.
+    """
+    records = [
+        runit_sv.FileRecord(tmpdir.join('d', 'f').strpath, 0o644, 'new'),
+        runit_sv.FileRecord(tmpdir.join('missing').strpath, 0o644, True),
+    ]
+    for record in records:
+        record.must_change = True
+    with pytest.raises(runit_sv.FileDoesNotExistError):
+        runit_sv.commit_records(records)
+    assert not tmpdir.listdir()
+
+
+def test_commit_records_prepare_failure_discards_temporary_links(tmpdir):
+    """
+    A LinkRecord prepares its new link beside the old one, and discards it if
+    preparing a later record fails.
+    """
+    link = tmpdir.join('l')
+    link.mksymlinkto('old-target')
+    records = [
+        runit_sv.LinkRecord(link.strpath, 'new-target'),
+        runit_sv.LinkRecord(tmpdir.join('d', 'l').strpath, 'new-target'),
+        runit_sv.FileRecord(tmpdir.join('missing').strpath, 0o644, True),
+    ]
+    for record in records:
+        record.must_change = True
+    with pytest.raises(runit_sv.FileDoesNotExistError):
+        runit_sv.commit_records(records)
+    assert [p.basename for p in tmpdir.listdir()] == ['l']
+    assert link.readlink() == 'old-target'
+
+
+def _hammer_readlink(path, stop, reads, errors):
+    while not stop.is_set():
+        try:
+            os.readlink(path)
+        except OSError:
+            errors.value += 1
+        reads.value += 1
+
+
+def test_linkrecord_retarget_is_atomic(tmpdir):
+    """
+    Retargeting a link never leaves its path missing, even for an instant, so
+    runsvdir rescanning the service directory always finds the service.
+    """
+    link = tmpdir.join('l')
+    link.mksymlinkto('target-0')
+    stop = multiprocessing.Event()
+    reads = multiprocessing.Value('l', 0)
+    errors = multiprocessing.Value('l', 0)
+    hammer = multiprocessing.Process(
+        target=_hammer_readlink, args=(link.strpath, stop, reads, errors))
+    hammer.start()
+    try:
+        while not reads.value:
+            time.sleep(0.001)
+        for n in range(1, 1000):
+            record = runit_sv.LinkRecord(link.strpath, 'target-%d' % (n,))
+            record.check_if_must_change()
+            record.commit()
+    finally:
+        stop.set()
+        hammer.join()
+    assert not errors.value
+    assert link.readlink() == 'target-999'
+    assert [p.basename for p in tmpdir.listdir()] == ['l']
+
+
+def test_commit_records_removes_things_on_success(tmpdir):
+    """
+    RemoveThing objects only move things aside while applying; the things are
+    actually removed once every record has been applied.
+    """
+    d = tmpdir.join('d')
+    d.ensure('inner', 'file')
+    r = tmpdir.join('r')
+    r.write('')
+    records = [runit_sv.rmdir(d.strpath), runit_sv.rm(r.strpath)]
+    for record in records:
+        record.check_if_must_change()
+    runit_sv.commit_records(records)
+    assert not tmpdir.listdir()
+    assert all(record.changed for record in records)
+
+
+def test_commit_records_reports_failed_rollbacks(tmpdir):
+    """
+    If rolling a record back fails, RollbackFailedError names its path.
+    """
+    class UnrollableRecord(ExplodingRecord):
+        def apply(self):
+            pass
+
+        def rollback(self):
+            raise OSError(errno.EIO, 'input/output error')
+
+    with pytest.raises(runit_sv.RollbackFailedError) as excinfo:
+        runit_sv.commit_records(
+            [UnrollableRecord('unrollable'), ExplodingRecord()])
+    assert [path for path, _ in excinfo.value.args[0]] == ['unrollable']
+
+
+@pytest.mark.parametrize(('content', 'expected'), [
+    (None, None),
+    (b'', None),
+    (b'\0' * 12 + b'\xd2\x04\0\0\0u\0\x01', (1234, b'u', 1)),
+    (b'\0' * 12 + b'\0\0\0\0\0d\0\0', (0, b'd', 0)),
+    (b'\0' * 12 + b'\xd2\x04', None),
+])
+def test_read_supervise_status(tmpdir, content, expected):
+    """
+    read_supervise_status parses the pid, wanted state and state out of a
+    runsv status file, and returns None if there's no complete one.
+    """
+    if content is not None:
+        tmpdir.join('status').write_binary(content)
+    assert runit_sv.read_supervise_status(tmpdir.strpath) == expected
+
+
+def test_send_control_without_runsv(tmpdir):
+    """
+    With no runsv reading the control fifo, or no fifo at all, nothing is sent
+    and the service isn't considered running.
+    """
+    assert not runit_sv.send_control(tmpdir.strpath, [b'd'])
+    os.mkfifo(tmpdir.join('control').strpath)
+    os.mkfifo(tmpdir.join('ok').strpath)
+    assert not runit_sv.send_control(tmpdir.strpath, [b'd'])
+    assert not runit_sv.supervisor_running(tmpdir.strpath)
+
+
+@pytest.mark.parametrize(('relative', 'expected'), [
+    ('run', ('service', 'restart')),
+    ('env/SPAM', ('service', 'restart')),
+    ('log', ('service', 'restart')),
+    ('log/run', ('log', 'restart')),
+    ('log/main/config', ('log', 'restart')),
+    ('down', None),
+    ('finish', None),
+    ('control/h', None),
+    ('../../service/testsv', None),
+])
+def test_default_action(relative, expected):
+    """
+    Changes to anything a service runs need it restarted; changes to its log
+    service need only that restarted; some changes need nothing.
+    """
+    assert runit_sv.default_action(relative.replace('/', os.sep)) == expected